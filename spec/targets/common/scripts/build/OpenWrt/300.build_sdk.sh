@@ -3,6 +3,6 @@
 topdir="${SDK_TOPDIR:?}"
 cd $topdir
 
-cmd="make ${VERBOSE:+V=sc} -j${NUM_BUILD_CORES:-1}"
+cmd="make ${VERBOSE:+V=sc} -j${NUM_BUILD_CORES:-1} ${BUILD_LOAD_LIMIT:+-l$BUILD_LOAD_LIMIT}"
 printf " ~ Building SDK; Command='$cmd'\n"
 $cmd
@@ -6,6 +6,8 @@ IMAGE="${YOCTO_IMAGE_NAME:?}"
 
 # default to 1 if unspecified
 N="${NUM_BUILD_CORES:-1}"
+# make stops starting jobs above this load average, if set
+L="${BUILD_LOAD_LIMIT:+ -l $BUILD_LOAD_LIMIT}"
 
 topdir="${SDK_TOPDIR:?SDK_TOPDIR must be set}"
 
@@ -14,7 +16,7 @@ cd "$topdir"
 
 build_config="$topdir/build/conf/local.conf"
 
-echo "Patching local.conf with BB_NUMBER_THREADS=$N and PARALLEL_MAKE=-j$N"
+echo "Patching local.conf with BB_NUMBER_THREADS=$N and PARALLEL_MAKE=-j$N$L"
 
 # --------
 
@@ -27,9 +29,9 @@ fi
 
 # Update or append PARALLEL_MAKE
 if grep -q '^PARALLEL_MAKE' "$build_config"; then
-    sed -i "s/^PARALLEL_MAKE.*/PARALLEL_MAKE ?= \"-j$N\"/" "$build_config"
+    sed -i "s/^PARALLEL_MAKE.*/PARALLEL_MAKE ?= \"-j$N$L\"/" "$build_config"
 else
-    echo "PARALLEL_MAKE ?= \"-j$N\"" >> "$build_config"
+    echo "PARALLEL_MAKE ?= \"-j$N$L\"" >> "$build_config"
 fi
 
 # --------
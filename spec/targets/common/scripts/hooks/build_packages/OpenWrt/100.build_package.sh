@@ -4,7 +4,7 @@
 # to the predefined output directory.
 
 out_dir="${PACKAGE_OUTDIR:?}"
-pkgs="${PACKAGES_TO_BUILD:?}"
+pkgs="${PACKAGES_TO_BUILD?}"
 sdk_topdir="${SDK_TOPDIR:?}"
 artifacts_dir="$sdk_topdir/bin"
 ncores="${NUM_BUILD_CORES:-1}"
@@ -17,12 +17,10 @@ fail(){
 cd "$sdk_topdir" || fail "Couldn't cd to $sdk_topdir"
 mkdir -p "$out_dir"
 echo "Packages to build: $pkgs"
-for pkg in $pkgs; do
-    build_cmd=(make package/"$pkg"/{clean,compile} V=sc -j"$ncores")
-    echo "Building $pkg ('${build_cmd[@]}')"
-    "${build_cmd[@]}" || fail "Error building $pkg"
 
-    find_cmd=(find "$artifacts_dir" -iname "*$pkg*.ipk" -exec cp {} "$out_dir" \;)
-    echo "Looking for $pkg artifact ('${find_cmd[@]}')"
-    "${find_cmd[@]}"
-done
+# Independent packages are built concurrently, sharing $ncores jobs
+# through a make jobserver; the ipks produced are then copied to $out_dir.
+# See src/pkgsched.py.
+python3 -m pkgsched --topdir "$sdk_topdir" --jobs "$ncores" \
+    --artifacts-dir "$artifacts_dir" --outdir "$out_dir" $pkgs \
+    || fail "Error building one or more packages"
@@ -22,7 +22,7 @@ fail(){
 
 # use the specified number of threads
 CONFIG_FPATH="$sdk_topdir/build/conf/auto.conf"
-echo "PARALLEL_MAKE := '-j${ncores}'" >> "$CONFIG_FPATH"
+echo "PARALLEL_MAKE := '-j${ncores}${BUILD_LOAD_LIMIT:+ -l $BUILD_LOAD_LIMIT}'" >> "$CONFIG_FPATH"
 echo "BB_NUMBER_THREADS := '${ncores}'" >> "$CONFIG_FPATH"
 
 # See here for the list of supported formats:
@@ -4,12 +4,14 @@ import os
 import sys
 
 import utils
+import profiler
 
 def list_known_hooks(hooks_dir):
     return [x for x in os.listdir(hooks_dir) if os.path.isdir(hooks_dir+'/'+x)]
 
 
 utils.STREAM_LOGGING_ON__ = bool(os.getenv("VERBOSE"))
+profiler.enable_from_env()
 
 hook = sys.argv[1] if len(sys.argv)>1 and sys.argv[1] else None
 
@@ -29,4 +31,5 @@ else:
     for script in scripts:
         basename = os.path.basename(script)
         utils.log(f"Runninng {basename} [hook='{hook}']")
-        utils.run( f"{script}", capture=not bool(os.getenv("VERBOSE")) )
+        with profiler.span(basename, 'script', hook=hook):
+            utils.run( f"{script}", capture=not bool(os.getenv("VERBOSE")) )
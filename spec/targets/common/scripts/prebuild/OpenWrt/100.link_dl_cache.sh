@@ -0,0 +1,18 @@
+#!/bin/bash
+
+# Make dl/ a link to the shared download cache (if available) so that
+# source tarballs are only ever downloaded once across targets and builds.
+cache="${DL_CACHE_DIR:-}"
+[ -n "$cache" ] || exit 0
+
+dl="${SDK_TOPDIR:?}/dl"
+mkdir -p "$cache" || exit $?
+
+# keep whatever was downloaded before the cache was in use
+if [ -d "$dl" ] && [ ! -L "$dl" ]; then
+    printf " ~ Moving existing downloads into %s ...\n" "$cache"
+    cp -an "$dl"/. "$cache"/ && rm -rf "$dl" || { rc="$?"; echo "failed to move '$dl' into the download cache: (exit code $rc)" ; exit $rc; }
+fi
+
+printf " ~ Using download cache %s\n" "$cache"
+ln -sfn "$cache" "$dl"
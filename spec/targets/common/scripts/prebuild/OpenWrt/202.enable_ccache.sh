@@ -0,0 +1,22 @@
+#!/bin/bash
+
+# Build with ccache, using the persistent compiler cache mounted from the
+# host (if any). This runs after the .config has been restored, so it is
+# reapplied on every build and dropped again when ccache is not in use.
+cache="${CCACHE_DIR:-}"
+[ -n "$cache" ] || exit 0
+
+sdk_topdir="${SDK_TOPDIR:?}"
+config="$sdk_topdir/.config"
+
+printf " ~ Enabling ccache (CCACHE_DIR=%s, max size %s)\n" "$cache" "${CCACHE_MAXSIZE:-default}"
+
+# CONFIG_CCACHE is only visible with CONFIG_DEVEL
+sed -i -e '/^CONFIG_DEVEL[=]/d' -e '/^# CONFIG_DEVEL is not set/d' \
+       -e '/^CONFIG_CCACHE[=_]/d' -e '/^# CONFIG_CCACHE is not set/d' "$config"
+cat >> "$config" <<CONFIG
+CONFIG_DEVEL=y
+CONFIG_CCACHE=y
+CONFIG_CCACHE_DIR="$cache"
+CONFIG
+make -C "$sdk_topdir" defconfig
@@ -0,0 +1,22 @@
+#!/bin/bash
+
+set -e
+
+# Point DL_DIR at the shared download cache (if available) so that
+# sources are only ever fetched once across targets and builds.
+# The setting lives in an include file of its own, rewritten every time
+# (empty when there is no cache), rather than being appended to auto.conf.
+conf_dir="${SDK_TOPDIR:?}/build/conf"
+include="builder_dl_dir.inc"
+cache="${DL_CACHE_DIR:-}"
+mkdir -p "$conf_dir"
+
+if [ -n "$cache" ]; then
+    mkdir -p "$cache"
+    echo "Using download cache $cache"
+    echo "DL_DIR = \"$cache\"" > "$conf_dir/$include"
+else
+    : > "$conf_dir/$include"
+fi
+grep -qxF "include conf/$include" "$conf_dir/auto.conf" 2>/dev/null \
+    || echo "include conf/$include" >> "$conf_dir/auto.conf"
@@ -0,0 +1,29 @@
+#!/bin/bash
+
+set -e
+
+# Build with ccache, using the persistent compiler cache mounted from the
+# host (if any). The settings live in an include file of their own,
+# rewritten every time -- empty when not building with ccache (e.g.
+# --no-ccache), which turns it back off -- rather than being appended to
+# auto.conf.
+conf_dir="${SDK_TOPDIR:?}/build/conf"
+include="builder_ccache.inc"
+cache="${CCACHE_DIR:-}"
+mkdir -p "$conf_dir"
+
+if [ -n "$cache" ]; then
+    echo "Enabling ccache (CCACHE_DIR=$cache, max size ${CCACHE_MAXSIZE:-default})"
+    # one cache for all recipes rather than one per recipe, so that
+    # CCACHE_MAXSIZE bounds the whole of it
+    cat > "$conf_dir/$include" <<CONF
+INHERIT += "ccache"
+CCACHE_TOP_DIR = "$cache"
+CCACHE_DIR = "$cache"
+${CCACHE_MAXSIZE:+export CCACHE_MAXSIZE = \"$CCACHE_MAXSIZE\"}
+CONF
+else
+    : > "$conf_dir/$include"
+fi
+grep -qxF "include conf/$include" "$conf_dir/auto.conf" 2>/dev/null \
+    || echo "include conf/$include" >> "$conf_dir/auto.conf"
@@ -0,0 +1,354 @@
+"""
+Content-addressed store of build artifacts (under out/store).
+
+Every artifact retrieved from a build is stored once, as an object named
+after the sha256 of its contents:
+    objects/<first 2 hex digits>/<sha256>
+and every build gets a manifest listing its files with their hashes, sizes
+and modes, along with the target and sdk it was built for:
+    manifests/<target>/<YYYYmmdd-HHMMSS.mmm>-<pid>.json   (and latest.json)
+so an image or package that did not change since the last build costs no
+more disk space (nor copying) the next time around.
+
+Objects are read-only. The files of the latest build of a target are
+checked out into out/ with the modes they were built with (see checkout()):
+as hard links to the objects if read-only anyway, otherwise as reflinks
+(or copies) that can be changed without touching the store. The
+whole bundle can be exported as a tarball compressed by a multithreaded
+zstd or xz (see export()). Only the last few manifests of each target are
+kept; objects no manifest refers to any longer are removed (see prune()).
+"""
+
+import os
+import time
+import fcntl
+import shutil
+import tarfile
+import hashlib
+import tempfile
+import contextlib
+import subprocess
+import concurrent.futures
+
+import utils
+import artifacts
+
+HASH_BLOCK_SIZE = 1 << 20
+HASH_WORKERS    = 8
+LATEST          = 'latest.json'
+# mode of the objects in the store
+OBJECT_MODE     = 0o444
+
+# --export-artifacts format -> (compressor command, file suffix)
+COMPRESSORS = {
+    'tar' : (None, '.tar'),
+    'zstd': (['zstd', '-T0', '-q', '-c'], '.tar.zst'),
+    'xz'  : (['xz', '-T0', '-c'], '.tar.xz'),
+}
+
+def hash_file(path):
+    """
+    Return the hex sha256 digest of the file at path. Reads with pread(),
+    so any number of threads can hash files at the same time without
+    sharing file offsets (hashlib releases the GIL on big blocks).
+    """
+    h = hashlib.sha256()
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        offset = 0
+        while True:
+            block = os.pread(fd, HASH_BLOCK_SIZE, offset)
+            if not block:
+                break
+            h.update(block)
+            offset += len(block)
+    finally:
+        os.close(fd)
+    return h.hexdigest()
+
+def member_path(name):
+    """
+    The name of a tar member relative to the top-level directory of the
+    archive e.g. './out/package/x.ipk' -> 'package/x.ipk'.
+    """
+    return artifacts.rewrite_prefix(name, '')[2:]
+
+class Artifact_store():
+    """
+    :param root     directory of the store on the host.
+    :param workers  threads hashing files at the same time.
+    """
+    def __init__(self, root, workers=HASH_WORKERS):
+        self.root      = root
+        self.workers   = workers
+        self.objects   = os.path.join(root, 'objects')
+        self.manifests = os.path.join(root, 'manifests')
+        self.tmpdir    = os.path.join(root, 'tmp')
+        self.lockfile  = os.path.join(root, 'lock')
+        # bytes of the files added, and of those that were not stored already
+        self.added  = 0
+        self.stored = 0
+
+    def object_path(self, digest):
+        return os.path.join(self.objects, digest[:2], digest)
+
+    @contextlib.contextmanager
+    def ingesting(self):
+        """
+        Context manager to add objects and the manifest referring to them
+        in: prune() leaves the store alone meanwhile, so it cannot remove
+        objects no manifest refers to *yet*.
+        """
+        os.makedirs(self.tmpdir, exist_ok=True)
+        with open(self.lockfile, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            try:
+                yield self
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _commit(self, tmp, digest, mode):
+        """
+        Move the file tmp into the store as the object digest, unless it is
+        stored already. Return the record of the file.
+        """
+        size = os.path.getsize(tmp)
+        obj = self.object_path(digest)
+        self.added += size
+        if os.path.exists(obj):
+            os.unlink(tmp)
+        else:
+            os.makedirs(os.path.dirname(obj), exist_ok=True)
+            os.chmod(tmp, OBJECT_MODE)
+            os.replace(tmp, obj)
+            self.stored += size
+        return {'sha256': digest, 'size': size, 'mode': mode & 0o7777}
+
+    def add_stream(self, chunks):
+        """
+        Add the files in the tar stream made up of chunks (e.g. as returned
+        by Containers.archive_from_container()). Each file is written out as
+        it comes in and hashed in a worker thread, overlapping with the
+        rest of the transfer.
+        Return {path relative to the top-level directory: record}.
+        """
+        records, pending, links = {}, {}, {}
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+                with tarfile.open(fileobj=artifacts.Chunk_reader(chunks), mode='r|') as src:
+                    for member in src:
+                        rel = member_path(member.name)
+                        if not rel:
+                            continue
+                        if member.isreg():
+                            fd, tmp = tempfile.mkstemp(dir=self.tmpdir)
+                            with os.fdopen(fd, 'wb') as f:
+                                shutil.copyfileobj(src.extractfile(member), f, HASH_BLOCK_SIZE)
+                            pending[rel] = (tmp, member.mode, pool.submit(hash_file, tmp))
+                        elif member.issym():
+                            records[rel] = {'symlink': member.linkname}
+                        elif member.islnk():
+                            links[rel] = member_path(member.linkname)
+                for rel, (tmp, mode, digest) in pending.items():
+                    records[rel] = self._commit(tmp, digest.result(), mode)
+        except BaseException:
+            for tmp, _, _ in pending.values():
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+            raise
+        for rel, target in links.items():
+            if target in records:
+                records[rel] = dict(records[target])
+        return records
+
+    def add_files(self, files):
+        """
+        Add the files on the host in files ({relative path: path}), hashing
+        them in parallel. Files already stored are not copied at all.
+        Return {relative path: record}.
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            digests = dict(zip(files, pool.map(hash_file, files.values())))
+        records = {}
+        for rel, path in files.items():
+            mode = os.stat(path).st_mode
+            if os.path.exists(self.object_path(digests[rel])):
+                self.added += os.path.getsize(path)
+                records[rel] = {'sha256': digests[rel], 'size': os.path.getsize(path), 'mode': mode & 0o7777}
+                continue
+            fd, tmp = tempfile.mkstemp(dir=self.tmpdir)
+            os.close(fd)
+            utils.copy_file(path, tmp, mode='reflink')
+            records[rel] = self._commit(tmp, digests[rel], mode)
+        return records
+
+    def write_manifest(self, target, info, records):
+        """
+        Record a build of target, made up of the files in records (see
+        add_stream() and add_files()), with info (sdk etc) about it.
+        Return the manifest.
+        """
+        now = time.time()
+        manifest = {
+                **info,
+                'target' : target,
+                'id'     : time.strftime('%Y%m%d-%H%M%S', time.localtime(now)) + f'.{int(now * 1000) % 1000:03d}-{os.getpid()}',
+                'created': round(now, 3),
+                'files'  : [{'path': rel, **record} for rel, record in sorted(records.items())],
+                }
+        outdir = os.path.join(self.manifests, target)
+        os.makedirs(outdir, exist_ok=True)
+        utils.dump_json_to_file(os.path.join(outdir, f"{manifest['id']}.json"), manifest)
+        utils.dump_json_to_file(os.path.join(outdir, LATEST), manifest)
+        return manifest
+
+    def load_manifest(self, target, build_id=None):
+        return utils.load_json_from_file(os.path.join(self.manifests, target, f'{build_id}.json' if build_id else LATEST))
+
+    def find_build(self, target, build_fingerprint):
+        """
+        Return the latest manifest of target if it records the build with
+        inputs build_fingerprint (see Sdk.run_step()) and all its files are
+        still stored, else None.
+        """
+        if not build_fingerprint:
+            return None
+        try:
+            manifest = self.load_manifest(target)
+        except (OSError, ValueError):
+            return None
+        if manifest.get('build_fingerprint') != build_fingerprint:
+            return None
+        if any('sha256' in x and not os.path.exists(self.object_path(x['sha256'])) for x in manifest['files']):
+            return None
+        return manifest
+
+    def checkout(self, manifest, dst_dir):
+        """
+        Make dst_dir hold (only) the files of manifest, with their recorded
+        modes. Only files recorded as read-only, like the objects, are hard
+        links to them: anything else (executables included) is reflinked,
+        or copied, so that it can be written to or chmod-ed without
+        changing the object.
+        """
+        shutil.rmtree(dst_dir, ignore_errors=True)
+        for record in manifest['files']:
+            dst = os.path.join(dst_dir, record['path'])
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            if 'symlink' in record:
+                os.symlink(record['symlink'], dst)
+                continue
+            obj = self.object_path(record['sha256'])
+            if record['mode'] == OBJECT_MODE:
+                try:
+                    os.link(obj, dst)
+                    continue
+                except OSError:
+                    pass
+            utils.copy_file(obj, dst, mode='reflink')
+            os.chmod(dst, record['mode'])
+        return dst_dir
+
+    def _write_tar(self, manifest, fileobj, arcroot):
+        with tarfile.open(fileobj=fileobj, mode='w|') as tar:
+            top = tarfile.TarInfo(f'./{arcroot}')
+            top.type, top.mode, top.mtime = tarfile.DIRTYPE, 0o755, manifest['created']
+            tar.addfile(top)
+            dirs = set()
+            for record in manifest['files']:
+                # parent directories first, as tar expects
+                parts = record['path'].split('/')[:-1]
+                for i in range(1, len(parts) + 1):
+                    d = '/'.join(parts[:i])
+                    if d not in dirs:
+                        dirs.add(d)
+                        info = tarfile.TarInfo(f'./{arcroot}/{d}')
+                        info.type, info.mode, info.mtime = tarfile.DIRTYPE, 0o755, manifest['created']
+                        tar.addfile(info)
+                info = tarfile.TarInfo(f"./{arcroot}/{record['path']}")
+                info.mtime = manifest['created']
+                if 'symlink' in record:
+                    info.type, info.linkname = tarfile.SYMTYPE, record['symlink']
+                    tar.addfile(info)
+                    continue
+                info.size, info.mode = record['size'], record['mode']
+                with open(self.object_path(record['sha256']), 'rb') as f:
+                    tar.addfile(info, f)
+
+    def export(self, manifest, outpath, fmt, arcroot):
+        """
+        Write the files of manifest, under arcroot, to a tarball at
+        outpath + the suffix of fmt (see COMPRESSORS), compressed with all
+        cores. The tarball only replaces any existing file once complete.
+        Return its path.
+        """
+        cmd, suffix = COMPRESSORS[fmt]
+        outpath += suffix
+        partial = outpath + '.part'
+        try:
+            with open(partial, 'wb') as out:
+                if not cmd:
+                    self._write_tar(manifest, out, arcroot)
+                else:
+                    try:
+                        proc = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=out)
+                    except FileNotFoundError:
+                        raise FileNotFoundError(f"'{cmd[0]}' is needed to export artifacts as {fmt}: not found")
+                    try:
+                        self._write_tar(manifest, proc.stdin, arcroot)
+                    finally:
+                        proc.stdin.close()
+                        if proc.wait():
+                            raise subprocess.CalledProcessError(proc.returncode, cmd)
+        except BaseException:
+            if os.path.exists(partial):
+                os.remove(partial)
+            raise
+        os.replace(partial, outpath)
+        return outpath
+
+    def prune(self, keep):
+        """
+        Remove all but the keep most recent manifests of each target, then
+        the objects no manifest refers to. Does nothing if the store is
+        being added to (see ingesting()).
+        Return (manifests removed, objects removed, bytes freed), or None if
+        the store was busy.
+        """
+        if not os.path.isdir(self.root):
+            return 0, 0, 0
+        with open(self.lockfile, 'a') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            try:
+                return self._prune(keep)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _prune(self, keep):
+        manifests = 0
+        referenced = set()
+        for target in os.listdir(self.manifests) if os.path.isdir(self.manifests) else []:
+            tgdir = os.path.join(self.manifests, target)
+            builds = sorted(x for x in os.listdir(tgdir) if x.endswith('.json') and x != LATEST)
+            for name in builds[:-keep] if keep > 0 else builds:
+                os.remove(os.path.join(tgdir, name))
+                manifests += 1
+            for name in os.listdir(tgdir):
+                if name.endswith('.json'):
+                    manifest = utils.load_json_from_file(os.path.join(tgdir, name))
+                    referenced.update(x['sha256'] for x in manifest['files'] if 'sha256' in x)
+
+        objects, freed = 0, 0
+        for dirpath, _, names in os.walk(self.objects):
+            for name in names:
+                if name not in referenced:
+                    path = os.path.join(dirpath, name)
+                    freed += os.path.getsize(path)
+                    os.remove(path)
+                    objects += 1
+        # leftovers of interrupted additions
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+        return manifests, objects, freed
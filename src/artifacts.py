@@ -0,0 +1,167 @@
+"""
+Collection of build artifacts, and reading the tar streams they are
+retrieved from containers in (see artifact_store.py for what becomes of them).
+"""
+
+import io
+import os
+import re
+import string
+import fnmatch
+import concurrent.futures
+
+import utils
+
+COPY_WORKERS = 8
+
+class Chunk_reader(io.RawIOBase):
+    """
+    Read-only, non-seekable file object over an iterable of bytes chunks
+    (e.g. the stream returned by the container engine when copying files
+    out of a container). Only one chunk is held in memory at any time.
+    """
+    def __init__(self, chunks):
+        self.chunks  = iter(chunks)
+        self.pending = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while not len(self.pending):
+            try:
+                self.pending = memoryview(next(self.chunks))
+            except StopIteration:
+                return 0
+        n = min(len(buf), len(self.pending))
+        buf[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
+
+def rewrite_prefix(name, prefix):
+    """
+    Replace the first path component of the archive member name with
+    prefix and root the result at './'. E.g. ('out/a/b', 'artifacts')
+    -> './artifacts/a/b'.
+    """
+    parts = [x for x in name.split('/') if x and x != '.']
+    prefix = [x for x in prefix.split('/') if x and x != '.']
+    return '/'.join(['.'] + prefix + parts[1:])
+
+def index_tree(root):
+    """
+    Walk the tree under root once and return a dict mapping the relative
+    path of every regular file to its (size, mtime, inode) triple.
+    This serves both as the index artifact patterns are matched against
+    and as a snapshot to tell what a build has produced. A root that does
+    not exist yields an empty index.
+    """
+    index = {}
+    stack = ['']
+    while stack:
+        reldir = stack.pop()
+        try:
+            it = os.scandir(os.path.join(root, reldir))
+        except FileNotFoundError:
+            continue
+        with it:
+            for entry in it:
+                rel = os.path.join(reldir, entry.name)
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(rel)
+                elif entry.is_file():
+                    st = entry.stat()
+                    index[rel] = (st.st_size, st.st_mtime_ns, st.st_ino)
+    return index
+
+def changed_since(after, before):
+    """
+    The subset of the index after with the files that are not in before
+    or that have been modified since.
+    """
+    return {k: v for k, v in after.items() if before.get(k) != v}
+
+def expand_patterns(patterns, env):
+    """
+    Substitute $VAR/${VAR} references in patterns with their values in env.
+    :raises KeyError if a pattern references a variable not in env.
+    """
+    return [string.Template(x).substitute(env) for x in patterns]
+
+def compile_patterns(patterns):
+    """
+    Combine shell-style patterns into a single case-insensitive regex
+    (find -iname semantics) so each file name is only matched once.
+    """
+    return re.compile('|'.join(f'(?:{fnmatch.translate(x)})' for x in patterns), re.IGNORECASE)
+
+def match(index, patterns):
+    """
+    Return the sorted relative paths in index whose base name matches any
+    of patterns.
+    """
+    regex = compile_patterns(patterns)
+    return sorted(x for x in index if regex.match(os.path.basename(x)))
+
+def _collect_one(src, dst, link):
+    if link:
+        try:
+            if os.path.lexists(dst):
+                os.unlink(dst)
+            os.link(src, dst)
+            return dst
+        except OSError:
+            pass
+    return utils.copy_file(src, dst)
+
+def collect(root, paths, outdir, workers=COPY_WORKERS):
+    """
+    Copy the files at the given relative paths under root into outdir,
+    flattening the directory structure (as 'find ... -exec cp {} outdir'
+    does). The copies are made in parallel; when root and outdir are on the
+    same filesystem the files are hardlinked instead of copied.
+
+    :return   the list of paths written in outdir.
+    """
+    os.makedirs(outdir, exist_ok=True)
+    link = os.stat(root).st_dev == os.stat(outdir).st_dev
+
+    jobs = {}
+    for rel in paths:
+        dst = os.path.join(outdir, os.path.basename(rel))
+        if dst in jobs:
+            utils.log(f" ! Artifact '{rel}' overrides '{jobs[dst]}' (same name)")
+        jobs[dst] = rel
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_collect_one, os.path.join(root, rel), dst, link)
+                   for dst, rel in jobs.items()]
+        return [f.result() for f in futures]
+
+class Collector():
+    """
+    Collects the artifacts a build produces: take a snapshot of the search
+    root before the build and call collect() after it. If only_new is
+    True, only the files that are new or modified in between are
+    considered -- not those an incremental build had no need to rewrite.
+    The whole root is walked just once per snapshot no matter how many
+    patterns there are.
+    """
+    def __init__(self, root, patterns, only_new=False):
+        self.root     = root
+        self.patterns = patterns
+        self.only_new = only_new
+        self.before   = {}
+
+    def snapshot(self):
+        if self.only_new:
+            self.before = index_tree(self.root)
+
+    def collect(self, outdir):
+        index = changed_since(index_tree(self.root), self.before)
+        found = match(index, self.patterns)
+        utils.log(f" ~ {len(found)} artifact(s) found among {len(index)} "
+                  f"{'new or modified ' if self.only_new else ''}file(s) in {self.root}")
+        for rel in found:
+            utils.log(f"   {rel}")
+        return collect(self.root, found, outdir)
@@ -0,0 +1,137 @@
+#!/usr/bin/python3
+
+"""
+Micro-benchmarks for parts of the builder that sit on hot paths.
+
+Run as:
+    python3 src/benchmark.py logging [--lines N] [--stdout]
+    python3 src/benchmark.py startup [--runs N] [--mode MODE ...]
+"""
+
+import os
+import re
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import utils
+
+# a line of 'make V=sc' output, with the odd colored one
+SAMPLE_LINES = [
+    "make[3]: Entering directory '/home/dev/OpenWrt_openwrt-22.03/build_dir/target-x86_64_musl/busybox-1.35.0'",
+    "x86_64-openwrt-linux-musl-gcc -Os -pipe -fno-caller-saves -fno-plt -fhonour-copts -c -o libbb/xfuncs.o libbb/xfuncs.c",
+    "\x1b[1;32m  CC      libbb/xfuncs_printf.o\x1b[0m",
+]
+
+def legacy_log(msg, tostdout, logfile):
+    """
+    utils.log() as it was before the log writer thread: the SGR pattern
+    is compiled (or looked up in re's cache) on every call and the log
+    file opened and closed for every line.
+    """
+    pattern = r'(?:\x1B[@-Z\\-_]|[\x80-\x9A\x9C-\x9F]|(?:\x1B\[|\x9B)[0-?]*[ -/]*[@-~])'
+    msg = re.sub(pattern, '', msg)
+    msg = utils.strip_quoted_newlines(msg)
+    if tostdout:
+        print(msg, flush=True)
+    with open(logfile, "a") as f:
+        f.write(msg + '\n')
+
+def run_logging(lines, tostdout):
+    """
+    Time logging lines lines with the legacy and the current utils.log(),
+    to a log file (and stdout, if tostdout). Return {name: lines per second}.
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as tmpdir:
+        logfile = os.path.join(tmpdir, 'legacy.log')
+        start = time.perf_counter()
+        for i in range(lines):
+            legacy_log(SAMPLE_LINES[i % len(SAMPLE_LINES)], tostdout, logfile)
+        results['legacy'] = lines / (time.perf_counter() - start)
+
+        utils.set_logging(tostdout=tostdout, tofile=True, logfile=os.path.join(tmpdir, 'build.log'))
+        start = time.perf_counter()
+        for i in range(lines):
+            utils.log(SAMPLE_LINES[i % len(SAMPLE_LINES)])
+        # the lines only count once they are written out
+        utils.flush_log()
+        results['current'] = lines / (time.perf_counter() - start)
+        utils.set_logging()
+    return results
+
+# builder.py command lines that do not build anything, by name; {tmpdir}
+# is replaced with a scratch directory
+STARTUP_MODES = {
+    'skip-all'    : ['--skip-all'],
+    'list-targets': ['--list-targets'],
+    'treegen'     : ['treegen', '--target', 'benchmark', '{tmpdir}'],
+    'help'        : ['--help'],
+    'validate'    : ['--validate'],
+}
+
+def run_startup(runs, modes):
+    """
+    Time runs runs of builder.py in each of modes (see STARTUP_MODES), as
+    separate processes, like the image build runs it for --skip-all.
+    Return {mode: (fastest, median) wall time in seconds}.
+    """
+    builder = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'builder.py')
+    results = {}
+    for mode in modes:
+        times = []
+        for _ in range(runs):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                cmd = [sys.executable, builder] + [x.format(tmpdir=tmpdir) for x in STARTUP_MODES[mode]]
+                start = time.perf_counter()
+                subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                times.append(time.perf_counter() - start)
+        results[mode] = (min(times), statistics.median(times))
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Builder micro-benchmarks')
+    subparsers = parser.add_subparsers(dest='benchmark', required=True)
+
+    logging_cmd = subparsers.add_parser('logging', help='Throughput of utils.log()')
+    logging_cmd.add_argument('--lines',
+                             type=int,
+                             default=200000,
+                             help='Number of lines to log'
+                             )
+    logging_cmd.add_argument('--stdout',
+                             action='store_true',
+                             help='Log to stdout as well as to the log file (redirect it to /dev/null)'
+                             )
+
+    startup_cmd = subparsers.add_parser('startup', help='Startup time of builder.py in modes that do not build')
+    startup_cmd.add_argument('--runs',
+                             type=int,
+                             default=10,
+                             help='Number of times to run each mode'
+                             )
+    startup_cmd.add_argument('--mode',
+                             action='append',
+                             dest='modes',
+                             choices=list(STARTUP_MODES),
+                             help='Mode to time (repeatable). Default: all of them'
+                             )
+    args = parser.parse_args()
+
+    if args.benchmark == 'logging':
+        results = run_logging(args.lines, args.stdout)
+        for name, rate in results.items():
+            print(f"{name:>8}: {rate:12,.0f} lines/s", file=sys.stderr)
+        print(f" speedup: {results['current'] / results['legacy']:.1f}x", file=sys.stderr)
+    elif args.benchmark == 'startup':
+        results = run_startup(args.runs, args.modes or list(STARTUP_MODES))
+        for mode, (fastest, median) in results.items():
+            print(f"{mode:>12}: {fastest * 1000:8.1f} ms fastest, {median * 1000:8.1f} ms median", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -5,22 +5,53 @@ Copyright (c) 2025, dcrisn -- d.crisn@outlook.com
 """
 
 import argparse
+import atexit
 import os
 import sys
 import shutil
 from pathlib import Path
-import json
+
+# the automated image build runs the builder with this flag only to have
+# it do nothing (see sdk.build_container_image()): do that before importing
+# anything else. Other modes only import what they need as they go.
+if '--skip-all' in sys.argv[1:]:
+    print(f" ** Invocation: {sys.argv}", flush=True)
+    print("MAGIC_CLI_SHORT_CIRCUIT_FLAG passed, exiting ok")
+    sys.exit(0)
 
 import utils
-import containers
-import sdk
 import settings
 import constants
-
-def clean_up_paths(paths):
+import resources
+import multibuild
+import profiler
+import validation
+import overlay
+import registry
+
+def clean_up_paths(paths, keep=()):
+    """
+    Empty (creating them if need be) the directories in paths, except for
+    whatever is at the paths in keep under them (e.g. the artifact store
+    under out/).
+    """
+    keep = [os.path.abspath(x) for x in keep]
     for path in paths:
-        shutil.rmtree(path, ignore_errors=True)
-        os.makedirs(path)
+        path = os.path.abspath(path)
+        if not any(x.startswith(path + os.sep) for x in keep):
+            shutil.rmtree(path, ignore_errors=True)
+            os.makedirs(path)
+            continue
+        for name in os.listdir(path):
+            child = os.path.join(path, name)
+            if child in keep:
+                continue
+            if os.path.isdir(child) and not os.path.islink(child):
+                clean_up_paths([child], keep)
+                if not os.listdir(child):
+                    os.rmdir(child)
+            else:
+                os.unlink(child)
 
 def normalize_extra_target_paths(extra_target_paths):
     """The --target-tree option points either to a directory that
@@ -29,25 +60,14 @@ def normalize_extra_target_paths(extra_target_paths):
     This function normalizes such a list of directories and returns
     a list of target directories only (ie a list of directories where
     each directory contains a spec.json file)"""
+    index = registry.get_index()
     paths = []
     for path in extra_target_paths:
-        if not os.path.isdir(path):
-            continue
-
-        # if target dir
-        basename = os.path.basename(path)
-        specfile = f'{path}/{basename}_spec.json'
-        if os.path.exists(specfile) and os.path.isfile(specfile):
+        # if target dir, else see if directory of target dirs
+        if index.is_target_dir(path):
             paths.append(path)
-            continue
-
-        # else see if directory of target dirs
-        dirs = [x for x in os.listdir(path) if os.path.isdir(f'{path}/{x}')]
-        for x in dirs:
-            d = f'{path}/{x}'
-            specfile = f'{d}/{x}_spec.json'
-            if os.path.exists(specfile) and os.path.isfile(specfile):
-                paths.append(d)
+        else:
+            paths += index.targets_in(path)
     return paths
 
 def normalize_extra_buildspec_file_paths(extra_buildspec_file_paths):
@@ -68,12 +88,7 @@ def normalize_extra_buildspec_file_paths(extra_buildspec_file_paths):
             continue
 
         # directory path
-        elif os.path.isdir(path):
-            for x in os.listdir(path):
-                x = f"{path}/{x}"
-                if os.path.isfile(x):
-                    if x.endswith(suffix):
-                        paths.append(x)
+        paths += registry.get_index().buildspecs_in(path)
     return paths
 
 def extra_targets_from_devconfig(developer_config):
@@ -105,48 +120,18 @@ def extra_buildspecs_from_devconfig(developer_config):
     normalized = normalize_extra_buildspec_file_paths(paths)
     return paths,normalized
 
-def install_tmp_specs_overlay(pathmap, extra_target_paths,
-                              extra_container_image_buildspec_file_paths):
-    """Cp the specs directory to a temporary directory, and then copy each
-    path in extra_target_paths (which must have been normalized via
-    normalize_extra_target_paths()), recursively, into the tgroot under specs."""
-    host = pathmap.clone(context='host')
-    tmp = pathmap.clone(context='tmp')
-    utils.cp_dir(host.specs, tmp.specs, empty_first=True, just_contents=True)
-    for path in extra_target_paths:
-        basename = os.path.basename(path)
-        dstdir = f'{tmp.tgroot}/{basename}'
-        utils.cp_dir(path, dstdir,  empty_first=True, just_contents=True)
-
-    buildspec_dir = f'{tmp.buildspecs}'
-    for path in extra_container_image_buildspec_file_paths:
-        utils.cp_file(path, buildspec_dir, must_exist=True, make_dirs=True)
-
-    # patch the targets.json enum to contain all the known and discovered
-    # targets, both in-tree and out-of-tree ones.
-    targets_enum_schema_file = f'{tmp.schemas}/enum/targets.json' 
-    with open(targets_enum_schema_file, 'r+') as f:
-        j = json.load(f)
-        j['enum'] = [os.path.basename(x) for x in targets_from_tgroot(tmp.tgroot)]
-        f.truncate(0)
-        f.seek(0)
-        json.dump(j, f, indent=5)
-
-    # patch the container_image_buildspec_files.json enum to contain all the
-    # known and discovered files, both in-tree and out-of-tree ones.
-    container_image_buildspec_files_enum_schema_file = \
-            f'{tmp.schemas}/enum/container_image_buildspec_files.json' 
-    suffix = constants.BUILDSPEC_SUFFIX
-    with open(container_image_buildspec_files_enum_schema_file, 'r+') as f:
-        j = json.load(f)
-        files = [x for x in os.listdir(buildspec_dir) if x.endswith(suffix)]
-        j['enum'] = files
-        f.truncate(0)
-        f.seek(0)
-        json.dump(j, f, indent=5)
+def load_specs_overlay(pathmap, extra_target_paths,
+                       extra_container_image_buildspec_file_paths):
+    """Return the spec overlay (see overlay.py) of the in-tree specs and the
+    out-of-tree targets and buildspecs (which must have been normalized via
+    normalize_extra_target_paths() etc), and have the validator use its
+    patched schemas."""
+    specs_overlay = overlay.Spec_overlay(pathmap, extra_target_paths, extra_container_image_buildspec_file_paths)
+    validation.override_schemas(specs_overlay.schemas_dir, specs_overlay.schemas)
+    return specs_overlay
 
 def targets_from_tgroot(tgroot):
-    return [f'{tgroot}/{x}' for x in os.listdir(tgroot) if os.path.exists(f'{tgroot}/{x}/{x}_spec.json')]
+    return registry.get_index().targets_in(tgroot)
 
 def load_known_targets(tgroot, extra_targets):
     """
@@ -175,47 +160,130 @@ def print_known_targets(tgroot, extra_targets):
 def is_known_target(target, extra_targets):
     return bool(load_known_targets(tgroot, extra_targets).get(target))
 
-def validate_json_files(specs_path : str, ignore_missing_specs):
-    schemas_dir = f"{specs_path}/json_schema/"
-    tgroot = f"{specs_path}/targets/"
-    paths = {
-            "steps" : f"{specs_path}/steps/",
-            "common" : f"{tgroot}/common/specs/",
-            }
-
-    for key,path in paths.items():
-        print(f"Validating {key} specs ...")
-        for file in os.listdir(path):
-            subject = path + file
-            utils.validate_json_against_schema(subject, schemas_dir)
-            print(f" # {subject} : valid.")
-
-    print("Validating target specs ...")
-    for directory in os.listdir(tgroot):
-        if not os.path.isdir(f'{tgroot}/{directory}'): continue
-        if directory != "common":
-            tgspec = f"{directory}_spec.json"
-            subject = tgroot + directory + "/" + tgspec
-            if not os.path.isfile(subject):
-                print(f"Target {directory} missing '{tgspec}'")
-                if not ignore_missing_specs:
-                    raise FileNotFoundError
-            else:
-                utils.validate_json_against_schema(subject, schemas_dir)
-                print(f" # {subject} : valid.")
+def validate_json_files(specs_overlay, ignore_missing_specs):
+    """
+    Validate all the json files in the spec overlay (and the developer
+    config, if any), in parallel.
+    """
+    subjects = []
+    common_specs = specs_overlay.resolve(f'{specs_overlay.tgroot}/common/specs')
+    for path in (specs_overlay.resolve(paths.steps_dir), common_specs):
+        subjects += [f'{path}/{file}' for file in sorted(os.listdir(path))]
+
+    for directory in registry.get_index().listing(specs_overlay.tgroot)[0]:
+        if directory != "common" and directory not in specs_overlay.targets:
+            print(f"Target {directory} missing '{directory}_spec.json'")
+            if not ignore_missing_specs:
+                raise FileNotFoundError
+    subjects += [specs_overlay.tgspec(x) for x in specs_overlay.targets]
 
     if developer_config:
-        print(f"Validating {developer_config} ...")
-        subject = developer_config
-        utils.validate_json_against_schema(subject, schemas_dir)
-        print(f" # {subject} : valid.")
+        subjects.append(developer_config)
+
+    print(f"Validating {len(subjects)} json files ...")
+    results = validation.validate_files(subjects, specs_overlay.schemas_dir, resources.available_cores())
+    for subject, error in results.items():
+        print(f" # {subject} : {'valid.' if not error else 'INVALID: ' + error}")
+    invalid = [x for x, error in results.items() if error]
+    if invalid:
+        raise ValueError(f"{len(invalid)} invalid json file(s): {invalid}")
+
+def validate_build_specs(specs_overlay, targets):
+    """
+    Validate the developer config (if any), the spec of each target in
+    targets and the build steps against their schemas in the spec overlay.
+    Return a (steps, {target: spec}) tuple.
+    """
+    schemas = specs_overlay.schemas_dir
+
+    try:
+        # we validate and load this config first as it may list out-of-tree
+        # targets and in that case case _those_ must also be loaded before
+        # validating the target etc.
+        if developer_config:
+            utils.log(f" > Validating {developer_config} against schema ...")
+            validation.validate(developer_config, schemas)
+
+        specs = {}
+        for target in targets:
+            tgspec_file = specs_overlay.tgspec(target)
+            utils.log(f" > Validating {tgspec_file} against schema ...")
+            specs[target] = validation.validate(tgspec_file, schemas)
+
+        steps_file = specs_overlay.resolve(paths.dev_build_steps if args.devbuild else paths.automated_build_steps)
+        utils.log(f" > Validating {steps_file} against schema ...")
+        steps = validation.validate(steps_file, schemas)
+    finally:
+        # the files found valid so far, even if one was not
+        validation.save_verdicts()
+    return steps, specs
+
+def build_multiple_targets(targets):
+    """
+    Build all targets concurrently, in separate builder processes (see
+    multibuild.py). The setup shared by all targets is done here, once.
+    The cores specified with --cores (or else all available cores) are
+    divided between the targets.
+    Return the exit code for this process.
+    """
+    paths_to_clean = [paths.tmpdir, paths.outdir]
+    clean_up_paths(paths_to_clean, keep=[paths.get('host', 'artifact_store')])
+    utils.log(f" > Cleaning up {paths_to_clean}")
+    specs_overlay = load_specs_overlay(paths, extra_targets, extra_buildspec_files)
+    steps, specs = validate_build_specs(specs_overlay, targets)
+
+    jobs = []
+    for target in targets:
+        spec = specs[target]
+        # dev builds use an sdk checkout on the host, shared by all the
+        # targets using the same sdk: those cannot be built at the same time,
+        # unless each target gets its own worktree.
+        exclusive = None
+        if sdk_build_type == 'dev' and not args.worktree:
+            exclusive = f"{spec['sdk_name']}_{spec['sdk_tag']}"
+        jobs.append(multibuild.Job(target, exclusive))
+
+    argv  = sys.argv[1:]
+    auto  = auto_cores()
+    cores = resources.available_cores() if auto or not num_build_cores else int(num_build_cores)
+    # the load average is system-wide, so all the targets get the same cap
+    if auto and not load_limit:
+        argv.append(f'--load-limit={cores}')
+    return multibuild.run(os.path.abspath(__file__), argv, jobs, cores,
+                          resources.available_memory(), args.memory_per_job)
+
+def auto_cores():
+    """
+    True if the parallelism of the build is to be worked out from the
+    resources available (see resources.auto_parallelism()).
+    """
+    return str(num_build_cores or constants.DEFAULT_NUM_BUILD_CORES) == 'auto'
 
 def dispatch_tasks(tasks, context):
-    for task in tasks:
-        task,ctx = task.popitem()
-        if ctx == context:
-            utils.log(f" > Step: {task} [{context}]")
-            sdk.execute_task(task)
+    """
+    Run the steps to be carried out in context, concurrently where their
+    dependencies allow it (see executor.py).
+    """
+    import executor
+    graph = executor.plan(tasks, context)
+    utils.log(f" ** step dependencies [{context}]: {graph}")
+    fingerprints = {}
+
+    def run_step(task):
+        utils.log(f" > Step: {task} [{context}]")
+        upstream = {x: fingerprints.get(x) for x in graph[task]}
+        with profiler.span(task, 'step', context=context):
+            fingerprints[task] = sdk.run_step(task, upstream)
+        utils.log(f" > Step done: {task} [{context}]")
+
+    executor.run(graph, run_step)
+
+def write_profile_report():
+    # paths is whatever the build ended up using (i.e. per target)
+    trace, summary = profiler.write_report(paths.outdir)
+    with open(summary, 'r') as f:
+        utils.log_lines(f.read().splitlines())
+    utils.log(f" ** profile written to {trace} and {summary}")
 
 def load_env_defaults():
     j = utils.load_json_from_file(env_defaults_file)
@@ -292,6 +360,12 @@ def sanitize_cli(argv):
     if argv.verbose and argv.quiet:
         print("Nonsensical argument combination of '--verbose' and '--quiet'")
         unsane=True
+    if argv.worktree and not argv.devbuild:
+        print("'--worktree' only applies to dev builds ('-d')")
+        unsane=True
+    if argv.num_build_cores and argv.num_build_cores != 'auto' and not argv.num_build_cores.isdigit():
+        print(f"Invalid number of cores: '{argv.num_build_cores}'")
+        unsane=True
     if unsane:
         raise ValueError("Invalid command line")
 
@@ -305,11 +379,27 @@ parser.add_argument('-d',
                              Useful for 'dev' containers"
                      )
 
+parser.add_argument('--worktree',
+                     action='store_true',
+                     dest='worktree',
+                     help="With -d, check out the sdk as a git worktree of its own for each target, \
+                             all sharing the objects of the sdk's local mirror, rather than as \
+                             a single clone shared by all the targets using the same sdk. \
+                             Lets targets using the same sdk be built side by side."
+                     )
+
 parser.add_argument('-t',
                      '--target',
                      metavar='PLATFORM',
-                     dest='target',
-                     help='Target platform to build for'
+                     action='append',
+                     dest='targets',
+                     help='Target platform to build for. Can be repeated to build multiple targets concurrently'
+                     )
+
+parser.add_argument('--all-targets',
+                     action='store_true',
+                     dest='all_targets',
+                     help='Build all known targets concurrently'
                      )
 
 parser.add_argument('--target-tree',
@@ -346,6 +436,67 @@ parser.add_argument('--clean',
                      help='Start clean'
                      )
 
+parser.add_argument('--force-step',
+                     metavar='STEP',
+                     action='append',
+                     dest='force_steps',
+                     help="Run STEP even if its inputs are unchanged since it last succeeded. \
+                             Can be repeated; 'all' forces every step. --clean implies this for all steps."
+                     )
+
+parser.add_argument('--dl-cache-budget',
+                     metavar='SIZE',
+                     type=utils.parse_size,
+                     dest='dl_cache_budget',
+                     help=f"Disk budget of the shared source download cache of each sdk (e.g. 20G). \
+                             Least recently used downloads are evicted beyond it. \
+                             Default: {constants.DL_CACHE_BUDGET >> 30}G."
+                     )
+
+parser.add_argument('--export-artifacts',
+                     choices=['tar', 'zstd', 'xz'],
+                     dest='export_artifacts',
+                     default='tar',
+                     help="Besides adding the build artifacts to the artifact store (out/store) \
+                             and checking them out in out/<archive name>/, bundle them in \
+                             out/<archive name>.tar[.zst|.xz], compressed using all cores. \
+                             Default: tar (uncompressed)."
+                     )
+
+parser.add_argument('--no-ccache',
+                     action='store_true',
+                     dest='no_ccache',
+                     help="Do not use the persistent compiler cache dev builds otherwise use (see src/ccache.py)."
+                     )
+
+parser.add_argument('--ccache-budget',
+                     metavar='SIZE',
+                     type=utils.parse_size,
+                     dest='ccache_budget',
+                     help=f"Size limit of the compiler cache of each sdk (e.g. 10G). \
+                             Default: {constants.CCACHE_BUDGET >> 30}G."
+                     )
+
+parser.add_argument('--profile',
+                     action='store_true',
+                     dest='profile',
+                     help=f"Record the wall time, CPU time and exit status of every step, stage, \
+                             script, hook and container operation of the build, and write them \
+                             to {profiler.TRACE_FILE} (Chrome trace format) and {profiler.SUMMARY_FILE} \
+                             in the output directory."
+                     )
+
+parser.add_argument('--sample-interval',
+                     metavar='SECONDS',
+                     type=float,
+                     dest='sample_interval',
+                     default=constants.STATS_SAMPLE_INTERVAL,
+                     help=f"Seconds between samples of the resource usage (cpu, memory, block I/O, \
+                             processes) of build containers, recorded next to the build log and \
+                             summed up at the end of the build. 0 turns sampling off. \
+                             Default: {constants.STATS_SAMPLE_INTERVAL}."
+                     )
+
 parser.add_argument('--validate',
                      action='store_true',
                      dest='validate_jsons',
@@ -361,7 +512,26 @@ parser.add_argument('--list-targets',
 parser.add_argument("--cores",
                     action='store',
                     dest='num_build_cores',
-                    help='Number of processor cores to use for the build (default=1)'
+                    help=f'Number of processor cores to use for the build, or "auto" to work it out \
+                            from the cpus (cpuset and CPU quota) and memory available (see \
+                            --memory-per-job). Default: {constants.DEFAULT_NUM_BUILD_CORES}'
+                    )
+
+parser.add_argument("--load-limit",
+                    type=float,
+                    dest='load_limit',
+                    help='Load average above which the build should not start new jobs (make -l). \
+                            Default with --cores=auto: the number of cores available; else no limit.'
+                    )
+
+parser.add_argument("--memory-per-job",
+                    metavar='SIZE',
+                    type=utils.parse_size,
+                    dest='memory_per_job',
+                    default=constants.MEMORY_PER_BUILD_JOB,
+                    help=f'Memory each build job (e.g. a compiler instance) is assumed to need, capping \
+                            the number of jobs --cores=auto (or building multiple targets) runs \
+                            at once. Default: {constants.MEMORY_PER_BUILD_JOB >> 20}M.'
                     )
 
 parser.add_argument("--build-firmware",
@@ -400,6 +570,18 @@ parser.add_argument("--devconfig",
                     help='Absolute path to file to use for the developer config rather than the default'
                     )
 
+parser.add_argument("--copy-mode",
+                    action='store',
+                    dest='copy_mode',
+                    choices=utils.COPY_MODES,
+                    default=utils.COPY_MODE,
+                    help="How files are materialized into the staging directory: \
+                            'reflink' shares data with the source where the filesystem supports it, \
+                            'hardlink' hard-links to the source, 'copy' always copies bytes. \
+                            'auto' (default) hard-links read-only files and reflinks the rest, \
+                            falling back to copying where neither is possible."
+                    )
+
 parser.add_argument("--stage",
                     action='store_true',
                     dest='populate_staging',
@@ -447,9 +629,20 @@ parser.add_argument("--skip-all",
                     help=argparse.SUPPRESS
                     )
 
+# hidden option used when building multiple targets: the builder
+# process started for each target is passed this to let it know the
+# shared setup (cleanup, validation etc) has already been done and that
+# it must keep to its own per-target directories. See multibuild.py.
+parser.add_argument(multibuild.WORKER_FLAG,
+                    action='store_true',
+                    dest="worker",
+                    help=argparse.SUPPRESS
+                    )
+
 os.chdir(utils.get_project_root())
 args = parser.parse_args()
 sanitize_cli(args)
+utils.set_copy_mode(args.copy_mode)
 
 if (args.skip_all):
     print("MAGIC_CLI_SHORT_CIRCUIT_FLAG passed, exiting ok")
@@ -461,14 +654,29 @@ build_mode  = not (args.populate_staging or args.container or args.list_targets
 interactive = args.container
 # excessive verbosity is inconvenient by default
 verbose    = not args.quiet and (build_mode or args.verbose)
-utils.set_logging(tostdout=verbose, tofile=not containers.inside_container())
 restricted_build   = args.only_packages or args.only_firmware
 
-paths              = settings.set_paths(args.target)
+target_args        = [x.lower() for x in (args.targets or [])]
+single_target      = target_args[0] if len(target_args) == 1 else None
+paths              = settings.set_paths(single_target, workspace=single_target if args.worker else None)
+utils.set_logging(tostdout=verbose, tofile=not utils.inside_container(), logfile=paths.buildlog if not utils.inside_container() else None)
+if utils.inside_container():
+    # the host asks for it through the environment (see sdk.get_env_vars())
+    profiler.enable_from_env()
+# files found valid before are not validated again; the cache is only
+# available in the container if mounted from the host (see sdk.get_mounts())
+verdicts_dir = paths.get(paths.get_current_context(), 'validation_cache')
+if not utils.inside_container() or os.path.isdir(verdicts_dir):
+    validation.use_verdicts(os.path.join(verdicts_dir, constants.VALIDATION_VERDICTS_FILE))
+# target discovery only lists directories that changed since the last run
+# (see registry.py)
+if not utils.inside_container():
+    registry.use_index(paths.target_index)
 start_clean        = args.clean
 steps_file         = paths.dev_build_steps if args.devbuild else paths.automated_build_steps
 sdk_build_type     = "dev" if args.devbuild else "automated"
 num_build_cores    = args.num_build_cores or None
+load_limit         = args.load_limit
 schemas_dir        = paths.schemas
 steps_dir          = paths.steps_dir
 env_defaults_file  = paths.env_defaults
@@ -498,7 +706,7 @@ if args.command == 'treegen':
     generate_target_tree(args.tree_target, args.path, paths)
     sys.exit(0)
 
-if verbose and not containers.inside_container():
+if verbose and not utils.inside_container():
     print("")
     print(f"{len(extra_targets)} extra targets found after normalization")
     if len(extra_targets_orig) > 0:
@@ -512,50 +720,70 @@ if verbose and not containers.inside_container():
 if args.list_targets:
     print_known_targets(paths.tgroot, extra_targets)
 elif args.validate_jsons:
-    install_tmp_specs_overlay(paths, extra_targets, extra_buildspec_files)
-    validate_json_files(paths.get(context='tmp',label='specs'), ignore_missing_specs=False)
+    validate_json_files(load_specs_overlay(paths, extra_targets, extra_buildspec_files), ignore_missing_specs=False)
 else:
-    target = args.target.lower() if args.target else None
-    if not target:
+    targets = list(load_known_targets(tgroot, extra_targets)) if args.all_targets else target_args
+    targets = list(dict.fromkeys(targets))
+    if not targets:
         print("Mandatory argument not specified: '-t|--target'")
         sys.exit(13)
-    elif not is_known_target(target, extra_targets):
-        print_known_targets(paths.tgroot, extra_targets)
-        raise LookupError(f"Target specified ('{target}') not supported")
-    
+    for target in targets:
+        if not is_known_target(target, extra_targets):
+            print_known_targets(paths.tgroot, extra_targets)
+            raise LookupError(f"Target specified ('{target}') not supported")
+
+    if len(targets) > 1:
+        if interactive:
+            raise ValueError("--container can only be used with a single target")
+        sys.exit(build_multiple_targets(targets))
+    target = targets[0]
+    if target != single_target:
+        paths = settings.set_paths(target)
+
     paths_to_clean = [paths.tmpdir]
     if not interactive:
         paths_to_clean.append(paths.outdir)
-    clean_up_paths(paths_to_clean)
+    clean_up_paths(paths_to_clean, keep=[paths.get('host', 'artifact_store')])
     utils.log(f" > Cleaning up {paths_to_clean}")
+    if args.profile and not utils.inside_container():
+        profiler.enable()
+        atexit.register(write_profile_report)
 
     utils.log(f" ** SDK type:   '{sdk_build_type}'")
     utils.log(f" ** SDK target: '{target}'")
 
-    tmp = paths.clone(context='tmp')
-    tgspec_file = tmp.tgspec
-    steps_file = tmp.dev_build_steps if args.devbuild else tmp.automated_build_steps
-    install_tmp_specs_overlay(paths, extra_targets, extra_buildspec_files)
-
-    # we validate and load this config first as it may list out-of-tree
-    # targets and in that case case _those_ must also be loaded before
-    # validating the target etc.
-    if developer_config:
-        utils.log(f" > Validating {developer_config} against schema ...")
-        utils.validate_json_against_schema(developer_config, tmp.schemas)
-
-    utils.log(f" > Validating {tgspec_file} against schema ...")
-    tgspec = utils.validate_json_against_schema(tgspec_file, tmp.schemas)
-
-    utils.log(f" > Validating {steps_file} against schema ...")
-    steps  = utils.validate_json_against_schema(steps_file, tmp.schemas)
+    specs_overlay = load_specs_overlay(paths, extra_targets, extra_buildspec_files)
+    if args.worker:
+        # the parent has already validated everything
+        tgspec = utils.load_json_from_file(specs_overlay.tgspec(target))
+        steps  = utils.load_json_from_file(specs_overlay.resolve(steps_file))
+    else:
+        steps, specs = validate_build_specs(specs_overlay, [target])
+        tgspec = specs[target]
     
+    if auto_cores():
+        num_build_cores, cores = resources.auto_parallelism(args.memory_per_job)
+        load_limit = load_limit or cores
+        memory = resources.available_memory()
+        utils.log(f" ** --cores=auto: {num_build_cores} job(s), load limit {load_limit:g} "
+                  f"({cores} core(s), {memory >> 20 if memory is not None else '?'} MiB available)")
+
     #
     confvars = {
             'sdk_build_type'    : sdk_build_type,
             'num_build_cores'   : str(num_build_cores) if num_build_cores else str(constants.DEFAULT_NUM_BUILD_CORES),
+            'build_load_limit'  : load_limit,
             'start_clean'       : start_clean,
+            'force_steps'       : args.force_steps or [],
+            'sdk_worktree'      : args.worktree and sdk_build_type == 'dev',
+            'dl_cache_budget'   : args.dl_cache_budget or constants.DL_CACHE_BUDGET,
+            # the cache only persists where it is mounted from the host
+            'ccache'            : sdk_build_type == 'dev' and not args.no_ccache,
+            'ccache_budget'     : args.ccache_budget or constants.CCACHE_BUDGET,
             'verbose'           : verbose,
+            'profile'           : args.profile,
+            'sample_interval'   : args.sample_interval,
+            'export_artifacts'  : args.export_artifacts,
             "build_artifacts_archive_name": tgspec["build_artifacts_archive_name"],
             "container_image_recipe": tgspec['container_image_buildspec_file'],
             "build_user"        : settings.build_user,
@@ -564,9 +792,13 @@ else:
             "env_overrides"     : load_env_overrides(),
             "mount_defaults"    : load_mount_defaults(),
             "mount_overrides"   : load_mount_overrides(),
-            "builder_entrypoint": utils.get_last_path_component(__file__)
+            "builder_entrypoint": utils.get_last_path_component(__file__),
+            "specs_overlay"     : specs_overlay,
             }
 
+    # only imported by the modes that need it, as it brings in the client
+    # library of the container technology, which takes a while to import
+    import sdk
     sdk = sdk.get_sdk_by_name(tgspec['sdk_name'])(tgspec, paths, confvars)
     utils.log(f" ** steps: {steps['steps']}", cond=(build_mode and not restricted_build))
     utils.log(f" ** environment: {sdk.get_env_vars(inherit=False)}")
@@ -0,0 +1,172 @@
+"""
+Minimal parsing of container image buildspec files (Dockerfiles), enough
+to work out what a container image built from one depends on.
+"""
+
+import os
+import re
+import hashlib
+
+import filetree
+
+VARIABLE_REF = re.compile(r'\$\{([A-Za-z_][A-Za-z0-9_]*)\}|\$([A-Za-z_][A-Za-z0-9_]*)')
+
+class Unresolvable(LookupError):
+    pass
+
+def parse_instructions(path):
+    """
+    Return a list of (INSTRUCTION, arguments string) tuples for the
+    buildspec at path, with comments dropped and continuation
+    lines joined.
+    """
+    instructions = []
+    current = ''
+    with open(path, 'r', encoding='utf8') as f:
+        for line in f:
+            stripped = line.strip()
+            if not stripped or stripped.startswith('#'):
+                continue
+            if stripped.endswith('\\'):
+                current += stripped[:-1] + ' '
+                continue
+            current += stripped
+            if current.strip():
+                keyword, _, rest = current.strip().partition(' ')
+                instructions.append((keyword.upper(), rest.strip()))
+            current = ''
+    if current.strip():
+        keyword, _, rest = current.strip().partition(' ')
+        instructions.append((keyword.upper(), rest.strip()))
+    return instructions
+
+def declared_args(instructions):
+    """
+    Return a dict of the build args declared via ARG, mapped to their
+    default value (None if no default is given).
+    """
+    args = {}
+    for keyword, rest in instructions:
+        if keyword != 'ARG':
+            continue
+        name, _, default = rest.partition('=')
+        args[name.strip()] = default.strip().strip('"\'') if default else None
+    return args
+
+def expand(s, variables):
+    def substitute(m):
+        name = m.group(1) or m.group(2)
+        value = variables.get(name)
+        if value is None:
+            raise Unresolvable(f"Unknown variable '{name}' in '{s}'")
+        return value
+    return VARIABLE_REF.sub(substitute, s)
+
+def copy_sources(instructions, build_args):
+    """
+    Return the list of context-relative source paths that ADD and COPY
+    instructions copy into the image.
+
+    :raises Unresolvable   if a source cannot be worked out statically
+                           (e.g. it references an unknown variable).
+    """
+    variables = {}
+    sources = []
+    for keyword, rest in instructions:
+        if keyword == 'ARG':
+            name, _, default = rest.partition('=')
+            name = name.strip()
+            value = build_args.get(name, default.strip().strip('"\'') if default else None)
+            if value is not None:
+                variables[name] = str(value)
+        elif keyword in ('ADD', 'COPY'):
+            if rest.startswith('['):
+                raise Unresolvable(f"Unsupported {keyword} form: '{rest}'")
+            if any(x.startswith('--from') for x in rest.split()):
+                continue
+            tokens = [x for x in rest.split() if not x.startswith('--')]
+            for src in tokens[:-1]:
+                if re.match(r'^[a-z]+://', src):
+                    continue
+                sources.append(os.path.normpath(expand(src, variables)))
+    return sources
+
+def resolve_sources(sources, context_root, context_prefix=''):
+    """
+    Map context-relative source paths to (source, host path) tuples.
+    See fingerprint() for the meaning of the arguments.
+    """
+    prefix = os.path.normpath(context_prefix) if context_prefix else None
+    resolved = []
+    for src in sorted(set(sources)):
+        rel = src
+        if prefix:
+            if rel != prefix and not rel.startswith(prefix + os.sep):
+                raise Unresolvable(f"Source '{src}' is outside the build context")
+            rel = os.path.relpath(rel, prefix)
+        resolved.append((src, os.path.normpath(os.path.join(context_root, rel))))
+    return resolved
+
+def is_bytecode(relpath):
+    """
+    True if relpath is python bytecode (or a directory of it), which
+    follows from the sources and so identifies nothing.
+    """
+    return '__pycache__' in relpath.split(os.sep) or relpath.endswith('.pyc')
+
+def is_excluded(relpath, exclude):
+    return any(relpath == x or relpath.startswith(x + os.sep) for x in exclude)
+
+def fingerprint(recipe, context_root, build_args, context_prefix='', exclude=()):
+    """
+    Return a hex digest identifying the image that would be built from
+    the buildspec at recipe. It covers:
+     - the contents of the buildspec itself
+     - the build args the buildspec actually declares
+     - the contents of every file the buildspec ADDs or COPYs from the
+       build context, python bytecode and anything in exclude aside. If
+       this cannot be worked out statically, the whole context is covered
+       instead.
+
+    :param context_root     directory the context-relative source paths
+                            resolve against.
+    :param context_prefix   leading component of the source paths that
+                            context_root corresponds to, if any (e.g. when
+                            the build context is an archive of context_root
+                            nested under context_prefix).
+    :param exclude          paths relative to context_root (files or
+                            directories) that are known not to make a
+                            difference to the image.
+    """
+    instructions = parse_instructions(recipe)
+    h = hashlib.sha256()
+    h.update(filetree.hash_file(recipe).encode())
+
+    declared = declared_args(instructions)
+    for name in sorted(declared):
+        value = build_args.get(name, declared[name])
+        h.update(f"ARG {name}={value}\n".encode())
+
+    try:
+        sources = resolve_sources(copy_sources(instructions, build_args),
+                                  context_root, context_prefix)
+    except Unresolvable:
+        sources = [('.', context_root)]
+
+    exclude = [os.path.normpath(x) for x in exclude]
+    root = os.path.abspath(context_root)
+    for src, path in sources:
+        h.update(f"SRC {src}\n".encode())
+        if os.path.isfile(path):
+            h.update(f"{filetree.hash_file(path)} {os.stat(path).st_mode:o}\n".encode())
+            continue
+        if not os.path.isdir(path):
+            raise FileNotFoundError(f"No such file or directory in build context: '{src}'")
+        base = os.path.relpath(os.path.abspath(path), root)
+        for relpath, st in filetree.walk_sorted(path):
+            if is_bytecode(relpath) or is_excluded(os.path.normpath(os.path.join(base, relpath)), exclude):
+                continue
+            entry = os.path.join(path, relpath)
+            digest = filetree.hash_file(entry) if os.path.isfile(entry) else '-'
+            h.update(f"{relpath} {st.st_mode:o} {digest}\n".encode())
+    return h.hexdigest()
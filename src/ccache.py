@@ -0,0 +1,107 @@
+"""
+Persistent compiler cache (ccache) for dev builds.
+
+Each sdk (name and tag, hence toolchain) has a ccache directory of its own on
+the host, mounted into the container and handed to the build through the
+CCACHE_* environment variables; the sdk-specific prebuild scripts then turn
+ccache on (CONFIG_CCACHE for OpenWrt, INHERIT += "ccache" for yocto). ccache
+keeps the directory within CCACHE_MAXSIZE by itself.
+
+The statistics of a build are worked out on the host, by reading the
+counters ccache keeps in the cache directory before and after the build,
+so no ccache binary is needed outside the container and the numbers are
+the same whatever the sdk runs ccache as.
+"""
+
+import os
+import contextlib
+
+import utils
+
+# indices of the counters of interest in ccache 'stats' files; these are
+# the same in ccache 3 and 4.
+CACHE_MISS        = 4
+PREPROCESSED_HIT  = 8
+FILES_IN_CACHE    = 11
+CACHE_SIZE_KIB    = 12
+DIRECT_HIT        = 22
+
+def read_counters(cachedir):
+    """
+    Sum the counters of all the stats files in cachedir. ccache spreads
+    them over its subdirectories; the sum is what 'ccache -s' shows.
+    """
+    totals = []
+    for root, _, files in os.walk(cachedir):
+        if 'stats' not in files:
+            continue
+        try:
+            with open(os.path.join(root, 'stats'), 'r') as f:
+                values = [int(x) for x in f.read().split()]
+        except (OSError, ValueError):
+            continue
+        totals += [0] * (len(values) - len(totals))
+        for i, value in enumerate(values):
+            totals[i] += value
+    return totals
+
+def counter(counters, index):
+    return counters[index] if index < len(counters) else 0
+
+class Cache():
+    """
+    :param cachedir  directory of the cache on the host.
+    :param budget    maximum size of the cache, in bytes.
+    """
+    def __init__(self, cachedir, budget):
+        self.cachedir = cachedir
+        self.budget   = budget
+        self.before   = []
+
+    def get_env_vars(self, container_dir, basedir):
+        """
+        Environment for building with the cache mounted at container_dir.
+        :param basedir   directory under which ccache makes paths relative
+                         when hashing, so that e.g. separate checkouts of
+                         the same sdk get the same hits.
+        """
+        return {
+                "CCACHE_DIR": container_dir,
+                # binary units: a bare number means gigabytes to ccache
+                "CCACHE_MAXSIZE": f"{self.budget >> 20}Mi",
+                "CCACHE_BASEDIR": basedir,
+                }
+
+    def snapshot(self):
+        self.before = read_counters(self.cachedir)
+
+    def report(self):
+        """
+        Log the hits and misses of the compilations since snapshot().
+        :return   (hits, misses)
+        """
+        after = read_counters(self.cachedir)
+        delta = lambda i: counter(after, i) - counter(self.before, i)
+        direct, preprocessed, misses = delta(DIRECT_HIT), delta(PREPROCESSED_HIT), delta(CACHE_MISS)
+        hits = direct + preprocessed
+        if hits + misses:
+            rate = f"{100 * hits / (hits + misses):.1f}% hit rate"
+        else:
+            rate = "no cacheable compilations"
+        utils.log(f" > ccache {self.cachedir}: {rate}: {hits} hit(s) ({direct} direct, "
+                  f"{preprocessed} preprocessed), {misses} miss(es); "
+                  f"{counter(after, FILES_IN_CACHE)} files, "
+                  f"{counter(after, CACHE_SIZE_KIB) / (1 << 10):.1f} MiB used of {self.budget >> 20} MiB")
+        return hits, misses
+
+    @contextlib.contextmanager
+    def tracking(self):
+        """
+        Context manager to wrap a build using the cache in: reports its
+        statistics once the build is over, whether or not it succeeded.
+        """
+        self.snapshot()
+        try:
+            yield self
+        finally:
+            self.report()
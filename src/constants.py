@@ -1,2 +1,41 @@
 BUILDSPEC_SUFFIX = '.buildspec'
+# number of cores builds use unless --cores is specified; 'auto' to work
+# it out from the resources available (see resources.auto_parallelism())
 DEFAULT_NUM_BUILD_CORES = 1
+# number of container build contexts kept cached on the host
+BUILD_CONTEXT_CACHE_SIZE = 8
+# top-level directory of the staging tree inside container build contexts
+BUILD_CONTEXT_STAGING_DIR = 'staging'
+# image label holding the fingerprint of the inputs an image was built from
+IMAGE_FINGERPRINT_LABEL = 'builder.fingerprint'
+# number of fingerprint hex digits used in content-addressed image tags
+IMAGE_FINGERPRINT_TAG_LENGTH = 20
+# fewest cores a target gets when building multiple targets concurrently
+MIN_CORES_PER_TARGET = 2
+# rough amount of memory a single build job (e.g. a compiler instance) needs
+MEMORY_PER_BUILD_JOB = 1 << 30
+# steps skipped when their inputs are unchanged since they last succeeded
+STAMPED_STEPS = ['checkout', 'prepare_system', 'install_configs', 'build']
+# environment variables that do not affect the outcome of a step
+STEP_FINGERPRINT_ENV_EXCLUDE = ['NUM_BUILD_CORES', 'PYTHONPATH', 'VERBOSE', 'CCACHE_MAXSIZE', 'BUILDER_PROFILE', 'BUILD_LOAD_LIMIT']
+# directory in the sdk top directory where step stamps are kept when
+# running inside the container
+SDK_STAMPS_DIR = '.builder_stamps'
+# commits of history an sdk is cloned with, unless its target spec says
+# otherwise (see the 'checkout' property); 0 means all of it
+SDK_CLONE_DEPTH = 1
+# seconds to wait for any of the URLs of a repository to answer
+GIT_LS_REMOTE_TIMEOUT = 60
+# default disk budget of the shared source download cache (see dlcache.py)
+DL_CACHE_BUDGET = 50 << 30
+# default size limit of the compiler cache of each sdk (see ccache.py)
+CCACHE_BUDGET = 20 << 30
+# default seconds between samples of the resource usage of build containers
+STATS_SAMPLE_INTERVAL = 5
+# build args that do not change what goes into a container image, and are
+# therefore left out of its fingerprint (see buildspec.fingerprint())
+IMAGE_FINGERPRINT_ARG_EXCLUDE = ['NUM_BUILD_CORES_CLI_FLAG']
+# file in the validation cache directory the verdicts are kept in (see validation.py)
+VALIDATION_VERDICTS_FILE = 'verdicts.json'
+# builds (manifests) of each target kept in the artifact store (see artifact_store.py)
+ARTIFACT_STORE_KEEP = 5
@@ -4,10 +4,12 @@ Abstraction layer for interacting with varying container/jail OS technologies.
 
 from abc import ABC, abstractmethod
 import os
+import time
 
 import docker
 
 import utils
+import profiler
 
 class Container(ABC):
     @abstractmethod
@@ -45,7 +47,61 @@ class Container(ABC):
 
     @abstractmethod
     def logs(self):
-        pass
+        """
+        Stream the output of the container, as batches (lists) of
+        (stream, line) tuples, where stream is 'stdout' or 'stderr'.
+        The next batch is only read once the consumer asks for it.
+        """
+
+    @abstractmethod
+    def stats(self):
+        """
+        Stream samples of the resource usage of the running container, as
+        dicts of:
+            time         when the sample was taken (seconds since the epoch)
+            cpu_ns       CPU time used by the container so far
+            system_ns    CPU time used by the whole system so far, all cpus
+            cpus         number of cpus the container can use
+            memory       memory used, page cache excluded (bytes)
+            memory_limit
+            io_read      bytes read from block devices so far
+            io_write     bytes written to block devices so far
+            pids         number of processes (and threads) in the container
+        """
+
+class Line_assembler():
+    """
+    Split a stream of bytes chunks into lines, whatever the chunk
+    boundaries. Lines are split on raw bytes, which means a multi-byte
+    UTF-8 sequence is never split (no byte of one can be a newline), and
+    all the complete lines in a chunk are decoded in one go; invalid
+    sequences are replaced rather than fatal.
+    """
+    def __init__(self):
+        self.pending = b''
+
+    @staticmethod
+    def decode(data):
+        return data.decode('utf8', errors='replace').replace('\r', '').split('\n')
+
+    def feed(self, chunk):
+        """
+        Return the list of lines completed by chunk.
+        """
+        data = self.pending + chunk
+        end = data.rfind(b'\n')
+        if end < 0:
+            self.pending = data
+            return []
+        self.pending = data[end+1:]
+        return self.decode(data[:end])
+
+    def finish(self):
+        """
+        Return the last line, if the stream did not end with a newline.
+        """
+        data, self.pending = self.pending, b''
+        return self.decode(data) if data else []
 
 class Docker(Container):
     def __init__(self, img, env=None, interactive=False, ephemeral=False):
@@ -92,27 +148,66 @@ class Docker(Container):
             return self.interact(cmd)
         client = self.client
         mounts = self.mounts
-        container = client.containers.run(
-                image=self.image,
-                command=cmd,
-                environment=self.env,
-                mounts = mounts,
-                detach=True,
-                network_mode='host'
-                )
+        with profiler.span('run', 'container', image=self.image, cmd=cmd):
+            container = client.containers.run(
+                    image=self.image,
+                    command=cmd,
+                    environment=self.env,
+                    mounts = mounts,
+                    detach=True,
+                    network_mode='host'
+                    )
         self.container = container
     
     def logs(self):
         if self.interactive:
             raise RuntimeError("Interactive containers do not return logs")
-        logs = self.container.logs(stream=True)
-        for log in logs:
-            yield log.decode('utf8').rstrip()
+        # logs=True: whatever the container output before attaching too
+        chunks = self.container.attach(stdout=True, stderr=True, stream=True, logs=True, demux=True)
+        streams = {'stdout': Line_assembler(), 'stderr': Line_assembler()}
+        # the stream ends when the container exits, so this spans its run
+        with profiler.span('logs', 'container', image=self.image):
+            for chunk in chunks:
+                batch = []
+                for (name, assembler), data in zip(streams.items(), chunk):
+                    if data:
+                        batch += [(name, line) for line in assembler.feed(data)]
+                if batch:
+                    yield batch
+            batch = [(name, line) for name, assembler in streams.items() for line in assembler.finish()]
+            if batch:
+                yield batch
     
+    @staticmethod
+    def io_bytes(blkio_stats, op):
+        entries = (blkio_stats or {}).get('io_service_bytes_recursive') or []
+        return sum(x.get('value', 0) for x in entries if x.get('op', '').lower() == op)
+
+    def stats(self):
+        # the daemon sends a sample about every second until the container exits
+        for raw in self.container.stats(stream=True, decode=True):
+            cpu    = raw.get('cpu_stats') or {}
+            memory = raw.get('memory_stats') or {}
+            # page cache is reclaimable: 'inactive_file' under cgroup v2, 'cache' under v1
+            cache  = (memory.get('stats') or {}).get('inactive_file', (memory.get('stats') or {}).get('cache', 0))
+            yield {
+                    'time'        : time.time(),
+                    'cpu_ns'      : (cpu.get('cpu_usage') or {}).get('total_usage', 0),
+                    'system_ns'   : cpu.get('system_cpu_usage', 0),
+                    'cpus'        : cpu.get('online_cpus') or len((cpu.get('cpu_usage') or {}).get('percpu_usage') or []) or 1,
+                    'memory'      : max(0, memory.get('usage', 0) - cache),
+                    'memory_limit': memory.get('limit', 0),
+                    'io_read'     : self.io_bytes(raw.get('blkio_stats'), 'read'),
+                    'io_write'    : self.io_bytes(raw.get('blkio_stats'), 'write'),
+                    'pids'        : (raw.get('pids_stats') or {}).get('current', 0),
+                    }
+
     def wait(self):
         if self.exited:
             return self.exitcode
-        status = self.container.wait()
+        with profiler.span('wait', 'container', image=self.image) as record:
+            status = self.container.wait()
+            record['status'] = status['StatusCode']
         return (status['StatusCode'])
 
     def id(self):
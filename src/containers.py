@@ -3,11 +3,13 @@ Abstraction layer for interacting with varying container/jail OS technologies.
 """
 
 from abc import ABC, abstractmethod
+import contextlib
 import os
 
 import docker
 
 import container
+import profiler
 
 class Containers(ABC):
     @abstractmethod
@@ -37,12 +39,39 @@ class Containers(ABC):
         Copy a file out of the specified container.
         """
 
+    @abstractmethod
+    def archive_from_img(self, imgid, src):
+        """
+        Like cp_from_img(), but rather than writing it to a file, return
+        an iterator over the chunks of the (tar) archive of src.
+        """
+
+    @abstractmethod
+    def archive_from_container(self, contid, src, remove_container=False):
+        """
+        Like cp_from_container(), but rather than writing it to a file,
+        return an iterator over the chunks of the (tar) archive of src.
+        """
+
+    @abstractmethod
+    def find_image(self, label, value):
+        """
+        Return the id of an image that has the given label set to value,
+        or None if there is no such image.
+        """
+
+    @abstractmethod
+    def tag_image(self, imgid, tag):
+        """
+        Add tag (of the form <repository>:<tag>) to the image with the given id or tag.
+        """
+
     @abstractmethod
     def new_container(self):
         pass
 
     @abstractmethod
-    def build_image(self, start_clean, image_build_topdir, image_recipe, tag=None, **kwargs):
+    def build_image(self, start_clean, build_context, image_recipe, tag=None, labels=None, **kwargs):
         pass
 
 class Docker_containers(Containers):
@@ -84,65 +113,119 @@ class Docker_containers(Containers):
         else:
             return True
 
-    def cp_from_img(self, imgid, src, dst):
+    def archive_from_img(self, imgid, src):
         """
-        Create ephemeral container for copying single file/dir out of image.
+        Create ephemeral container for streaming single file/dir out of image.
+        The container is removed once the stream has been consumed (or
+        the iterator is closed).
         """
         if not self.image_exists(imgid):
             raise docker.errors.ImageNotFound
 
         client = self.api
         container = client.containers.run(command="bash", detach=True, auto_remove=False, image=imgid)
-        bytes_, stats = container.get_archive(src)
-        with open(dst, "wb") as tar:
-            for byte in bytes_:
-                tar.write(byte)
-        container.stop()
-        container.remove(force=True)
-        return bytes_, stats
+        try:
+            with profiler.span('get_archive', 'container', image=imgid, src=src):
+                bytes_, stats = container.get_archive(src)
+                yield from bytes_
+        finally:
+            container.stop()
+            container.remove(force=True)
 
-    def cp_from_container(self, contid, src, dst, remove_container=False):
+    def archive_from_container(self, contid, src, remove_container=False):
         """
-        Copy single file/dir out of existing (running or stopped) container.
+        Stream single file/dir out of existing (running or stopped) container.
         """
         if not self.container_exists(contid):
             raise docker.errors.NotFound
         client = self.api
         container = client.containers.get(contid)
-        bytes_, stats = container.get_archive(src)
+        try:
+            with profiler.span('get_archive', 'container', container=contid, src=src):
+                bytes_, stats = container.get_archive(src)
+                yield from bytes_
+        finally:
+            if remove_container:
+                container.remove(force=True)
+
+    def cp_from_img(self, imgid, src, dst):
+        """
+        Create ephemeral container for copying single file/dir out of image.
+        """
         with open(dst, "wb") as tar:
-            for byte in bytes_:
+            for byte in self.archive_from_img(imgid, src):
                 tar.write(byte)
-        if remove_container:
-            container.remove(force=True)
-        return bytes_, stats
+
+    def cp_from_container(self, contid, src, dst, remove_container=False):
+        """
+        Copy single file/dir out of existing (running or stopped) container.
+        """
+        with open(dst, "wb") as tar:
+            for byte in self.archive_from_container(contid, src, remove_container):
+                tar.write(byte)
+
+    def find_image(self, label, value):
+        client = self.api
+        images = client.images.list(filters={"label": f"{label}={value}"})
+        return images[0].id if images else None
+
+    def tag_image(self, imgid, tag):
+        client = self.api
+        repository, _, tagname = tag.rpartition(':')
+        client.images.get(imgid).tag(repository, tagname)
 
     def new_container(self, *args, **kwargs):
         return container.get(self.tech)(*args, **kwargs)
 
-    def build_image(self, start_clean, image_build_topdir, image_recipe, tag=None, **kwargs):
+    def build_image(self, start_clean, build_context, image_recipe, tag=None, labels=None, **kwargs):
+        """
+        Build an image and yield the lines of output produced by the build.
+
+        :param build_context   either the top directory of the build context,
+                               or the path to a (tar) archive of it.
+        :param image_recipe    path to the Dockerfile. If build_context is an
+                               archive, the path is relative to its root.
+        :param labels          dict of labels to set on the image.
+        """
         uds_uri = 'unix://var/run/docker.sock'
         docker_client = docker.APIClient(base_url=uds_uri)
         nocache = bool(start_clean)
-        stream = docker_client.build(
-            decode=True, # decode the stream to dictionaries on the fly
-            tag = tag,
-            path = image_build_topdir,
-            dockerfile = image_recipe,
-            buildargs = kwargs,
-            nocache=nocache,
-            network_mode='host',
-            rm=True
-            )
-        for chunk in stream:
-            if 'stream' in chunk:
-                line=chunk['stream'].rstrip()
-                if line:
-                    yield line
-            elif 'error' in chunk:
-                error_msg = chunk['error'].strip()
-                print(f"CONTAINER IMAGE BUILD FAILURE: {error_msg}")
-                raise RuntimeError(f"Container image build failure: {error_msg}")
+        with contextlib.ExitStack() as stack:
+            stack.enter_context(profiler.span('image build', 'container', tag=tag))
+            context = {"path": build_context}
+            if os.path.isfile(build_context):
+                # stream the prepared archive as is
+                context = {
+                        "fileobj": stack.enter_context(open(build_context, 'rb')),
+                        "custom_context": True
+                        }
+            stream = docker_client.build(
+                decode=True, # decode the stream to dictionaries on the fly
+                tag = tag,
+                dockerfile = image_recipe,
+                buildargs = kwargs,
+                labels = labels,
+                nocache=nocache,
+                network_mode='host',
+                rm=True,
+                **context
+                )
+            # a long line of output may come in several chunks: only whole
+            # lines are yielded (e.g. profile dumps: see profiler.py)
+            partial = ''
+            for chunk in stream:
+                if 'stream' in chunk:
+                    *lines, partial = (partial + chunk['stream']).split('\n')
+                    for line in lines:
+                        line = line.rstrip()
+                        if line:
+                            yield line
+                elif 'error' in chunk:
+                    error_msg = chunk['error'].strip()
+                    print(f"CONTAINER IMAGE BUILD FAILURE: {error_msg}")
+                    raise RuntimeError(f"Container image build failure: {error_msg}")
+            if partial.rstrip():
+                yield partial.rstrip()
 
 class ImageNotFound(LookupError):
     pass
@@ -151,12 +234,6 @@ class ContainerNotFound(LookupError):
     pass
 
 
-def inside_container():
-    """
-    True if currently running inside a container, else False.
-    """
-    return bool(os.getenv("INSIDE_CONTAINER"))
-
 def get_interface_to(container_tech):
     known_tech = {"docker": Docker_containers}
     interface  = known_tech.get(container_tech)
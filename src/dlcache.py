@@ -0,0 +1,215 @@
+"""
+Shared cache of sdk source downloads (i.e. OpenWrt's dl/, yocto's DL_DIR).
+
+There is one cache per sdk on the host, shared by all the targets and builds
+using the sdk. Dev builds mount it into the container and the stage scripts
+point the sdk at it (through the DL_CACHE_DIR environment variable), so a
+source tarball is only ever downloaded once. Images of automated builds
+cannot mount it (the container engine does not support mounts at image
+build time), so instead whatever they download is harvested from the image
+into the cache once it is built.
+
+The cache is kept within a disk budget by evicting the least recently used
+entries. An entry is a file at the top of the cache, or a child of a
+directory at the top (e.g. yocto's git2/<repository>): either way it is
+evicted as a whole. Entries used by a build are told from the rest by their
+access times, which the cache resets before the build -- for the files read
+since the last reset only, the others needing no reset.
+"""
+
+import os
+import time
+import json
+import shutil
+import tarfile
+import contextlib
+
+import utils
+import artifacts
+
+INDEX = '.index.json'
+
+def list_entries(cachedir):
+    """
+    Return a dict mapping the name (relative path) of each entry of the
+    cache to its absolute path.
+    """
+    entries = {}
+    if not os.path.isdir(cachedir):
+        return entries
+    for top in os.scandir(cachedir):
+        if top.name.startswith('.'):
+            continue
+        if top.is_dir(follow_symlinks=False):
+            for child in os.scandir(top.path):
+                entries[f"{top.name}/{child.name}"] = child.path
+        else:
+            entries[top.name] = top.path
+    return entries
+
+def entry_files(path):
+    if not os.path.isdir(path) or os.path.islink(path):
+        yield path
+        return
+    for root, _, files in os.walk(path):
+        for name in files:
+            yield os.path.join(root, name)
+
+def entry_stats(path):
+    """
+    Return (size, latest access time in ns) for the entry at path.
+    """
+    size, atime = 0, 0
+    for f in entry_files(path):
+        try:
+            st = os.lstat(f)
+        except FileNotFoundError:
+            continue
+        size += st.st_size
+        atime = max(atime, st.st_atime_ns)
+    return size, atime
+
+class Cache():
+    """
+    :param cachedir  directory of the cache on the host.
+    :param budget    maximum size of the cache, in bytes.
+    """
+    def __init__(self, cachedir, budget):
+        self.cachedir = cachedir
+        self.budget   = budget
+        self.lockfile = cachedir.rstrip('/') + '.lock'
+        self.index    = os.path.join(cachedir, INDEX)
+
+    def load_index(self):
+        """
+        The index records when each entry was last used by a build.
+        """
+        try:
+            with open(self.index, 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_index(self, index):
+        with open(self.index + '.tmp', 'w') as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+        os.replace(self.index + '.tmp', self.index)
+
+    def snapshot(self):
+        """
+        Record the entries present before a build. The access times of
+        their files are set back to their modification times, which makes
+        the kernel update them on the next read even on filesystems mounted
+        with relatime. Only files read since (i.e. accessed later than
+        modified) need it: most of the cache is left untouched.
+        """
+        self.start = time.time_ns()
+        self.before = list_entries(self.cachedir)
+        for path in self.before.values():
+            for f in entry_files(path):
+                with contextlib.suppress(OSError):
+                    st = os.lstat(f)
+                    if st.st_atime_ns > st.st_mtime_ns:
+                        os.utime(f, ns=(st.st_mtime_ns, st.st_mtime_ns), follow_symlinks=False)
+
+    def report(self):
+        """
+        Log the entries the build used from the cache (hits) and the ones
+        it added to it (misses), and mark them all as just used.
+        :return   (hits, misses), lists of entry names.
+        """
+        after  = list_entries(self.cachedir)
+        misses = sorted(set(after) - set(self.before))
+        hits   = sorted(x for x in set(after) & set(self.before) if entry_stats(after[x])[1] > self.start)
+        downloaded = sum(entry_stats(after[x])[0] for x in misses)
+        utils.log(f" > Download cache {self.cachedir}: {len(hits)} hit(s), {len(misses)} miss(es) "
+                  f"({downloaded / (1 << 20):.1f} MiB downloaded)")
+        for name in misses:
+            utils.log(f"   miss: {name}")
+        with utils.file_lock(self.lockfile):
+            index = self.load_index()
+            now = time.time()
+            index.update({x: now for x in hits + misses})
+            self.save_index(index)
+        return hits, misses
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache is within
+        its budget. Entries never recorded as used count as last used when
+        they were last modified.
+        """
+        if not os.path.isdir(self.cachedir):
+            return
+        with utils.file_lock(self.lockfile):
+            index   = self.load_index()
+            entries = list_entries(self.cachedir)
+            sizes   = {name: entry_stats(path)[0] for name, path in entries.items()}
+            total   = sum(sizes.values())
+            last_used = lambda x: index.get(x) or os.lstat(entries[x]).st_mtime
+            evicted = 0
+            for name in sorted(entries, key=last_used):
+                if total <= self.budget:
+                    break
+                path = entries[name]
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.remove(path)
+                total -= sizes[name]
+                evicted += 1
+                index.pop(name, None)
+            # forget entries deleted behind the cache's back too
+            self.save_index({k: v for k, v in index.items() if k in entries})
+        if evicted:
+            utils.log(f" > Evicted {evicted} least recently used download(s) from {self.cachedir} "
+                      f"to keep it within {self.budget / (1 << 30):.1f} GiB")
+
+    @contextlib.contextmanager
+    def tracking(self):
+        """
+        Context manager to wrap a build using the cache in: reports hits
+        and misses and enforces the budget once the build is over, whether
+        or not it succeeded.
+        """
+        self.snapshot()
+        try:
+            yield self
+        finally:
+            self.report()
+            self.evict()
+
+    def harvest(self, chunks):
+        """
+        Add to the cache the entries it does not already have from the tar
+        stream made up of chunks (e.g. the download directory copied out of
+        an image). The name of the top-level directory in the stream is
+        ignored.
+        :return   the list of entry names added.
+        """
+        added = set()
+        os.makedirs(self.cachedir, exist_ok=True)
+        with utils.file_lock(self.lockfile):
+            known = set(list_entries(self.cachedir))
+            with tarfile.open(fileobj=artifacts.Chunk_reader(chunks), mode='r|') as src:
+                for member in src:
+                    parts = [x for x in member.name.split('/') if x and x != '.'][1:]
+                    if not parts or parts[0].startswith('.'):
+                        continue
+                    name = '/'.join(parts[:2])
+                    if name in known:
+                        continue
+                    member.name = '/'.join(parts)
+                    if member.isdir() and len(parts) == 1:
+                        # a directory of entries rather than an entry
+                        os.makedirs(os.path.join(self.cachedir, member.name), exist_ok=True)
+                        continue
+                    if member.islnk():
+                        member.linkname = '/'.join(member.linkname.split('/')[1:])
+                    src.extract(member, self.cachedir, set_attrs=False)
+                    added.add(name)
+            index = self.load_index()
+            index.update({x: time.time() for x in added})
+            self.save_index(index)
+        utils.log(f" > Harvested {len(added)} new download(s) into {self.cachedir}")
+        return sorted(added)
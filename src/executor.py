@@ -0,0 +1,109 @@
+"""
+Execution of build steps as a dependency graph.
+
+Each entry of a build steps file (see spec/steps/) maps a step to the
+context it runs in, and can optionally list the steps it depends on:
+    { "build_container_image": "host", "depends_on": ["populate_staging_dir"] }
+
+A step that does not specify depends_on depends on the step listed right
+before it, which makes a steps file without any depends_on strictly
+sequential. depends_on: [] makes a step independent of all others.
+Steps whose dependencies have all completed are run concurrently.
+"""
+
+import concurrent.futures
+
+DEPENDS_ON = "depends_on"
+
+class Step():
+    def __init__(self, name, context, deps):
+        self.name    = name
+        self.context = context
+        self.deps    = deps
+
+    def __repr__(self):
+        return f"<{self.name} [{self.context}] <- {sorted(self.deps)}>"
+
+def parse_steps(entries):
+    """
+    Turn the entries of a steps file into a list of Steps, making any
+    implicit dependencies explicit.
+    """
+    steps = []
+    for entry in entries:
+        entry = dict(entry)
+        deps  = entry.pop(DEPENDS_ON, None)
+        if len(entry) != 1:
+            raise ValueError(f"Invalid step entry: '{entry}'")
+        (name, context), = entry.items()
+        if any(x.name == name for x in steps):
+            raise ValueError(f"Step '{name}' listed more than once")
+        if deps is None:
+            deps = [steps[-1].name] if steps else []
+        steps.append(Step(name, context, set(deps)))
+
+    known = {x.name for x in steps}
+    for step in steps:
+        unknown = step.deps - known
+        if unknown:
+            raise ValueError(f"Step '{step.name}' depends on unknown step(s): {sorted(unknown)}")
+    return steps
+
+def plan(entries, context):
+    """
+    Return a dict mapping each step to be run in context to the set of
+    steps (also run in context) it must wait for, preserving the order
+    of the input.
+
+    Steps of other contexts are not run here; they are carried out as part
+    of some step of this context (e.g. container steps during the image
+    build). Dependencies are therefore followed through them: a host step
+    that depends on a container step waits for whatever host steps that
+    container step in turn depends on.
+    """
+    steps = {x.name: x for x in parse_steps(entries)}
+
+    def local_deps(name, seen):
+        deps = set()
+        for dep in steps[name].deps:
+            if dep in seen:
+                continue
+            seen.add(dep)
+            if steps[dep].context == context:
+                deps.add(dep)
+            else:
+                deps |= local_deps(dep, seen)
+        return deps
+
+    return {name: local_deps(name, set()) for name, step in steps.items() if step.context == context}
+
+def run(graph, fn, max_workers=None):
+    """
+    Call fn(step) for every step in graph (see plan()) once all the steps
+    it depends on have completed, concurrently where possible.
+    If any call raises, no further steps are started and the exception is
+    re-raised once the steps already running are done.
+    """
+    pending = dict(graph)
+    done    = set()
+    running = {}
+    error   = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or max(1, len(graph))) as pool:
+        while pending or running:
+            if error is None:
+                for step in [x for x, deps in pending.items() if deps <= done]:
+                    del pending[step]
+                    running[pool.submit(fn, step)] = step
+            if not running:
+                if error is None and pending:
+                    raise ValueError(f"Circular dependencies between steps: {sorted(pending)}")
+                break
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                step = running.pop(future)
+                if future.exception() is not None:
+                    error = error or future.exception()
+                else:
+                    done.add(step)
+    if error is not None:
+        raise error
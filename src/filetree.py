@@ -0,0 +1,324 @@
+"""
+Layered file-tree manifests and incremental directory synchronization.
+"""
+
+import os
+import stat
+import shutil
+import hashlib
+import tarfile
+
+import utils
+
+HASH_BLOCK_SIZE = 1 << 20
+
+def hash_file(path):
+    """
+    Return the hex sha256 digest of the contents of the file at path.
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(HASH_BLOCK_SIZE)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+class Entry():
+    """
+    A single path in a Manifest: where it comes from and what it looks like.
+    The content hash is only computed if and when it is actually needed.
+    Files that only exist in memory have no source but their data instead
+    (see from_data()).
+    """
+    def __init__(self, source, st):
+        self.source = source
+        self.data   = None
+        self.isdir  = st is None or stat.S_ISDIR(st.st_mode)
+        if st is None:
+            # implicit parent directory with no source of its own
+            self.mode = self.size = self.mtime = self.dev = self.ino = None
+            self._hash = None
+            return
+        self.mode   = stat.S_IMODE(st.st_mode)
+        self.size   = st.st_size
+        self.mtime  = st.st_mtime_ns
+        self.dev    = st.st_dev
+        self.ino    = st.st_ino
+        self._hash  = None
+
+    @classmethod
+    def from_data(cls, data, mode):
+        entry = cls(None, None)
+        entry.isdir = False
+        entry.data  = data
+        entry.mode  = mode
+        entry.size  = len(data)
+        return entry
+
+    @property
+    def hash(self):
+        if self.isdir:
+            return None
+        if self._hash is None:
+            if self.data is not None:
+                self._hash = hashlib.sha256(self.data).hexdigest()
+            else:
+                self._hash = hash_file(self.source)
+        return self._hash
+
+    def __repr__(self):
+        kind = 'dir' if self.isdir else 'file'
+        return f"<{kind} {self.source or '(data)'} size={self.size} mtime={self.mtime}>"
+
+class Manifest():
+    """
+    In-memory view of a directory tree obtained by layering any number of
+    source directories and files on top of each other. Later additions
+    override earlier ones if they map to the same path.
+
+    Paths are kept relative to the root the manifest is to be synced to.
+    Nothing is written to disk until sync() is called.
+    """
+    def __init__(self, root):
+        self.root    = os.path.abspath(root)
+        self.entries = {}
+
+    def _relpath(self, path):
+        rel = os.path.relpath(os.path.abspath(path), self.root)
+        if rel == os.curdir:
+            return ''
+        if rel == os.pardir or rel.startswith(os.pardir + os.sep):
+            raise ValueError(f"Path '{path}' is outside the manifest root '{self.root}'")
+        return rel
+
+    def _add_parents(self, rel):
+        """
+        Make sure every ancestor directory of rel is present in the
+        manifest so the sync does not delete it as extraneous.
+        """
+        parent = os.path.dirname(rel)
+        while parent and parent not in self.entries:
+            self.entries[parent] = Entry(None, None)
+            parent = os.path.dirname(parent)
+
+    def _set(self, rel, entry):
+        if not rel:
+            return
+        # a file replacing a directory (or vice versa) hides whatever was
+        # under the old path
+        old = self.entries.get(rel)
+        if old is not None and old.isdir != entry.isdir:
+            prefix = rel + os.sep
+            for k in [k for k in self.entries if k.startswith(prefix)]:
+                del self.entries[k]
+        self._add_parents(rel)
+        self.entries[rel] = entry
+
+    def add_dir(self, src_dir, dst_dir, just_contents=False):
+        """
+        Layer the directory tree at src_dir on top of the manifest.
+        Takes the same arguments and has the same semantics
+        as utils.cp_dir().
+        """
+        dst = dst_dir
+        if not just_contents:
+            dst = dst_dir + "/" + utils.get_last_path_component(src_dir)
+        if not os.path.isdir(src_dir):
+            raise FileNotFoundError(f"No such directory: '{src_dir}'")
+
+        base = self._relpath(dst)
+        if base:
+            self._set(base, Entry(src_dir, os.stat(src_dir)))
+        for dirpath, dirs, files in os.walk(src_dir, followlinks=True):
+            reldir = os.path.relpath(dirpath, src_dir)
+            reldir = '' if reldir == os.curdir else reldir
+            for name in sorted(dirs) + sorted(files):
+                path = os.path.join(dirpath, name)
+                rel  = os.path.join(base, reldir, name)
+                self._set(rel, Entry(path, os.stat(path)))
+
+    def add_file(self, src_file, dst_dir, dst_fname=None, must_exist=False):
+        """
+        Layer a single file on top of the manifest.
+        Takes the same arguments and has the same semantics
+        as utils.cp_file().
+        """
+        if not os.path.isfile(src_file):
+            if must_exist:
+                raise FileNotFoundError(src_file)
+            return
+        fname = dst_fname or os.path.basename(src_file)
+        rel   = self._relpath(os.path.join(dst_dir, fname))
+        self._set(rel, Entry(src_file, os.stat(src_file)))
+
+    def add_data(self, data, dst_dir, dst_fname, mode=0o644):
+        """
+        Layer a file with contents data (bytes) on top of the manifest,
+        for files that only exist in memory.
+        """
+        rel = self._relpath(os.path.join(dst_dir, dst_fname))
+        self._set(rel, Entry.from_data(data, mode))
+
+    def remove(self, path):
+        """
+        Drop path, and whatever is under it, from the manifest.
+        """
+        rel = self._relpath(path)
+        prefix = rel + os.sep
+        for k in [k for k in self.entries if k == rel or k.startswith(prefix)]:
+            del self.entries[k]
+
+    def items(self):
+        """
+        (relative path, Entry) pairs in an order such that directories
+        always come before their contents.
+        """
+        return sorted(self.entries.items())
+
+    def _scan_root(self):
+        existing = {}
+        for dirpath, dirs, files in os.walk(self.root):
+            for name in dirs + files:
+                path = os.path.join(dirpath, name)
+                existing[os.path.relpath(path, self.root)] = os.lstat(path)
+        return existing
+
+    @staticmethod
+    def _up_to_date(entry, dst, st):
+        if stat.S_ISLNK(st.st_mode):
+            return False
+        if entry.isdir:
+            return stat.S_ISDIR(st.st_mode)
+        if not stat.S_ISREG(st.st_mode) or st.st_size != entry.size:
+            return False
+        if stat.S_IMODE(st.st_mode) != entry.mode:
+            return False
+        if st.st_dev == entry.dev and st.st_ino == entry.ino:
+            return True
+        if st.st_mtime_ns == entry.mtime:
+            return True
+        # same size, different mtime: only the contents can tell
+        return hash_file(dst) == entry.hash
+
+    def sync(self):
+        """
+        Make the directory tree under the manifest root identical to the
+        manifest, touching only the paths that actually differ.
+        Files are materialized with utils.copy_file() so they keep the
+        mtime of their source and honor the copy mode in effect (files
+        held in memory are written out); files that are already up to
+        date are not modified at all.
+
+        :return   a dict of counters: copied, unchanged, removed.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        existing = self._scan_root()
+        stats = {"copied": 0, "unchanged": 0, "removed": 0}
+
+        for rel, entry in self.items():
+            dst = os.path.join(self.root, rel)
+            st  = existing.pop(rel, None)
+            if st is not None and self._up_to_date(entry, dst, st):
+                stats["unchanged"] += 1
+                continue
+
+            if st is not None:
+                remove_path(dst, st)
+                # anything that was under a replaced directory is gone too
+                prefix = rel + os.sep
+                for k in [k for k in existing if k.startswith(prefix)]:
+                    del existing[k]
+            if entry.isdir:
+                os.makedirs(dst, exist_ok=True)
+            elif entry.data is not None:
+                write_data(entry.data, dst, entry.mode)
+            else:
+                utils.copy_file(entry.source, dst)
+            stats["copied"] += 1
+
+        # whatever is left over is not part of the manifest;
+        # deepest paths first so directories are empty by the time
+        # they get removed.
+        for rel in sorted(existing, reverse=True):
+            path = os.path.join(self.root, rel)
+            if os.path.lexists(path):
+                remove_path(path, existing[rel])
+                stats["removed"] += 1
+        return stats
+
+def write_data(data, path, mode):
+    with open(path, 'wb') as f:
+        f.write(data)
+    os.chmod(path, mode)
+
+def remove_path(path, st=None):
+    st = st or os.lstat(path)
+    if stat.S_ISDIR(st.st_mode):
+        shutil.rmtree(path)
+    else:
+        os.unlink(path)
+
+def walk_sorted(root):
+    """
+    Yield (relative path, lstat) for everything under root, in a stable
+    order where directories come before their contents.
+    """
+    for dirpath, dirs, files in os.walk(root):
+        dirs.sort()
+        for name in sorted(dirs + files):
+            path = os.path.join(dirpath, name)
+            yield os.path.relpath(path, root), os.lstat(path)
+
+def tree_fingerprint(root):
+    """
+    Return a hex digest identifying the state of the tree under root.
+    This is based on metadata only (path, type, mode, size, mtime); it is
+    therefore cheap to compute even for big trees, and it is stable as long
+    as nothing in the tree is touched -- which is what Manifest.sync()
+    guarantees for files whose contents have not changed.
+    """
+    h = hashlib.sha256()
+    for rel, st in walk_sorted(root):
+        h.update(f"{rel}\0{st.st_mode}\0{st.st_size}\0{st.st_mtime_ns}\n".encode())
+    return h.hexdigest()
+
+def content_fingerprint(path):
+    """
+    Return a hex digest of the names, modes and contents of everything
+    under path (or of the file at path). Unlike tree_fingerprint(), this
+    reads every file, so it should only be used for small trees
+    (e.g. scripts and configuration files).
+    """
+    h = hashlib.sha256()
+    if os.path.isfile(path):
+        h.update(f"{os.stat(path).st_mode:o} {hash_file(path)}\n".encode())
+    elif os.path.isdir(path):
+        for rel, st in walk_sorted(path):
+            entry = os.path.join(path, rel)
+            digest = hash_file(entry) if stat.S_ISREG(st.st_mode) else '-'
+            h.update(f"{rel} {st.st_mode:o} {digest}\n".encode())
+    else:
+        h.update(b"missing\n")
+    return h.hexdigest()
+
+def archive_tree(root, arcroot, outpath):
+    """
+    Write a tar archive of the tree under root to outpath, with all
+    members nested under arcroot. The file at outpath is only
+    replaced once the archive is complete, so concurrent writers
+    of the same archive do not step on each other.
+    """
+    partial = f'{outpath}.{os.getpid()}.part'
+    try:
+        with tarfile.open(partial, mode='w') as tar:
+            tar.add(root, arcname=arcroot, recursive=False)
+            for rel, st in walk_sorted(root):
+                tar.add(os.path.join(root, rel), arcname=f'{arcroot}/{rel}', recursive=False)
+    except BaseException:
+        if os.path.exists(partial):
+            os.remove(partial)
+        raise
+    os.replace(partial, outpath)
+    return outpath
@@ -0,0 +1,253 @@
+"""
+Local cache of bare git mirrors of sdk repositories.
+
+Each sdk repository gets a bare mirror on the host, keyed by its primary
+(i.e. first) URL. Checkouts are cloned from the mirror, which is a local
+operation that shares objects with the mirror through hard links; only
+the mirror itself is ever fetched over the network. When the mirror needs
+refreshing, all the URLs configured for the repository are queried at the
+same time and the first one to respond is fetched from.
+
+Alternatively, checkouts can be worktrees of the mirror (see
+Mirror.add_worktree()), which share not only its objects but its
+refs, so that any number of them cost no more than one clone.
+
+Mirrors always hold the whole history of the refs fetched into them:
+git does not clone from a shallow repository with hard links, so a
+shallow mirror would make every clone a copy. Cloning with limited
+history is left to the clones that do not share objects with the mirror
+anyway (see Mirror.clone()).
+
+If none of the URLs can be reached (e.g. when offline), a ref the mirror
+already has is used as it is.
+"""
+
+import os
+import time
+import hashlib
+import subprocess
+
+import utils
+import constants
+
+class Unavailable(RuntimeError):
+    pass
+
+def mirror_name(url, filter=None):
+    """
+    Directory name of the mirror for url: readable, but unique per URL.
+    Partial (i.e. filtered) mirrors are kept apart from full ones, since
+    a full clone cannot be made from a partial mirror.
+    """
+    base = os.path.basename(url.rstrip('/')) or 'repo'
+    if not base.endswith('.git'):
+        base += '.git'
+    key = url if not filter else f"{url}\0{filter}"
+    digest = hashlib.sha256(key.encode()).hexdigest()[:12]
+    return f"{digest}_{base}"
+
+def checkout(dest, ref, sparse_paths=None, detach=False):
+    """
+    Check out ref in the repository or worktree at dest, restricting the
+    working tree to sparse_paths (directories, relative to the top of the
+    repository) if specified.
+    """
+    if sparse_paths:
+        subprocess.run(['git', '-C', dest, 'sparse-checkout', 'set', '--cone'] + list(sparse_paths),
+                       check=True, env=git_env())
+    cmd = ['git', '-C', dest, '-c', 'advice.detachedHead=false', 'checkout', '--quiet']
+    cmd += ['--detach'] if detach else []
+    subprocess.run(cmd + [ref], check=True, env=git_env())
+
+def git_env():
+    # never prompt for credentials: an URL that needs them just loses the race
+    return dict(os.environ, GIT_TERMINAL_PROMPT='0')
+
+def race(urls, ref, timeout=constants.GIT_LS_REMOTE_TIMEOUT):
+    """
+    Query all urls for ref concurrently and return (url, refname) for
+    the first to answer, where refname is the full name of the ref
+    (e.g. refs/heads/<ref> or refs/tags/<ref>).
+
+    :raises Unavailable  if none of the urls has ref.
+    """
+    procs = {}
+    for url in urls:
+        procs[url] = subprocess.Popen(
+                ['git', 'ls-remote', '--exit-code', url, ref],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                text=True,
+                env=git_env()
+                )
+    deadline = time.monotonic() + timeout
+    winner = None
+    try:
+        while procs and not winner and time.monotonic() < deadline:
+            for url, proc in list(procs.items()):
+                if proc.poll() is None:
+                    continue
+                output = proc.stdout.read()
+                del procs[url]
+                refs = [x.split()[1] for x in output.splitlines() if len(x.split()) == 2]
+                for refname in (f'refs/heads/{ref}', f'refs/tags/{ref}'):
+                    if refname in refs:
+                        winner = (url, refname)
+                        break
+                if winner:
+                    break
+            if not winner:
+                time.sleep(0.05)
+    finally:
+        for proc in procs.values():
+            proc.kill()
+            proc.wait()
+    if not winner:
+        raise Unavailable(f"'{ref}' could not be found at any of: {urls}")
+    utils.log(f" > [gitcache] {winner[0]} answered first ({winner[1]})")
+    return winner
+
+class Mirror():
+    """
+    :param cachedir  directory all mirrors live under.
+    :param urls      URLs of the repository, in order of preference; the
+                     first one identifies the mirror.
+    :param filter    if specified, a partial clone filter (e.g. blob:none):
+                     the mirror then only holds the objects the filter lets
+                     through, and the rest are fetched on demand by
+                     whatever is checked out from it.
+    """
+    def __init__(self, cachedir, urls, filter=None):
+        if not urls:
+            raise ValueError("No URLs specified for mirror")
+        self.urls     = list(urls)
+        self.filter   = filter
+        self.path     = os.path.join(cachedir, mirror_name(self.urls[0], filter))
+        self.lockfile = self.path + '.lock'
+
+    def git(self, *args):
+        cmd = ['git', '-C', self.path] + list(args)
+        try:
+            subprocess.run(cmd, check=True, env=git_env(), text=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        except subprocess.CalledProcessError as e:
+            utils.log(f" ! [gitcache] '{' '.join(cmd)}' failed with exit code {e.returncode}")
+            utils.log_lines(f"   {x}" for x in (e.stderr or '').splitlines() if x.strip())
+            raise
+
+    def is_shallow(self):
+        return os.path.exists(os.path.join(self.path, 'shallow'))
+
+    def init(self):
+        os.makedirs(self.path)
+        self.git('init', '--bare', '--quiet')
+        if self.filter:
+            # missing objects are fetched on demand from the promisor
+            # remote; clones are made from the mirror with the same filter.
+            self.git('config', 'remote.origin.promisor', 'true')
+            self.git('config', 'remote.origin.partialclonefilter', self.filter)
+            self.git('config', 'uploadpack.allowfilter', 'true')
+            self.git('config', 'uploadpack.allowanysha1inwant', 'true')
+
+    def resolve(self, ref):
+        """
+        Return the full name of ref in the mirror, or None if the mirror
+        does not have it.
+        """
+        if not os.path.isdir(self.path):
+            return None
+        for refname in (f'refs/heads/{ref}', f'refs/tags/{ref}'):
+            found = subprocess.run(['git', '-C', self.path, 'rev-parse', '--verify', '--quiet', refname],
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, env=git_env())
+            if found.returncode == 0:
+                return refname
+        return None
+
+    def update(self, ref):
+        """
+        Fetch ref into the mirror from whichever URL answers first, with
+        its whole history, and return its full name in the mirror.
+        If no URL answers but the mirror already has ref, it is used as is.
+        """
+        try:
+            url, refname = race(self.urls, ref)
+        except Unavailable:
+            refname = self.resolve(ref)
+            if not refname:
+                raise
+            utils.log(f" ! [gitcache] '{ref}' could not be fetched: using {refname} from {self.path} as is")
+            return refname
+        if not os.path.isdir(self.path):
+            self.init()
+        utils.log(f" > [gitcache] Fetching {refname} from {url} into {self.path}")
+        args = ['fetch', '--quiet', '--no-tags', '--force']
+        if self.is_shallow():
+            # made shallow by an older version: see the module docstring
+            args.append('--unshallow')
+        if self.filter:
+            # a partial fetch must go through the promisor remote, which
+            # is pointed at the winner of the race
+            self.git('config', 'remote.origin.url', url)
+            args.append(f'--filter={self.filter}')
+            url = 'origin'
+        self.git(*args, url, f'+{refname}:{refname}')
+        return refname
+
+    def fetch(self, ref):
+        """
+        Like update(), but safe to call while the mirror is in use.
+        """
+        with utils.file_lock(self.lockfile):
+            return self.update(ref)
+
+    def clone(self, ref, dest, origin, depth=None, sparse_paths=None):
+        """
+        Refresh the mirror and clone ref from it to dest, with the origin
+        remote pointing at the URL origin rather than at the mirror.
+        A clone of a partial mirror is a partial clone itself, and does not
+        share objects with the mirror: the objects it fetches on demand come
+        from origin. Only such a clone is made with depth commits of history
+        if specified; any other shares the mirror's whole history through
+        hard links, at no cost.
+        """
+        cmd = ['git', '-c', 'advice.detachedHead=false', 'clone', '--quiet', '--branch', ref]
+        if self.filter:
+            # --local would make a clone that is missing objects without
+            # knowing where to get them.
+            cmd += [f'--filter={self.filter}']
+            cmd += [f'--depth={depth}'] if depth else []
+            cmd += ['file://' + os.path.abspath(self.path), dest]
+        else:
+            cmd += ['--local', self.path, dest]
+        # objects missing from a partial clone can only be fetched once
+        # origin points upstream, so check out after that.
+        deferred = self.filter or sparse_paths
+        if deferred:
+            cmd.insert(-2, '--no-checkout')
+        with utils.file_lock(self.lockfile):
+            self.update(ref)
+            utils.log(f" > [gitcache] {' '.join(cmd)}")
+            subprocess.run(cmd, check=True, env=git_env())
+        subprocess.run(['git', '-C', dest, 'remote', 'set-url', 'origin', origin], check=True)
+        if deferred:
+            checkout(dest, ref, sparse_paths)
+
+    def add_worktree(self, ref, dest, sparse_paths=None):
+        """
+        Refresh the mirror and add a worktree of it at dest, with ref
+        checked out (detached, so that any number of worktrees can have
+        the same branch checked out).
+        The worktree refers to the mirror by its absolute path, so it can
+        only be used where the mirror is available at that same path.
+        """
+        with utils.file_lock(self.lockfile):
+            refname = self.update(ref)
+            # forget worktrees whose directory has since been deleted
+            self.git('worktree', 'prune')
+            cmd = ['git', '-C', self.path, 'worktree', 'add', '--quiet', '--detach', '--no-checkout',
+                   os.path.abspath(dest), refname]
+            utils.log(f" > [gitcache] {' '.join(cmd)}")
+            subprocess.run(cmd, check=True, env=git_env())
+            # objects missing from a partial mirror are fetched into it
+            # here, so this too is done holding the lock
+            checkout(dest, refname, sparse_paths, detach=True)
@@ -0,0 +1,162 @@
+"""
+Concurrent builds of multiple targets from a single builder invocation.
+
+The parent (i.e. the builder invocation given multiple targets) takes care of
+the setup that is common to all targets -- cleaning up, validation against
+the spec overlay -- and then runs one builder 'worker' process per target.
+Each worker builds a single target exactly as a single-target invocation
+would, except that it skips the shared setup and uses its own staging, output
+and temporary directories (see settings.set_paths()).
+
+The cores (and memory) available are divided into slots by resources.plan();
+each worker occupies one slot. Builds that cannot share the host at the same
+time (e.g. dev builds of targets using the same sdk checkout) are never run
+concurrently. Worker output is multiplexed with a per-target prefix, and a
+per-target summary is printed at the end.
+"""
+
+import os
+import sys
+import time
+import threading
+import subprocess
+
+import utils
+import constants
+import resources
+
+WORKER_FLAG = '--worker'
+
+# options whose value is set per worker and are therefore dropped
+# from the parent's command line.
+_PER_WORKER_OPTIONS = ('-t', '--target', '--cores')
+
+def worker_argv(argv, target, cores):
+    """
+    Derive the command line for the worker building target from the
+    parent's command line (argv, excluding the program name).
+    """
+    out = []
+    it = iter(argv)
+    for arg in it:
+        if arg in _PER_WORKER_OPTIONS:
+            next(it, None)
+            continue
+        if arg == '--all-targets' or arg.startswith(tuple(f'{x}=' for x in _PER_WORKER_OPTIONS)):
+            continue
+        if arg.startswith('-t') and not arg.startswith('--'):
+            continue
+        out.append(arg)
+    return out + ['-t', target, f'--cores={cores}', WORKER_FLAG]
+
+class Job():
+    def __init__(self, target, exclusive=None):
+        self.target     = target
+        self.exclusive  = exclusive
+        self.cores      = None
+        self.slot       = None
+        self.proc       = None
+        self.start      = None
+        self.duration   = 0
+        self.returncode = None
+
+    @property
+    def status(self):
+        if self.returncode is None:
+            return 'not run'
+        return 'ok' if self.returncode == 0 else f'failed ({self.returncode})'
+
+class Multibuild():
+    """
+    :param entrypoint   path to builder.py.
+    :param argv         the parent's command line, excluding the program name.
+    :param jobs         list of Job objects, one per target, in the order
+                        they should be started.
+    :param slots        list of the number of cores available in each slot
+                        (see resources.plan()).
+    """
+    def __init__(self, entrypoint, argv, jobs, slots):
+        self.entrypoint = entrypoint
+        self.argv       = argv
+        self.jobs       = jobs
+        self.slots      = slots
+        self.cond       = threading.Condition()
+        self.output_lock = threading.Lock()
+
+    def log(self, target, msg):
+        with self.output_lock:
+            utils.log(f"[{target}] {msg}")
+
+    def launch(self, job, slot):
+        job.slot  = slot
+        job.cores = self.slots[slot]
+        cmd = [sys.executable, self.entrypoint] + worker_argv(self.argv, job.target, job.cores)
+        env = dict(os.environ, PYTHONUNBUFFERED='1')
+        utils.log(f" > Starting build of '{job.target}' with {job.cores} core(s): {' '.join(cmd)}")
+        job.start = time.monotonic()
+        job.proc  = subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT)
+        threading.Thread(target=self.follow, args=(job,), daemon=True).start()
+
+    def follow(self, job):
+        for line in job.proc.stdout:
+            self.log(job.target, line.decode('utf8', errors='replace').rstrip())
+        returncode = job.proc.wait()
+        with self.cond:
+            job.returncode = returncode
+            job.duration = time.monotonic() - job.start
+            self.cond.notify_all()
+
+    def run(self):
+        pending = list(self.jobs)
+        running = []
+        free    = list(range(len(self.slots)))
+        try:
+            with self.cond:
+                while pending or running:
+                    for job in [x for x in running if x.returncode is not None]:
+                        running.remove(job)
+                        free.append(job.slot)
+                        utils.log(f" > Build of '{job.target}' done: {job.status}")
+                    busy = {x.exclusive for x in running if x.exclusive}
+                    for job in list(pending):
+                        if not free:
+                            break
+                        if job.exclusive and job.exclusive in busy:
+                            continue
+                        pending.remove(job)
+                        running.append(job)
+                        busy.add(job.exclusive)
+                        self.launch(job, free.pop(0))
+                    if running:
+                        self.cond.wait()
+        except BaseException:
+            for job in running:
+                job.proc.terminate()
+            raise
+        return self.jobs
+
+    def summary(self):
+        utils.log(" > Build summary:")
+        width = max(len(x.target) for x in self.jobs)
+        for job in self.jobs:
+            utils.log(f"   {job.target:<{width}}  {job.status:<12} {job.cores or '-':>3} core(s) "
+                      f" {job.duration:8.1f}s")
+        failed = [x for x in self.jobs if x.returncode != 0]
+        utils.log(f" > {len(self.jobs) - len(failed)} of {len(self.jobs)} targets built successfully")
+        return failed
+
+def run(entrypoint, argv, jobs, cores, memory=None, memory_per_job=constants.MEMORY_PER_BUILD_JOB):
+    """
+    Build all jobs concurrently within a budget of cores (and memory, if
+    known, each build job being assumed to need memory_per_job); see
+    Multibuild.
+    :return   the exit code for the parent: 0 if all builds succeeded,
+              1 otherwise.
+    """
+    slots = resources.plan(len(jobs), cores, memory, memory_per_job=memory_per_job)
+    utils.log(f" > Building {len(jobs)} targets, {len(slots)} at a time, "
+              f"within {cores} cores: {slots}")
+    builds = Multibuild(entrypoint, argv, jobs, slots)
+    builds.run()
+    return 1 if builds.summary() else 0
@@ -0,0 +1,118 @@
+"""
+The spec overlay: the in-tree spec/ directory as extended by out-of-tree
+targets (see --target-tree) and container image buildspecs (see --buildspec).
+
+In the overlay, out-of-tree targets appear under targets/ and out-of-tree
+buildspecs under container_image_buildspec/, replacing any in-tree ones of
+the same name, and the enum schemas listing the known targets and buildspecs
+are patched to list those too.
+
+None of this gets copied anywhere. A path in the overlay is resolved to the
+file it comes from (see Spec_overlay.resolve()) and the patched schemas are
+kept in memory, from where the validator takes them (see
+validation.override_schemas()). The only physical copy of the overlay is the
+one made in the staging directory, as the container needs a real tree (see
+Spec_overlay.add_to_manifest()).
+"""
+
+import os
+import json
+
+import utils
+import registry
+
+# schemas patched in the overlay, relative to the schemas directory
+TARGETS_ENUM_SCHEMA    = 'enum/targets.json'
+BUILDSPECS_ENUM_SCHEMA = 'enum/container_image_buildspec_files.json'
+
+def _under(path, directory):
+    """
+    Return path relative to directory if it is under it, else None.
+    """
+    rel = os.path.relpath(path, directory)
+    if rel == os.pardir or rel.startswith(os.pardir + os.sep):
+        return None
+    return '' if rel == os.curdir else rel
+
+class Spec_overlay():
+    """
+    :param pathmap           the paths of the spec tree to overlay (those of
+                             the current context are used).
+    :param extra_targets     out-of-tree target directories, normalized (see
+                             builder.normalize_extra_target_paths()).
+    :param extra_buildspecs  out-of-tree buildspec files, normalized (see
+                             builder.normalize_extra_buildspec_file_paths()).
+    """
+    def __init__(self, pathmap, extra_targets=(), extra_buildspecs=()):
+        self.root           = os.path.abspath(pathmap.specs)
+        self.tgroot         = os.path.abspath(pathmap.tgroot)
+        self.buildspecs_dir = os.path.abspath(pathmap.buildspecs)
+        self.schemas_dir    = os.path.abspath(pathmap.schemas)
+        self.extra_targets    = {os.path.basename(x): os.path.abspath(x) for x in extra_targets}
+        self.extra_buildspecs = {os.path.basename(x): os.path.abspath(x) for x in extra_buildspecs}
+
+        index = registry.get_index()
+        self.targets = {os.path.basename(x): x for x in index.targets_in(self.tgroot)}
+        self.targets.update(self.extra_targets)
+        self.buildspecs = {os.path.basename(x): x for x in index.buildspecs_in(self.buildspecs_dir)}
+        self.buildspecs.update(self.extra_buildspecs)
+
+        # the enums list everything known, in-tree and out-of-tree
+        self.schemas = {}
+        for name, values in ((TARGETS_ENUM_SCHEMA, list(self.targets)),
+                             (BUILDSPECS_ENUM_SCHEMA, list(self.buildspecs))):
+            j = utils.load_json_from_file(os.path.join(self.schemas_dir, name))
+            j['enum'] = values
+            self.schemas[name] = j
+
+    def __repr__(self):
+        return (f"<spec overlay {self.root}: {len(self.extra_targets)} out-of-tree target(s), "
+                f"{len(self.extra_buildspecs)} out-of-tree buildspec(s)>")
+
+    def resolve(self, path):
+        """
+        Return the path of the file (or directory) that path, either
+        relative to the spec directory or under it, comes from. Patched
+        schemas resolve to their unpatched in-tree file: see schemas.
+        """
+        path = os.path.join(self.root, path)
+        rel = _under(path, self.tgroot)
+        if rel:
+            name, _, rest = rel.partition(os.sep)
+            if name in self.extra_targets:
+                return os.path.join(self.extra_targets[name], rest) if rest else self.extra_targets[name]
+        rel = _under(path, self.buildspecs_dir)
+        if rel in self.extra_buildspecs:
+            return self.extra_buildspecs[rel]
+        return os.path.normpath(path)
+
+    def target_dir(self, target):
+        """
+        Return the directory target comes from.
+        :raises LookupError  if there is no such target.
+        """
+        if target not in self.targets:
+            raise LookupError(f"Target '{target}' not found in {self.tgroot} or out-of-tree")
+        return self.targets[target]
+
+    def tgspec(self, target):
+        return os.path.join(self.target_dir(target), f'{target}_spec.json')
+
+    def add_to_manifest(self, manifest, dst_dir):
+        """
+        Layer the overlay, patched schemas included, on top of manifest
+        at dst_dir.
+        """
+        manifest.add_dir(self.root, dst_dir, just_contents=True)
+        dst_tgroot = os.path.join(dst_dir, os.path.relpath(self.tgroot, self.root))
+        for name, path in self.extra_targets.items():
+            # replaced outright, not merged with an in-tree target of the same name
+            manifest.remove(os.path.join(dst_tgroot, name))
+            manifest.add_dir(path, os.path.join(dst_tgroot, name), just_contents=True)
+        dst_buildspecs = os.path.join(dst_dir, os.path.relpath(self.buildspecs_dir, self.root))
+        for path in self.extra_buildspecs.values():
+            manifest.add_file(path, dst_buildspecs, must_exist=True)
+        dst_schemas = os.path.join(dst_dir, os.path.relpath(self.schemas_dir, self.root))
+        for name, schema in self.schemas.items():
+            data = json.dumps(schema, indent=5).encode()
+            manifest.add_data(data, os.path.join(dst_schemas, os.path.dirname(name)), os.path.basename(name))
@@ -0,0 +1,375 @@
+#!/usr/bin/python3
+
+"""
+Dependency-aware, parallel package build scheduler for OpenWrt SDKs.
+
+The packages requested are ordered using the package dependency metadata
+OpenWrt keeps in tmp/.packageinfo. Building a package with make also builds
+whatever it depends on, so two packages sharing a dependency built at the
+same time would both build it, in the same tmp/ and staging_dir/. Hence the
+dependencies of the packages requested, requested or not, are built first,
+once each, before any package that depends on them: packages are only built
+concurrently once there is nothing left for them to share. The concurrent
+make instances share a single GNU make jobserver so that the total number
+of jobs never exceeds the core budget. A failed package does not abort the
+others; only the packages that depend on it are skipped. A status and
+timing report is printed at the end.
+
+If no dependency metadata is available, the packages are built one after
+the other, in the order given (a failure still does not stop the rest).
+
+Run as:
+    python3 -m pkgsched --topdir <sdk topdir> --jobs <N> pkg1 pkg2 ...
+"""
+
+import os
+import sys
+import time
+import argparse
+import threading
+import subprocess
+
+import utils
+import artifacts
+
+PACKAGEINFO = "tmp/.packageinfo"
+
+class Jobserver():
+    """
+    A GNU make jobserver: a pipe preloaded with one token per job slot.
+
+    Every make instance normally has one implicit job slot of its own on top
+    of the tokens it reads from the jobserver. Here the scheduler holds a
+    token for each make it launches to back that implicit slot, so the
+    pipe starts out with all the slots in it.
+    """
+    def __init__(self, slots):
+        self.slots = max(1, int(slots))
+        self.r, self.w = os.pipe()
+        os.set_inheritable(self.r, True)
+        os.set_inheritable(self.w, True)
+        os.write(self.w, b'+' * self.slots)
+
+    def acquire(self):
+        while True:
+            token = os.read(self.r, 1)
+            if token:
+                return token
+
+    def release(self, token):
+        os.write(self.w, token)
+
+    def fds(self):
+        return (self.r, self.w)
+
+    def makeflags(self):
+        # --jobserver-fds is what make < 4.2 understands
+        fds = f"{self.r},{self.w}"
+        return f" -j --jobserver-fds={fds} --jobserver-auth={fds}"
+
+    def close(self):
+        os.close(self.r)
+        os.close(self.w)
+
+def parse_dependencies(field, build_depends=False):
+    """
+    Return the names of the packages listed in a Depends or Build-Depends
+    field of .packageinfo. Conditions on config symbols are dropped e.g.
+    '+USE_GLIBC:librt' -> 'librt', '@KERNEL_X' -> (nothing), and so are
+    '/host' suffixes in Build-Depends.
+    """
+    names = []
+    for token in field.split():
+        token = token.lstrip('+')
+        if ':' in token:
+            token = token.rpartition(':')[2].lstrip('+')
+        if not token or token[0] in '@!':
+            continue
+        if build_depends:
+            token = token.partition('/')[0]
+        names.append(token)
+    return names
+
+def parse_packageinfo(path):
+    """
+    Parse the OpenWrt package metadata at path.
+
+    :return   a (sources, providers) tuple, where sources maps each source
+              package (i.e. the directory name of the Makefile, which is
+              what make package/<name>/compile expects) to the set of
+              names it depends on, and providers maps each binary
+              package name to the source package it is built from.
+    """
+    sources = {}
+    providers = {}
+    source = None
+    with open(path, 'r', encoding='utf8', errors='replace') as f:
+        for line in f:
+            key, sep, value = line.partition(':')
+            if not sep:
+                continue
+            value = value.strip()
+            if key == 'Source-Makefile':
+                source = os.path.basename(os.path.dirname(value))
+                sources.setdefault(source, set())
+                providers.setdefault(source, source)
+            elif source is None:
+                continue
+            elif key == 'Package':
+                providers[value] = source
+            elif key == 'Depends':
+                sources[source].update(parse_dependencies(value))
+            elif key == 'Build-Depends':
+                sources[source].update(parse_dependencies(value, build_depends=True))
+    return sources, providers
+
+def order_packages(requested, sources, providers):
+    """
+    Work out what to build, and what each package built must wait for: the
+    requested source packages and all the packages they depend on,
+    transitively, that are built from source (i.e. found in sources).
+
+    :param requested  source packages requested (see main()).
+    :return   a dict mapping each source package to build to the set of
+              source packages it directly depends on, dependencies first.
+    """
+    graph = {}
+    def visit(source, path):
+        if source in graph or source in path:
+            return
+        path.add(source)
+        deps = set()
+        for dep in sorted(sources.get(source, ())):
+            dep = providers.get(dep, dep)
+            if dep in sources and dep != source:
+                visit(dep, path)
+                deps.add(dep)
+        path.discard(source)
+        graph[source] = deps
+    for source in requested:
+        visit(source, set())
+    return graph
+
+class Scheduler():
+    """
+    Builds packages as their dependencies complete, in as many concurrent
+    make instances as there are jobserver tokens available.
+    :param clean   the packages to clean before building (the others are
+                   only built if out of date).
+    """
+    def __init__(self, topdir, graph, jobs, max_builds=None, make_args=None, clean=None):
+        self.topdir    = topdir
+        self.max_builds = max_builds or len(graph)
+        self.graph     = graph
+        self.order     = list(graph)
+        self.jobserver = Jobserver(jobs)
+        self.make_args = make_args or ["V=sc"]
+        self.clean     = set(graph if clean is None else clean)
+        self.results   = {}      # pkg -> (status, start, duration)
+        self.started   = set()
+        self.cond      = threading.Condition()
+        self.output_lock = threading.Lock()
+
+    def log(self, pkg, msg):
+        with self.output_lock:
+            utils.log(f"[{pkg}] {msg}")
+
+    def command(self, pkg):
+        clean = [f"package/{pkg}/clean"] if pkg in self.clean else []
+        return ["make", *clean, f"package/{pkg}/compile"] + self.make_args
+
+    def build(self, pkg):
+        token = self.jobserver.acquire()
+        start = time.monotonic()
+        status = 'failed'
+        try:
+            cmd = self.command(pkg)
+            self.log(pkg, f"Building ('{' '.join(cmd)}')")
+            env = dict(os.environ)
+            env["MAKEFLAGS"] = self.jobserver.makeflags()
+            env.pop("MFLAGS", None)
+            proc = subprocess.Popen(
+                    cmd,
+                    cwd=self.topdir,
+                    env=env,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.STDOUT,
+                    pass_fds=self.jobserver.fds()
+                    )
+            for line in proc.stdout:
+                self.log(pkg, line.decode('utf8', errors='replace').rstrip())
+            status = 'ok' if proc.wait() == 0 else 'failed'
+        except OSError as e:
+            self.log(pkg, f"Failed to start build: {e}")
+        finally:
+            self.jobserver.release(token)
+            with self.cond:
+                self.results[pkg] = (status, start, time.monotonic() - start)
+                self.cond.notify_all()
+
+    def ready(self):
+        """
+        Packages not yet started whose dependencies have all completed.
+        Packages depending on a package that did not build are marked as
+        skipped instead.
+        """
+        ready = []
+        for pkg in self.order:
+            if pkg in self.started:
+                continue
+            deps = self.graph[pkg]
+            if any(self.results.get(d, ('ok',))[0] != 'ok' for d in deps if d in self.results):
+                self.started.add(pkg)
+                self.results[pkg] = ('skipped', None, 0)
+                continue
+            if all(d in self.results for d in deps):
+                ready.append(pkg)
+        return ready
+
+    def run(self):
+        threads = []
+        with self.cond:
+            while len(self.results) < len(self.order):
+                ready = self.ready()
+                running = len(self.started) - len(self.results)
+                if not ready and not running and len(self.results) < len(self.order):
+                    # only possible with circular dependencies: break
+                    # the cycle by building in the requested order
+                    pkg = next(x for x in self.order if x not in self.started)
+                    utils.log(f" ! Circular dependency involving '{pkg}', building it first")
+                    ready = [pkg]
+                for pkg in ready[:max(0, self.max_builds - running)]:
+                    self.started.add(pkg)
+                    t = threading.Thread(target=self.build, args=(pkg,), daemon=True)
+                    t.start()
+                    threads.append(t)
+                if len(self.results) < len(self.order):
+                    self.cond.wait()
+        for t in threads:
+            t.join()
+        self.jobserver.close()
+        return self.results
+
+def prepare(topdir, make_args):
+    """
+    Bring the package metadata in tmp/ up to date, so that the concurrent
+    make instances find it so rather than all regenerating it at once.
+    Not fatal if it fails: the metadata (if any) is then used as is.
+    """
+    cmd = ["make", "prepare-tmpinfo"] + make_args
+    utils.log(f" > Updating package metadata ('{' '.join(cmd)}')")
+    proc = subprocess.run(cmd, cwd=topdir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if proc.returncode:
+        utils.log_lines(proc.stdout.decode('utf8', errors='replace').splitlines())
+        utils.log(f" ! Failed to update the package metadata (exit code {proc.returncode})")
+
+def report(results, order, requested):
+    """
+    Log the outcome of every build in order (source packages), dependencies
+    built along the way included, and return the requested packages that
+    did not build.
+    :param requested  {package requested: its source package}
+    """
+    utils.log(" > Package build report:")
+    names = {}
+    for pkg, source in requested.items():
+        names.setdefault(source, []).append(pkg)
+    width = max(len(x) for x in order)
+    for source in order:
+        status, _, duration = results[source]
+        if source not in names:
+            note = "  (dependency)"
+        elif names[source] != [source]:
+            note = f"  (for {', '.join(names[source])})"
+        else:
+            note = ""
+        utils.log(f"   {source:<{width}}  {status:<7}  {duration:8.1f}s{note}")
+    failed = [pkg for pkg, source in requested.items() if results[source][0] != 'ok']
+    utils.log(f" > {len(requested) - len(failed)} of {len(requested)} packages built successfully")
+    return failed
+
+def main():
+    parser = argparse.ArgumentParser(description='Dependency-aware parallel package builds')
+    parser.add_argument('--topdir',
+                        required=True,
+                        help='Top-level directory of the OpenWrt SDK'
+                        )
+    parser.add_argument('-j',
+                        '--jobs',
+                        type=int,
+                        default=int(os.getenv("NUM_BUILD_CORES") or 1),
+                        help='Total number of make jobs across all packages'
+                        )
+    parser.add_argument('-l',
+                        '--load-average',
+                        type=float,
+                        default=float(os.getenv("BUILD_LOAD_LIMIT") or 0) or None,
+                        help='Load average above which make should not start new jobs (make -l)'
+                        )
+    parser.add_argument('--artifacts-dir',
+                        metavar='DIR',
+                        help='Directory the built packages end up in (e.g. <topdir>/bin)'
+                        )
+    parser.add_argument('--outdir',
+                        metavar='DIR',
+                        help='Copy the packages produced by the build from --artifacts-dir to DIR'
+                        )
+    parser.add_argument('--pattern',
+                        action='append',
+                        dest='patterns',
+                        help='Pattern the names of the files to copy to --outdir must match (default: *.ipk)'
+                        )
+    parser.add_argument('packages',
+                        nargs='*',
+                        help='Packages to build'
+                        )
+    args = parser.parse_args()
+    utils.set_logging(tostdout=True)
+
+    packages = list(dict.fromkeys(args.packages))
+    if not packages:
+        utils.log(" > No packages to build")
+        return 0
+
+    make_args = ["V=sc"] + ([f"-l{args.load_average:g}"] if args.load_average else [])
+    prepare(args.topdir, make_args)
+    metadata = os.path.join(args.topdir, PACKAGEINFO)
+    if os.path.isfile(metadata):
+        sources, providers = parse_packageinfo(metadata)
+        # packages are built by source package (several of those requested
+        # may come from the same one): see report() for the way back
+        requested = {pkg: providers.get(pkg, pkg) for pkg in packages}
+        targets = list(dict.fromkeys(requested.values()))
+        graph = order_packages(targets, sources, providers)
+        max_builds = None
+        utils.log(f" > Building {len(packages)} package(s) from {len(targets)} source package(s), "
+                  f"and {len(graph) - len(targets)} dependencies, with up to {args.jobs} jobs")
+        for source in graph:
+            utils.log(f"   {source} <- {sorted(graph[source]) or '-'}")
+    else:
+        utils.log(f" ! No package metadata at {metadata}: building packages sequentially")
+        requested = {pkg: pkg for pkg in packages}
+        targets = packages
+        graph = {pkg: set() for pkg in packages}
+        max_builds = 1
+
+    collector = None
+    if args.artifacts_dir and args.outdir:
+        # what this build produced (the packages requested are cleaned, so
+        # theirs are all new), not every package ever built in there
+        collector = artifacts.Collector(args.artifacts_dir, args.patterns or ["*.ipk"], only_new=True)
+        collector.snapshot()
+
+    t0 = time.monotonic()
+    results = Scheduler(args.topdir, graph, args.jobs, max_builds, make_args, clean=targets).run()
+    failed = report(results, list(graph), requested)
+    utils.log(f" > Total time: {time.monotonic() - t0:.1f}s")
+
+    # whatever the build produced is collected, even if some packages
+    # failed: the packages that did build are still usable.
+    if collector:
+        collector.collect(args.outdir)
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,236 @@
+"""
+Timing profiler for builds (see --profile).
+
+Code to be profiled is wrapped in spans:
+    with profiler.span("build", "stage"):
+        ...
+Each span records its wall time, the CPU time used meanwhile (by this
+process and any child processes it waited for -- process-wide, so the CPU
+time of spans running concurrently in different threads overlaps) and its
+exit status. Spans cost next to nothing when profiling is off.
+
+The builder on the host writes the spans out when it exits, both as a Chrome
+trace-event file (load it in chrome://tracing or https://ui.perfetto.dev)
+and as a flat summary table. Processes running in the container (the
+builder, the hook runner) are told to profile through the BUILDER_PROFILE
+environment variable, which names a directory to dump their spans in when
+they exit; the host then merges these dumps into its own report. The dumps
+of the image build must not end up in the image: they are printed to the
+build output, one per line after DUMP_MARKER, and removed in the same step.
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import resource
+import threading
+import contextlib
+import subprocess
+
+import utils
+
+ENV_VAR     = "BUILDER_PROFILE"
+TRACE_FILE  = "profile.trace.json"
+SUMMARY_FILE = "profile.txt"
+# prefixes a dump printed as a line of output (see merge_dump_line())
+DUMP_MARKER = "BUILDER_PROFILE_DUMP "
+
+_enabled  = False
+_dump_dir = None
+_events   = []
+_lock     = threading.Lock()
+# pids of processes whose spans were merged into this one, mapped to
+# their names; dumped pids are renumbered so as not to clash with ours.
+_processes = {}
+
+def enable(dump_dir=None):
+    """
+    Turn profiling on for this process. If dump_dir is specified, the spans
+    are dumped there when the process exits (for some other process to
+    merge); otherwise it is up to the caller to write_report().
+    """
+    global _enabled, _dump_dir
+    _enabled  = True
+    _dump_dir = dump_dir
+    _processes[os.getpid()] = os.path.basename(sys.argv[0]) or 'python'
+    if dump_dir:
+        atexit.register(_dump)
+
+def enable_from_env():
+    """
+    Turn profiling on if the BUILDER_PROFILE environment variable asks for it.
+    """
+    if os.getenv(ENV_VAR):
+        enable(os.getenv(ENV_VAR))
+
+def is_enabled():
+    return _enabled
+
+def _cpu_time():
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+def _exit_status(e):
+    # a generator closed before it is exhausted has not failed
+    if isinstance(e, GeneratorExit):
+        return 0
+    if isinstance(e, SystemExit):
+        return e.code if isinstance(e.code, int) else 1
+    if isinstance(e, subprocess.CalledProcessError):
+        return e.returncode
+    return type(e).__name__
+
+@contextlib.contextmanager
+def span(name, category, **args):
+    """
+    Context manager recording a span. The dict yielded holds the arguments
+    of the span and can be added to; setting its 'status' key overrides
+    the exit status (0, unless an exception is raised).
+    """
+    if not _enabled:
+        yield {}
+        return
+    record = dict(args)
+    start = time.time_ns() // 1000
+    wall  = time.perf_counter()
+    cpu   = _cpu_time()
+    status = 0
+    try:
+        yield record
+    except BaseException as e:
+        status = _exit_status(e)
+        raise
+    finally:
+        record.setdefault('status', status)
+        record['cpu_s'] = round(_cpu_time() - cpu, 3)
+        event = {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": start,
+                "dur": int((time.perf_counter() - wall) * 1e6),
+                "pid": os.getpid(),
+                "tid": threading.get_native_id(),
+                "args": record,
+                }
+        with _lock:
+            _events.append(event)
+
+def counter(name, values, timestamp=None):
+    """
+    Record the values (a dict of series -> number) of the counter name at
+    timestamp (seconds since the epoch, default now), for the trace to
+    graph.
+    """
+    if not _enabled:
+        return
+    event = {
+            "name": name,
+            "cat": "counter",
+            "ph": "C",
+            "ts": int((timestamp or time.time()) * 1e6),
+            "pid": os.getpid(),
+            "args": values,
+            }
+    with _lock:
+        _events.append(event)
+
+def _dump():
+    with _lock:
+        events = list(_events)
+    if not events:
+        return
+    os.makedirs(_dump_dir, exist_ok=True)
+    dump = {"process": _processes.get(os.getpid()), "events": events}
+    path = os.path.join(_dump_dir, f"events.{os.getpid()}.json")
+    with open(path + '.tmp', 'w') as f:
+        json.dump(dump, f)
+    os.replace(path + '.tmp', path)
+
+def merge(dump, where):
+    """
+    Merge the spans of dump (as written by another process on exit) into
+    this process' spans.
+    :param where   where the process ran e.g. 'container', for its name.
+    """
+    with _lock:
+        pid = max([*_processes, 1 << 20]) + 1
+        _processes[pid] = f"{dump.get('process')} [{where}]"
+        for event in dump.get("events") or []:
+            event["pid"] = pid
+            _events.append(event)
+
+def merge_dump_line(line, where):
+    """
+    Merge the dump printed as line (after DUMP_MARKER) of some output, e.g.
+    that of an image build. Return True if line is such a dump, whether
+    profiling or not, else False.
+    """
+    if not line.startswith(DUMP_MARKER):
+        return False
+    if _enabled:
+        try:
+            merge(json.loads(line[len(DUMP_MARKER):]), where)
+        except ValueError as e:
+            utils.log(f"Ignoring unreadable profile dump in the {where} output: {e}")
+    return True
+
+def merge_dump_archive(chunks, where):
+    """
+    Merge the dumps found in the tar stream made up of chunks (e.g. the
+    dump directory copied out of a container).
+    """
+    if not _enabled:
+        return
+    # only needed here, and not worth importing for every process
+    import tarfile
+    import artifacts
+    with tarfile.open(fileobj=artifacts.Chunk_reader(chunks), mode='r|') as src:
+        for member in src:
+            if member.isreg() and member.name.endswith('.json'):
+                merge(json.load(src.extractfile(member)), where)
+
+def summarize(events):
+    """
+    Aggregate spans by category and name into a list of rows of
+    (category, name, count, failures, total wall s, max wall s, total cpu s),
+    longest total wall time first.
+    """
+    rows = {}
+    for event in events:
+        if event["ph"] != "X":
+            continue
+        key = (event["cat"], event["name"])
+        row = rows.setdefault(key, [0, 0, 0.0, 0.0, 0.0])
+        wall = event["dur"] / 1e6
+        row[0] += 1
+        row[1] += event["args"].get("status") not in (0, None)
+        row[2] += wall
+        row[3] = max(row[3], wall)
+        row[4] += event["args"].get("cpu_s") or 0
+    return sorted((k + tuple(v) for k, v in rows.items()), key=lambda x: -x[4])
+
+def write_report(outdir):
+    """
+    Write the Chrome trace and the summary of all the spans recorded (and
+    merged) so far to outdir. Return the paths written.
+    """
+    with _lock:
+        events = list(_events)
+    os.makedirs(outdir, exist_ok=True)
+    metadata = [{"name": "process_name", "ph": "M", "pid": pid, "args": {"name": name}}
+                for pid, name in _processes.items()]
+    trace_path = os.path.join(outdir, TRACE_FILE)
+    with open(trace_path, 'w') as f:
+        json.dump({"traceEvents": metadata + events, "displayTimeUnit": "ms"}, f)
+
+    header = ("category", "name", "count", "failed", "wall (s)", "max (s)", "cpu (s)")
+    lines = [f"{header[0]:<10} {header[1]:<40} {header[2]:>6} {header[3]:>6} {header[4]:>10} {header[5]:>10} {header[6]:>10}"]
+    for cat, name, count, failed, wall, longest, cpu in summarize(events):
+        lines.append(f"{cat:<10} {name[:40]:<40} {count:>6} {failed:>6} {wall:>10.2f} {longest:>10.2f} {cpu:>10.2f}")
+    summary_path = os.path.join(outdir, SUMMARY_FILE)
+    with open(summary_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return trace_path, summary_path
@@ -0,0 +1,156 @@
+"""
+Registry of the targets and container image buildspecs found on disk.
+
+Discovering targets means listing the in-tree target root and every
+directory given with --target-tree (or in the developer config), and looking
+for a <target>_spec.json in each subdirectory; likewise for buildspecs. Out-
+of-tree trees often live on network filesystems, where listing directories
+is slow, so the listings are kept in an index that persists across runs
+(.cache/targets.json). A directory is only listed again if its mtime has
+changed -- which it does whenever an entry is added to, removed from or
+renamed in it -- and at most once per process however many times it is
+looked at.
+
+The index is shared by all discovery code: see use_index() and get_index().
+"""
+
+import os
+import stat
+import time
+import atexit
+
+import utils
+import constants
+
+# most directories kept; the least recently listed go first
+MAX_DIRS = 1024
+# a listing taken within this long of the directory's last change is not
+# trusted: the directory may still have been changing within the mtime's
+# granularity (coarse on some filesystems).
+RACY_WINDOW_NS = 2 * 10**9
+
+_index = None
+
+class Index():
+    """
+    Persistent listings of directories, keyed by their absolute path, with
+    the mtime each was listed at.
+    :param path   the file the index is kept in, or None to keep it in
+                  memory only.
+    """
+    def __init__(self, path):
+        self.path     = path
+        self.lockfile = path + '.lock' if path else None
+        self.entries  = self.load()
+        self.updated  = {}
+        self.removed  = set()
+        self.checked  = set()   # directories known to be up to date in this process
+
+    def load(self):
+        if not self.path:
+            return {}
+        try:
+            return utils.load_json_from_file(self.path)
+        except (OSError, ValueError):
+            return {}
+
+    def listing(self, directory):
+        """
+        Return (subdirectories, files) of directory, as sorted lists of
+        names (symlinks being followed), or None if it is not a directory.
+        """
+        directory = os.path.abspath(directory)
+        entry = self.entries.get(directory)
+        if directory in self.checked:
+            return (entry['dirs'], entry['files']) if entry else None
+        self.checked.add(directory)
+        try:
+            st = os.stat(directory)
+        except OSError:
+            st = None
+        if st is None or not stat.S_ISDIR(st.st_mode):
+            if entry:
+                del self.entries[directory]
+                self.updated.pop(directory, None)
+                self.removed.add(directory)
+            return None
+        if entry and entry['mtime'] == st.st_mtime_ns and entry['mtime'] < entry['listed'] - RACY_WINDOW_NS:
+            return entry['dirs'], entry['files']
+
+        listed = time.time_ns()
+        dirs, files = [], []
+        with os.scandir(directory) as it:
+            for x in it:
+                try:
+                    if x.is_dir():
+                        dirs.append(x.name)
+                    elif x.is_file():
+                        files.append(x.name)
+                except OSError:
+                    # e.g. dangling symlinks
+                    continue
+        entry = {'mtime': st.st_mtime_ns, 'listed': listed, 'dirs': sorted(dirs), 'files': sorted(files)}
+        self.entries[directory] = self.updated[directory] = entry
+        self.removed.discard(directory)
+        return entry['dirs'], entry['files']
+
+    def is_target_dir(self, path):
+        """
+        True if path is a target directory, i.e. contains <basename>_spec.json.
+        """
+        listing = self.listing(path)
+        return bool(listing) and f'{os.path.basename(os.path.abspath(path))}_spec.json' in listing[1]
+
+    def targets_in(self, directory):
+        """
+        Return the paths of the target directories directly under directory.
+        """
+        listing = self.listing(directory)
+        if not listing:
+            return []
+        return [f'{directory}/{x}' for x in listing[0] if self.is_target_dir(f'{directory}/{x}')]
+
+    def buildspecs_in(self, directory):
+        """
+        Return the paths of the buildspec files directly under directory.
+        """
+        listing = self.listing(directory)
+        if not listing:
+            return []
+        return [f'{directory}/{x}' for x in listing[1] if x.endswith(constants.BUILDSPEC_SUFFIX)]
+
+    def save(self):
+        """
+        Merge the listings taken since loading into the file, evicting the
+        least recently listed ones beyond MAX_DIRS.
+        """
+        if not self.path or not (self.updated or self.removed):
+            return
+        try:
+            with utils.file_lock(self.lockfile):
+                entries = {**self.load(), **self.updated}
+                for directory in self.removed:
+                    entries.pop(directory, None)
+                if len(entries) > MAX_DIRS:
+                    entries = dict(sorted(entries.items(), key=lambda x: x[1]['listed'])[-MAX_DIRS:])
+                utils.dump_json_to_file(self.path, entries, indent=None)
+        except OSError as e:
+            utils.log(f"Failed to save the target index to {self.path}: {e}")
+            return
+        self.updated = {}
+        self.removed = set()
+
+def use_index(path):
+    """
+    Keep the index of this process in (and take the listings still up to
+    date from) the file at path. The index is saved when the process exits.
+    """
+    global _index
+    _index = Index(path)
+    atexit.register(_index.save)
+
+def get_index():
+    global _index
+    if _index is None:
+        _index = Index(None)
+    return _index
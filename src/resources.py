@@ -0,0 +1,165 @@
+"""
+Discovery of host resources and their division between builds running
+concurrently.
+"""
+
+import os
+import math
+
+import constants
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+# cgroup v1 reports no memory limit as a huge number rather than 'max'
+CGROUP_V1_UNLIMITED = 1 << 60
+
+def _read(path):
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def cgroup_dirs(controller):
+    """
+    Directories of the cgroups this process is in, the cgroup itself
+    first and then its ancestors, in the cgroup v2 hierarchy and in the
+    cgroup v1 hierarchy of controller (e.g. cpu, memory).
+    In a container the cgroup path in /proc/self/cgroup may not exist
+    under the cgroup mount (which is then the container's own cgroup):
+    only the directories that do exist are returned.
+    """
+    cgroups = _read('/proc/self/cgroup')
+    dirs = []
+    for line in (cgroups or '').splitlines():
+        try:
+            _, controllers, path = line.split(':', 2)
+        except ValueError:
+            continue
+        if not controllers:
+            base = CGROUP_ROOT
+        elif controller in controllers.split(','):
+            base = os.path.join(CGROUP_ROOT, controllers)
+            if not os.path.isdir(base):
+                base = os.path.join(CGROUP_ROOT, controller)
+        else:
+            continue
+        while True:
+            d = os.path.normpath(os.path.join(base, path.lstrip('/')))
+            if os.path.isdir(d) and d not in dirs:
+                dirs.append(d)
+            if path in ('', '/'):
+                break
+            path = os.path.dirname(path)
+    return dirs
+
+def cgroup_cpu_limit():
+    """
+    The number of cpus' worth of CPU time the cgroups of this process
+    allow it (i.e. the CFS quota divided by its period, as set by e.g.
+    docker run --cpus), or None if there is no limit.
+    """
+    limits = []
+    for d in cgroup_dirs('cpu'):
+        quota, _, period = (_read(f'{d}/cpu.max') or 'max').partition(' ')
+        if quota != 'max':
+            limits.append(int(quota) / int(period or 100000))
+        quota, period = _read(f'{d}/cpu.cfs_quota_us'), _read(f'{d}/cpu.cfs_period_us')
+        if quota and period and int(quota) > 0:
+            limits.append(int(quota) / int(period))
+    return min(limits) if limits else None
+
+def cgroup_memory_available():
+    """
+    Memory (in bytes) the cgroups of this process let it use on top of
+    what they use already, not counting reclaimable page cache as used,
+    or None if there is no limit.
+    """
+    available = []
+    for d in cgroup_dirs('memory'):
+        for limit_file, usage_file, cache_stat in (('memory.max', 'memory.current', 'inactive_file'),
+                                                   ('memory.limit_in_bytes', 'memory.usage_in_bytes', 'total_inactive_file')):
+            limit, usage = _read(f'{d}/{limit_file}'), _read(f'{d}/{usage_file}')
+            if not limit or not usage or limit == 'max' or int(limit) >= CGROUP_V1_UNLIMITED:
+                continue
+            cache = 0
+            for line in (_read(f'{d}/memory.stat') or '').splitlines():
+                name, _, value = line.partition(' ')
+                if name == cache_stat:
+                    cache = int(value)
+            available.append(max(0, int(limit) - int(usage) + cache))
+    return min(available) if available else None
+
+def available_cores():
+    """
+    Number of cores this process may run on: those of its cpuset (i.e.
+    affinity mask), unless its CPU quota is lower.
+    """
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    quota = cgroup_cpu_limit()
+    if quota:
+        cores = min(cores, max(1, math.ceil(quota)))
+    return cores
+
+def available_memory():
+    """
+    Memory (in bytes) available for starting new applications without
+    swapping, nor exceeding the memory limit of the cgroups of this process,
+    or None if this cannot be determined.
+    """
+    memory = None
+    try:
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    memory = int(line.split()[1]) * 1024
+                    break
+    except (OSError, ValueError, IndexError):
+        pass
+    limited = cgroup_memory_available()
+    if limited is not None:
+        memory = limited if memory is None else min(memory, limited)
+    return memory
+
+def auto_parallelism(memory_per_job=constants.MEMORY_PER_BUILD_JOB):
+    """
+    Work out the parallelism of a build (see --cores=auto) from the cores
+    and memory available.
+    :return   (jobs, load_limit): the number of jobs to run at once (make -j)
+              and the load average above which no new jobs should be
+              started (make -l), i.e. the number of cores available.
+    """
+    cores = available_cores()
+    return plan(1, cores, available_memory(), memory_per_job=memory_per_job)[0], cores
+
+def split(total, parts):
+    """
+    Split total into parts integer shares that differ by at most 1,
+    e.g. split(10, 3) -> [4, 3, 3].
+    """
+    share, remainder = divmod(total, parts)
+    return [share + 1 if i < remainder else share for i in range(parts)]
+
+def plan(num_builds, cores, memory=None,
+         min_cores=constants.MIN_CORES_PER_TARGET,
+         memory_per_job=constants.MEMORY_PER_BUILD_JOB):
+    """
+    Work out how to run num_builds builds within a budget of cores and memory.
+
+    The memory budget caps the number of jobs that can usefully run at
+    once (each job is assumed to need memory_per_job); the resulting job
+    budget is then divided into as many slots as there are builds, but
+    such that no slot has fewer than min_cores jobs. Builds beyond the
+    number of slots wait for a slot to become free.
+
+    :return   a list with the number of jobs (cores) assigned to each slot;
+              the length of the list is the number of builds to run
+              concurrently.
+    """
+    jobs = max(1, int(cores))
+    if memory is not None:
+        jobs = max(1, min(jobs, memory // memory_per_job))
+    slots = max(1, min(num_builds, jobs // max(1, min_cores)))
+    return split(jobs, slots)
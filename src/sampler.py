@@ -0,0 +1,98 @@
+"""
+Sampling of the resource usage of build containers (see --sample-interval).
+
+While a build container runs, a Stats_sampler thread reads its resource
+usage (see Container.stats()) every so often and records how many cores it
+kept busy, its memory use, block I/O and number of processes. The samples
+are written out as JSON lines next to the build log, graphed in the profile
+(when profiling, see profiler.py), and summed up at the end of the build:
+    average 3.1 of 16 cores busy (peak 15.8), ...
+which says more about how to set --cores than the wall time alone does.
+"""
+
+import json
+import threading
+
+import utils
+import profiler
+
+class Stats_sampler(threading.Thread):
+    """
+    :param container  the (running) container to sample.
+    :param path       file to write the samples to, one JSON object per line.
+    :param interval   seconds between samples; the container technology may
+                      not be able to sample more often than every second or so.
+    """
+    def __init__(self, container, path, interval):
+        # never keeps the builder from exiting
+        super().__init__(daemon=True, name="stats-sampler")
+        self.container = container
+        self.path      = path
+        self.interval  = interval
+        self.samples   = []
+        self.stopped   = threading.Event()
+
+    @staticmethod
+    def usage(prev, cur):
+        """
+        The usage over the time between the raw samples prev and cur.
+        """
+        elapsed = cur['system_ns'] - prev['system_ns']
+        # system_ns counts the CPU time of all cpus, busy or idle
+        busy = (cur['cpu_ns'] - prev['cpu_ns']) / elapsed * cur['cpus'] if elapsed > 0 else 0.0
+        return {
+                'time'       : round(cur['time'], 3),
+                'cpus_busy'  : round(max(0.0, busy), 2),
+                'cpus'       : cur['cpus'],
+                'memory'     : cur['memory'],
+                'memory_limit': cur['memory_limit'],
+                'io_read'    : cur['io_read'],
+                'io_write'   : cur['io_write'],
+                'pids'       : cur['pids'],
+                }
+
+    def run(self):
+        prev = None
+        try:
+            with open(self.path, 'w') as f:
+                for raw in self.container.stats():
+                    if self.stopped.is_set():
+                        break
+                    if prev and raw['time'] - prev['time'] < self.interval:
+                        continue
+                    if prev:
+                        sample = self.usage(prev, raw)
+                        f.write(json.dumps(sample) + '\n')
+                        f.flush()
+                        self.samples.append(sample)
+                        profiler.counter('cpus busy', {'cpus': sample['cpus_busy']}, sample['time'])
+                        profiler.counter('memory (MiB)', {'memory': sample['memory'] >> 20}, sample['time'])
+                        profiler.counter('processes', {'pids': sample['pids']}, sample['time'])
+                    prev = raw
+        except Exception as e:
+            # once the container is gone, so are its stats
+            if not self.stopped.is_set():
+                utils.log(f" > Container stats sampling stopped: {e}")
+
+    def stop(self):
+        """
+        Stop sampling, waiting a little for the last sample to be written.
+        """
+        self.stopped.set()
+        self.join(timeout=max(2, self.interval))
+
+    def summary(self):
+        """
+        A one-line summary of the samples taken, or None if there were none.
+        """
+        samples = self.samples
+        if not samples:
+            return None
+        busy = [x['cpus_busy'] for x in samples]
+        memory = max(x['memory'] for x in samples)
+        return (f"average {sum(busy) / len(busy):.1f} of {samples[-1]['cpus']} cores busy "
+                f"(peak {max(busy):.1f}); peak memory {memory / (1 << 20):.0f} MiB; "
+                f"block I/O {samples[-1]['io_read'] / (1 << 20):.0f} MiB read, "
+                f"{samples[-1]['io_write'] / (1 << 20):.0f} MiB written; "
+                f"at most {max(x['pids'] for x in samples)} processes "
+                f"[{len(samples)} samples]")
@@ -6,12 +6,26 @@ from abc import ABC, abstractmethod
 import pathlib
 import shutil
 import os
+import stat
 import sys
 import glob
+import json
+import hashlib
+import contextlib
 from datetime import datetime
 
 import utils
+import constants
 import containers
+import filetree
+import buildspec
+import artifacts
+import artifact_store
+import gitcache
+import dlcache
+import ccache
+import profiler
+import sampler
 
 class Sdk(ABC):
     """
@@ -85,16 +99,26 @@ class Concrete_sdk(Sdk):
         self.url      = spec["sdk_url"]
         self.tag      = spec["sdk_tag"]
         self.env      = spec['environment']['variables']
+        self.artifact_spec = spec.get("build_artifacts")
+        self.checkout_spec = spec.get("checkout") or {}
+        # commits of history to clone; 0 for all of it
+        self.clone_depth = self.checkout_spec.get("depth", constants.SDK_CLONE_DEPTH)
         self.paths    = pathmap
         self.dir_name = f"{self.name}_{self.tag}"
-        self.path     = pathlib.Path(f"{self.paths.sdk_path}/" + self.dir_name) # path to the sdk
         self.conf     = confvars
+        # in worktree mode each target has a checkout of its own on the host;
+        # it is still mounted at dir_name in the container
+        self.worktree = bool(confvars.get("sdk_worktree"))
+        checkout_name = f"{self.dir_name}_{self.target}" if self.worktree else self.dir_name
+        self.path     = pathlib.Path(f"{self.paths.sdk_path}/" + checkout_name) # path to the sdk
         self.build_type = confvars["sdk_build_type"]
         #self.docker = docker.from_env()
         self.containers        = containers.get_interface_to(self.conf['container_tech'])
-        self.inside_container = containers.inside_container()
+        self.inside_container = utils.inside_container()
         self.container_img_tag = f"{self.name}_{self.tag}:latest_{self.build_type}_{self.target}".lower()
         self.container = None
+        self.fingerprints = {}   # step -> fingerprint of its inputs
+        self.skipped_steps = set()   # steps found up to date
         self.set_start_timestamp()
 
     def is_inside_container(self):
@@ -122,13 +146,36 @@ class Concrete_sdk(Sdk):
 
         # if repo already cloned, then simply check out tag
         if pabs.exists() and utils.is_git_repo(str(pabs)):
-            cmd = f"git -C {pabs} checkout {self.tag}"
+            if self.checkout_spec.get("fetch"):
+                self.fetch_tag()
+                return
+            # a worktree cannot check out a branch already checked out by another.
+            # Inside the container self.worktree is not set: go by the checkout.
+            detach = " --detach" if self.is_worktree_checkout() else ""
+            cmd = f"git -C {pabs} checkout{detach} {self.tag}"
             utils.log(f"Running {cmd} ...")
             utils.run(cmd)
             return
+
+        # on the host, clone from the local mirror cache if at all possible
+        if not self.is_inside_container():
+            try:
+                self.clone_from_mirror()
+                return
+            except Exception as e:
+                utils.log(f"Failed to clone sdk repo from the local mirror, falling back to cloning directly: {e}")
+                shutil.rmtree(pabs, ignore_errors=True)
        
+        sparse_paths = self.checkout_spec.get("sparse_paths")
+        partial      = self.checkout_spec.get("filter")
         for url in self.url:
-            cmd  = f"git clone {url} --branch {self.tag} --depth 1 {pabs}"
+            cmd  = f"git clone {url} --branch {self.tag} {pabs}"
+            if self.clone_depth:
+                cmd += f" --depth {self.clone_depth}"
+            if partial:
+                cmd += f" --filter={partial}"
+            if sparse_paths:
+                cmd += " --no-checkout"
 
             if not self.path.exists():
                 self.path.mkdir(parents=True, exist_ok=True)
@@ -136,6 +183,8 @@ class Concrete_sdk(Sdk):
             try:
                 utils.log(f"Running {cmd} ...")
                 utils.run(cmd)
+                if sparse_paths:
+                    gitcache.checkout(str(pabs), self.tag, sparse_paths)
             except Exception as e:
                 utils.log(f"Failed to clone sdk repo. Command={cmd}, error={e}") 
                 shutil.rmtree(pabs)
@@ -143,7 +192,67 @@ class Concrete_sdk(Sdk):
                 # done as soon as one URL works
                 return
         raise RuntimeError(f"Failed to clone sdk repo. All urls failed. Urls: {self.url}")
+
+    def fetch_tag(self):
+        """
+        Bring the existing sdk checkout up to date with the tag (or branch):
+        fetch just that ref and check it out (detached). A failure to fetch
+        (e.g. when offline) is not fatal: the build goes ahead with what
+        is already checked out.
+        """
+        pabs = str(self.path.absolute())
+        try:
+            if self.worktree or self.is_worktree_checkout():
+                # the worktree's refs are the mirror's, which has no remote
+                # to fetch from: update it from the sdk URLs instead
+                refname = self.get_mirror().fetch(self.tag)
+                gitcache.checkout(pabs, refname, detach=True)
+                return
+            shallow = os.path.exists(f"{pabs}/.git/shallow")
+            # a partial clone fetches with its filter by itself
+            depth = f" --depth {self.clone_depth}" if shallow and self.clone_depth else ''
+            utils.run(f"git -C {pabs} fetch{depth} origin {self.tag}")
+            # not a merge: a shallow checkout shares no history with what
+            # was fetched ("refusing to merge unrelated histories")
+            utils.run(f"git -C {pabs} checkout --detach FETCH_HEAD")
+        except Exception as e:
+            utils.log(f"Failed to update sdk repo to the latest '{self.tag}', using it as is: {e}")
     
+    def clone_from_mirror(self):
+        """
+        Clone the sdk from its mirror in the host's git cache (see
+        gitcache.py), refreshing the mirror from whichever sdk URL responds
+        first. The clone is made locally from the mirror, so every
+        checkout after the first is a local operation.
+        In worktree mode, the checkout is a worktree of the mirror instead.
+        """
+        mirror = self.get_mirror()
+        sparse_paths = self.checkout_spec.get("sparse_paths")
+        if self.worktree:
+            utils.log(f" > Adding worktree of local mirror {mirror.path} for '{self.target}'")
+            mirror.add_worktree(self.tag, str(self.path.absolute()), sparse_paths)
+            return
+        utils.log(f" > Cloning sdk from local mirror {mirror.path}")
+        mirror.clone(self.tag, str(self.path.absolute()), origin=self.url[0],
+                     depth=self.clone_depth or None, sparse_paths=sparse_paths)
+
+    def is_worktree_checkout(self):
+        """
+        True if the sdk checkout is a worktree of the mirror (its .git is a
+        file), whether or not worktree mode is on in this process: the
+        builder in the container is not told about it.
+        """
+        return os.path.isfile(f"{self.path.absolute()}/.git")
+
+    def get_mirror(self):
+        cachedir = self.paths.get(context='host', label='gitcache')
+        if self.is_worktree_checkout():
+            # the mirror is wherever the worktree points, which is where it
+            # is mounted in the container too (see get_mounts())
+            _, common = utils.run(f"git -C {self.path.absolute()} rev-parse --git-common-dir", capture=True)
+            cachedir = os.path.dirname(os.path.join(self.path.absolute(), common.strip()))
+        return gitcache.Mirror(os.path.abspath(cachedir), self.url, self.checkout_spec.get("filter"))
+
     def get_env_vars(self, inherit=True):
         inherited   = dict(**os.environ if inherit else {})
         defaults    = self.conf.get("env_defaults")  or {}
@@ -157,9 +266,16 @@ class Concrete_sdk(Sdk):
         configured["BUILD_ARTIFACTS_OUTDIR"] = paths.outdir
         configured["PACKAGE_OUTDIR"] = self.paths.get(context='container', label='pkg_outdir')
         configured["NUM_BUILD_CORES"] = self.conf["num_build_cores"]
+        if self.conf.get("build_load_limit"):
+            configured["BUILD_LOAD_LIMIT"] = f'{self.conf["build_load_limit"]:g}'
         configured["PYTHONPATH"] = (os.getenv("PYTHONPATH") or '') + f':{paths.basedir}:{paths.src}'
         configured["CONFIGS_DIR"] = paths.files
         configured["SDK_TOPDIR"] = paths.sdk_path + self.dir_name
+        configured["DL_CACHE_DIR"] = paths.dlcache.rstrip('/')
+        if self.conf.get("ccache"):
+            configured.update(self.get_ccache().get_env_vars(paths.ccache.rstrip('/'), configured["SDK_TOPDIR"]))
+        if self.conf.get("profile"):
+            configured[profiler.ENV_VAR] = paths.profile_dumps.rstrip('/')
 
         return {**inherited, **defaults, **specifics, **configured, **overrides}
     
@@ -187,15 +303,135 @@ class Concrete_sdk(Sdk):
                 self.paths.get(context='container', label='basedir'),
                 'bind'
                 )
+        dl_cache = (
+                self.get_dl_cache().cachedir,
+                self.paths.get(context='container', label='dlcache'),
+                'bind'
+                )
         mounts += self.conf.get('mount_defaults') or {}
         mounts.append(sdk_root)
+        mounts.append(dl_cache)
+        caches = [dl_cache[0]]
+        if self.conf.get("ccache"):
+            caches.append(self.get_ccache().cachedir)
+            mounts.append((caches[-1], self.paths.get(context='container', label='ccache'), 'bind'))
+        # lets the builder in the container skip validating the specs the
+        # builder on the host has already validated
+        validation_cache = self.paths.get(context='host', label='validation_cache')
+        caches.append(validation_cache)
+        mounts.append((validation_cache, self.paths.get(context='container', label='validation_cache'), 'bind'))
+        # the worktree's .git file points into the mirror by absolute path
+        mirror = self.get_mirror().path
+        if self.worktree and os.path.isdir(mirror):
+            mounts.append((mirror, mirror, 'bind'))
         mounts.append(staging)
         mounts += self.conf.get('mount_overrides') or {}
-        return utils.validate_mounts(mounts) if validate else mounts
+        if not validate:
+            return mounts
+        # the caches are the builder's own: created when first mounted
+        # (and only then: not e.g. when the mounts are merely logged)
+        for cache in caches:
+            os.makedirs(cache, exist_ok=True)
+        return utils.validate_mounts(mounts)
+
+    def get_artifact_store(self):
+        """
+        The host's store of build artifacts (see artifact_store.py).
+        """
+        return artifact_store.Artifact_store(self.paths.get(context='host', label='artifact_store'))
+
+    def get_dl_cache(self):
+        """
+        The host's download cache for this sdk (see dlcache.py).
+        """
+        budget = self.conf.get("dl_cache_budget") or constants.DL_CACHE_BUDGET
+        return dlcache.Cache(self.paths.get(context='host', label='dlcache') + self.name, budget)
+
+    def get_ccache(self):
+        """
+        The host's compiler cache for this sdk (see ccache.py); one per
+        sdk name and tag, since that determines the toolchain.
+        """
+        budget = self.conf.get("ccache_budget") or constants.CCACHE_BUDGET
+        return ccache.Cache(self.paths.get(context='host', label='ccache') + self.dir_name, budget)
+
+    @contextlib.contextmanager
+    def tracking_caches(self):
+        """
+        Context manager to run container builds in: in dev builds, where the
+        download cache and compiler cache are mounted, reports their hits
+        and misses (and keeps the download cache within budget) afterwards.
+        """
+        with contextlib.ExitStack() as stack:
+            if self.build_type == "dev" and not self.is_inside_container():
+                stack.enter_context(self.get_dl_cache().tracking())
+                if self.conf.get("ccache"):
+                    stack.enter_context(self.get_ccache().tracking())
+            yield
+
+    @contextlib.contextmanager
+    def collecting_profile(self, container):
+        """
+        Context manager to run container builds in: when profiling, merges
+        the spans dumped by the processes run in container (see
+        get_env_vars()) afterwards.
+        """
+        if not profiler.is_enabled():
+            yield
+            return
+        try:
+            yield
+        finally:
+            try:
+                # the dumps are outside the sdk tree, hence never on the host
+                srcpath = self.get_env_vars(inherit=False)[profiler.ENV_VAR]
+                profiler.merge_dump_archive(self.containers.archive_from_container(container.id(), srcpath), 'container')
+            except Exception as e:
+                utils.log(f"Failed to collect the container's profile: {e}")
+
+    @contextlib.contextmanager
+    def sampling_stats(self, container):
+        """
+        Context manager to wait for the (running) container in: samples its
+        resource usage every sample_interval seconds (see sampler.py), if
+        set, and logs how well it was used afterwards.
+        """
+        interval = self.conf.get("sample_interval")
+        if not interval:
+            yield
+            return
+        path = self.paths.get(context='host', label='statslog')
+        stats_sampler = sampler.Stats_sampler(container, path, interval)
+        stats_sampler.start()
+        try:
+            yield
+        finally:
+            stats_sampler.stop()
+            summary = stats_sampler.summary()
+            if summary:
+                utils.log(f" > Container utilization: {summary}")
+                utils.log(f" > Container resource usage samples written to {path}")
+
+    def harvest_downloads(self, image):
+        """
+        Copy into the download cache whatever the automated build baked
+        into image downloaded that the cache does not have yet.
+        """
+        srcpath = self.paths.get(context='container', label='dlcache')
+        cache = self.get_dl_cache()
+        try:
+            cache.harvest(self.containers.archive_from_img(image, srcpath))
+        except Exception as e:
+            utils.log(f"Failed to harvest downloads from image {image}: {e}")
+            return
+        cache.evict()
 
     def run_scripts(self, path):
         scripts = utils.get_sorted_script_list(path)
-        utils.run_commands([f"./{script}" for script in scripts], env=self.get_env_vars(), verbose=self.conf["verbose"])
+        env = self.get_env_vars()
+        for script in scripts:
+            with profiler.span(os.path.basename(script), 'script', stage=path):
+                utils.run_commands([f"./{script}"], env=env, verbose=self.conf["verbose"])
 
     def build(self):
         sdk_type = self.conf["sdk_build_type"]
@@ -208,11 +444,34 @@ class Concrete_sdk(Sdk):
 
     def run_staged_build(self):
         stages = ["prebuild", "build", "postbuild"]
+        collector = self.get_artifact_collector()
         for stage in stages:
             time = datetime.now()
             time = time.strftime("%H:%M:%S")
             utils.log(f"============| Stage: {stage} [{time}] |============")
-            self.run_scripts("scripts/" + stage)
+            utils.flush_log()
+            if collector and stage == "build":
+                collector.snapshot()
+            with profiler.span(stage, 'stage'):
+                if collector and stage == "postbuild":
+                    collector.collect(self.get_env_vars()["BUILD_ARTIFACTS_OUTDIR"])
+                self.run_scripts("scripts/" + stage)
+
+    def get_artifact_collector(self):
+        """
+        Return an artifacts.Collector for the build_artifacts declared in the
+        target spec, or None if the target does not declare any (in which
+        case it is up to its postbuild scripts to retrieve artifacts).
+        The search root is relative to the top directory of the sdk and the
+        patterns can reference any of the environment variables the build
+        scripts get.
+        """
+        if not self.artifact_spec:
+            return None
+        env = self.get_env_vars()
+        root = os.path.join(env["SDK_TOPDIR"], self.artifact_spec["search_root"])
+        patterns = artifacts.expand_patterns(self.artifact_spec["patterns"], env)
+        return artifacts.Collector(root, patterns, self.artifact_spec.get("only_new", False))
 
     def build_only_firmware(self):
         utils.log("Restricted firmware-only build using prebuilt sdk .. ")
@@ -222,22 +481,9 @@ class Concrete_sdk(Sdk):
 
         environ = self.get_env_vars(inherit=False)
 
-        container = self.containers.new_container(self.container_img_tag, environ)
-        container.set_mounts(self.get_mounts())
-
-        cmd = self.paths.get('container', 'src') + self.conf['builder_entrypoint'] + f" -t {self.target} --cores={environ['NUM_BUILD_CORES']}"
-        utils.log(f"Starting container with cmd '{cmd}'")
-        container.run(cmd)
-
-        logs = container.logs()
-        for line in logs:
-            utils.log(line)
-        
-        errno = container.wait()
-        utils.log(f"container exited with exit code {errno}: '{os.strerror(errno)}'")
-        if errno:
-            sys.exit(errno)
-        self.container = container
+        cmd = self.paths.get('container', 'src') + self.conf['builder_entrypoint'] + f" -t {self.target} {self.parallelism_cli_flags()}"
+        cmd += ''.join(f" --force-step {x}" for x in self.conf.get("force_steps") or [])
+        self.run_build_container(environ, cmd)
 
     def build_single_packages(self, packages):
         utils.log(f" ** Restricted build for packages: {packages}")
@@ -251,21 +497,30 @@ class Concrete_sdk(Sdk):
         environ["PACKAGES_TO_BUILD"] = pkgs
         #utils.log(f"passing environment: {environ}")
         
-        container = self.containers.new_container(self.container_img_tag, environ)
-        container.set_mounts(self.get_mounts())
-    
         hook_runner = "run_hooks.py"
         hooks_dir    = self.paths.get(context='container', label='hooks')
         hook         = "build_packages"
         cmd  = hooks_dir + hook_runner + f" {hook}"
+        self.run_build_container(environ, cmd)
+
+    def run_build_container(self, environ, cmd):
+        """
+        Run cmd in a new container of the build image, with environ, and
+        wait for it to exit, logging its output; exit with its exit code if
+        that is not 0. Meanwhile the caches are tracked, the container's
+        resource usage sampled and its profile collected.
+        """
+        container = self.containers.new_container(self.container_img_tag, environ)
+        container.set_mounts(self.get_mounts())
 
         utils.log(f"Starting container with cmd '{cmd}'")
-        container.run(cmd)
-        logs = container.logs()
-        for line in logs:
-            utils.log(line)
-        errno = container.wait()
-        utils.log(f"container exitted with exit code {errno}: '{os.strerror(errno)}'")
+        with self.tracking_caches(), self.collecting_profile(container):
+            container.run(cmd)
+            with self.sampling_stats(container):
+                for batch in container.logs():
+                    utils.log_lines(line for _, line in batch)
+                errno = container.wait()
+        utils.log(f"container exited with exit code {errno}: '{os.strerror(errno)}'")
         if errno:
             sys.exit(errno)
         self.container = container
@@ -298,6 +553,17 @@ class Concrete_sdk(Sdk):
     def num_build_cores(self):
         return self.get_env_vars()["NUM_BUILD_CORES"]
 
+    def parallelism_cli_flags(self):
+        """
+        The builder options that make the builder in the container build
+        with the same parallelism as this one.
+        """
+        env = self.get_env_vars(inherit=False)
+        flags = f"--cores={env['NUM_BUILD_CORES']}"
+        if env.get("BUILD_LOAD_LIMIT"):
+            flags += f" --load-limit={env['BUILD_LOAD_LIMIT']}"
+        return flags
+
     def build_container_image(self, short_circuit=False):
         sdk_build_type = self.conf['sdk_build_type']
 
@@ -308,10 +574,13 @@ class Concrete_sdk(Sdk):
         short_circuit = short_circuit or sdk_build_type == 'dev'
 
         nocache = True if self.conf["start_clean"] else False
+        # paths as seen from the root of the build context
+        staging_dir = self.paths.get(context='staging', label='basedir')
+        context_dir = f'./{constants.BUILD_CONTEXT_STAGING_DIR}/'
         sdk_configs = self.paths.get(context='staging', label='sdk_configs')
         system_configs = self.paths.get(context='staging', label='system_configs')
-        sdk_configs = sdk_configs.replace(self.paths.basedir, './')
-        system_configs = system_configs.replace(self.paths.basedir, './')
+        sdk_configs = sdk_configs.replace(staging_dir, context_dir)
+        system_configs = system_configs.replace(staging_dir, context_dir)
         build_args = {
                 "UID"     : str(os.getuid()),
                 "GID"     : str(os.getgid()),
@@ -320,40 +589,143 @@ class Concrete_sdk(Sdk):
                 "SDK_DIRNAME" : self.dir_name,
                 "TARGET" : self.target,
                 "QUIET_MODE_CLI_FLAG" : not self.conf["verbose"] and "--quiet" or "",
-                "NUM_BUILD_CORES_CLI_FLAG" : "--cores=" + self.num_build_cores(),
+                "NUM_BUILD_CORES_CLI_FLAG" : self.parallelism_cli_flags(),
                 "BUILD_ARTIFACTS_OUTDIR" : self.paths.get(context='container', label='outdir'),
                 "DEV_BUILD_CLI_FLAG" : (self.conf["sdk_build_type"] == "dev") and "-d" or "",
                 "SHORT_CIRCUIT_MAGIC_CLI_FLAG": ("--skip-all" if short_circuit else ""),
                 "SYSTEM_CONFIGS": system_configs,
                 "SDK_CONFIGS": sdk_configs,
                 }
-        utils.log("BUILD_ARGS: ", build_args)
+        # the builder run in the image build is profiled too. Its dumps are
+        # printed to the build output and removed in the same step (see the
+        # buildspecs), so that they never get into the image; the build arg
+        # is kept out of the fingerprint, so an existing image is reused as
+        # is -- its build just goes unprofiled. Profiling does change the
+        # cache key of the layer the builder runs in, which is rebuilt.
+        profile_args = {}
+        if self.conf.get("profile") and not short_circuit:
+            profile_args[profiler.ENV_VAR] = self.paths.get(context='container', label='profile_dumps').rstrip('/')
+        utils.log("BUILD_ARGS: ", {**build_args, **profile_args})
 
         # we use the recipe from the staging dir
-        specs_dir = self.paths.get(context='staging', label='specs')
+        buildspecs_dir = self.paths.get(context='staging', label='buildspecs')
         var = self.conf["container_image_recipe"]
-        container_image_recipe = f'{specs_dir}/container_image_buildspec/{var}'
-
-        utils.log(f"Building docker image with tag: {self.container_img_tag}")
-
-        # NOTE: we can bind-mount directories from the host when running a
-        # container, but NOT when building an image. In other words, paths
-        # can only be bind-mounted into containers, not images. This means
-        # if any hooks are invoked during the image-build stage of the
-        # dev-build -type configuration, they would to handle this case i.e.
-        # they will not have an SDK_TOPDIR to operate on.
-        # To avoid this sort of confusion, dev-build -type builds always
-        # specify SHORT_CIRCUIT_MAGIC_CLI_FLAG=true.
-        stream = self.containers.build_image(
-                nocache,
-                self.paths.basedir,
-                container_image_recipe,
-                tag = self.container_img_tag,
-                **build_args
-                )
-        for line in stream:
-            utils.log(line)
+        container_image_recipe = buildspecs_dir.replace(staging_dir, f'{constants.BUILD_CONTEXT_STAGING_DIR}/') + var
+
+        # The image is identified by what goes into it rather than by
+        # target: if an image with the same fingerprint already exists
+        # it is simply (re)tagged for this target and nothing is built.
+        # Targets with identical inputs thereby share one image.
+        fingerprint_args = {k: v for k, v in build_args.items() if k not in constants.IMAGE_FINGERPRINT_ARG_EXCLUDE}
+        exclude = []
+        if self.has_target_agnostic_image(buildspecs_dir + var, short_circuit):
+            fingerprint_args.pop("TARGET", None)
+            exclude = self.get_target_only_paths()
+        fingerprint = buildspec.fingerprint(buildspecs_dir + var, staging_dir, fingerprint_args,
+                                            context_prefix=constants.BUILD_CONTEXT_STAGING_DIR,
+                                            exclude=exclude)
+        utils.log(f" > Container image fingerprint: {fingerprint}")
+        self.fingerprints["build_container_image"] = fingerprint
+        # Serialize on the fingerprint so that concurrent builds needing the
+        # same image (e.g. multiple targets built at once) build it only once.
+        lockfile = self.paths.get(context='host', label='locks') + f'image_{fingerprint}.lock'
+        with utils.file_lock(lockfile):
+            if not nocache:
+                existing = self.containers.find_image(constants.IMAGE_FINGERPRINT_LABEL, fingerprint)
+                if existing:
+                    utils.log(f" > Up-to-date image {existing} found: tagging as {self.container_img_tag}, skipping build")
+                    self.containers.tag_image(existing, self.container_img_tag)
+                    return
+
+            build_context = self.get_build_context()
+            content_tag = f"{self.name}_{self.tag}:{self.build_type}_{fingerprint[:constants.IMAGE_FINGERPRINT_TAG_LENGTH]}".lower()
+            utils.log(f"Building docker image with tag: {content_tag}")
+
+            # NOTE: we can bind-mount directories from the host when running a
+            # container, but NOT when building an image. In other words, paths
+            # can only be bind-mounted into containers, not images. This means
+            # if any hooks are invoked during the image-build stage of the
+            # dev-build -type configuration, they would to handle this case i.e.
+            # they will not have an SDK_TOPDIR to operate on.
+            # To avoid this sort of confusion, dev-build -type builds always
+            # specify SHORT_CIRCUIT_MAGIC_CLI_FLAG=true.
+            stream = self.containers.build_image(
+                    nocache,
+                    build_context,
+                    container_image_recipe,
+                    tag = content_tag,
+                    labels = {constants.IMAGE_FINGERPRINT_LABEL: fingerprint},
+                    **build_args,
+                    **profile_args
+                    )
+            for line in stream:
+                if not profiler.merge_dump_line(line, 'image build'):
+                    utils.log(line)
+            self.containers.tag_image(content_tag, self.container_img_tag)
+            if not short_circuit:
+                self.harvest_downloads(content_tag)
         print(f"----- docker image build done")
+
+    def has_target_agnostic_image(self, recipe, short_circuit):
+        """
+        True if what the target contributes to the image built from recipe
+        makes no difference: in dev builds, as long as the image build does
+        not build the target (i.e. the recipe honours the short circuit),
+        the only use of the staging dir copied into the image is to be
+        hidden by the staging dir mounted over it (see get_mounts()).
+        """
+        if self.build_type != "dev" or not short_circuit:
+            return False
+        declared = buildspec.declared_args(buildspec.parse_instructions(recipe))
+        return "SHORT_CIRCUIT_MAGIC_CLI_FLAG" in declared
+
+    def get_target_only_paths(self):
+        """
+        Return the paths, relative to the staging dir, of what only this
+        target puts there: its directory in the spec tree and the files it
+        layers over the common ones (see populate_staging_dir()).
+        """
+        staging = self.paths.clone(context='staging')
+        target_dir = self.conf["specs_overlay"].target_dir(self.target)
+        paths = [os.path.join(os.path.relpath(staging.tgroot, staging.basedir), self.target)]
+        for top in ("files", "scripts"):
+            if not os.path.isdir(f"{target_dir}/{top}"):
+                continue
+            # files only: the directories are shared with the common files
+            for relpath, st in filetree.walk_sorted(f"{target_dir}/{top}"):
+                if not stat.S_ISDIR(st.st_mode):
+                    paths.append(os.path.join(top, relpath))
+        return paths
+
+    def get_build_context(self):
+        """
+        Return the path to a tar archive to be used as the container image
+        build context. The archive contains nothing but the staging dir,
+        (which includes the buildspec files) under
+        constants.BUILD_CONTEXT_STAGING_DIR -- in particular, not the sdk
+        checkout, out/, .tmp/ etc that may be found under the project root.
+
+        Archives are cached on the host keyed by the fingerprint of the
+        staging dir, so an unchanged context is never archived twice.
+        """
+        staging_dir = self.paths.get(context='staging', label='basedir')
+        cache_dir = self.paths.get(context='host', label='build_context_cache')
+        os.makedirs(cache_dir, exist_ok=True)
+
+        fingerprint = filetree.tree_fingerprint(staging_dir)
+        context = f'{cache_dir}{fingerprint}.tar'
+        if os.path.isfile(context):
+            utils.log(f" > Reusing cached build context {context}")
+            os.utime(context)
+        else:
+            utils.log(f" > Creating build context {context}")
+            filetree.archive_tree(staging_dir, constants.BUILD_CONTEXT_STAGING_DIR, context)
+
+        # evict the least recently used archives
+        cached = sorted(glob.glob(f'{cache_dir}*.tar'), key=os.path.getmtime, reverse=True)
+        for path in cached[constants.BUILD_CONTEXT_CACHE_SIZE:]:
+            os.remove(path)
+        return context
     
 
     def populate_staging_dir(self):
@@ -366,17 +738,15 @@ class Concrete_sdk(Sdk):
         
         The process is the following:
         - targets and dockerfiles ('container image buildspec files') can be
-          either in-tree or out-of-tree. Therefore prior to validation,
-          or listing all targets etc, all the in-tree files are copied
-          under .tmp, and all out-of-tree files are copied on top of them
-          to the same place.
-        The staging dir is then populated.
+          either in-tree or out-of-tree. The spec overlay (see overlay.py)
+          tells where each comes from, without copying anything.
+        The staging dir is then populated (incrementally: see below).
         - some basic common files (sdk- and target- agnostic) are copied to the
           staging dir from the in-tree paths
         - sdk-specific files are copied on top from the in-tree paths
         - schemas, dockerfiles, and target-specific files are copied on top from
-          the in-tree paths if the target is in-tree, else they get copied
-          from .tmp, as explained earlier.
+          wherever the spec overlay says they come from; the schemas it
+          patches are written out from memory.
 
         The staging dir contents will then end up at the root of the 'basedir'
         inside the container. Note that under the container basedir there will
@@ -387,65 +757,70 @@ class Concrete_sdk(Sdk):
         various file trees as explained earlier. Some of these directories
         are exposed via environment variables to scripts that run as part
         of stages or hooks e.g. 'CONFIGS_DIR' is basedir/files. etc.
+
+        The staging dir is not wiped and recreated on every call. Instead,
+        the final merged tree is first computed as a manifest and the
+        staging dir is then synced to it: only files that are missing or
+        differ get copied and stale files get removed. Unchanged files
+        are left alone (mtimes included) so that e.g. the container
+        engine's build cache is not needlessly invalidated.
         """
         current  = self.paths
         staging  = current.clone(context='staging')
-        tmp = current.clone(context='tmp')
+        specs_overlay = self.conf["specs_overlay"]
 
-        shutil.rmtree(staging.basedir, ignore_errors=True)
-        os.mkdir(staging.basedir)
+        # the merged view of all the layers is worked out in memory first;
+        # only what differs from the current contents of the staging dir
+        # then gets written to disk.
+        manifest = filetree.Manifest(staging.basedir)
 
         # basic sdk files to continue inside container
-        utils.cp_dir(current.depends, staging.depends, just_contents=True)
-        utils.cp_dir(current.steps_dir, staging.steps_dir, just_contents=True)
-        utils.cp_file(current.env_defaults, staging.common + 'specs/', must_exist=True)
-        utils.cp_file(current.common_hooks + "run_hooks.py", staging.hooks, must_exist=True)
+        manifest.add_dir(current.depends, staging.depends, just_contents=True)
+        manifest.add_dir(current.steps_dir, staging.steps_dir, just_contents=True)
+        manifest.add_file(current.env_defaults, staging.common + 'specs/', must_exist=True)
+        manifest.add_file(current.common_hooks + "run_hooks.py", staging.hooks, must_exist=True)
 
         # common build materials
-        utils.cp_dir(current.common_files + f"system_config/common", staging.files + "system_config", just_contents=True)
-        utils.cp_dir(current.common_files + f"sdk_config/common", staging.files + "system_config", just_contents=True)
-        utils.cp_dir(current.common_scripts + "prebuild/common", staging.scripts + "prebuild", just_contents=True)
-        utils.cp_dir(current.common_scripts + "build/common", staging.scripts + "build", just_contents=True)
-        utils.cp_dir(current.common_scripts + "postbuild/common", staging.scripts + "postbuild", just_contents=True)
-        utils.cp_dir(current.common_hooks + "prepare_system/common", staging.hooks + "prepare_system", just_contents=True)
-        utils.cp_dir(current.common_hooks + "prepare_sdk/common", staging.hooks + "prepare_sdk", just_contents=True)
-        utils.cp_dir(current.common_hooks + "install_configs/common", staging.hooks + "install_configs", just_contents=True)
-        utils.cp_dir(current.common_hooks + "build_packages/common", staging.hooks + "build_packages", just_contents=True)
+        manifest.add_dir(current.common_files + f"system_config/common", staging.files + "system_config", just_contents=True)
+        manifest.add_dir(current.common_files + f"sdk_config/common", staging.files + "system_config", just_contents=True)
+        manifest.add_dir(current.common_scripts + "prebuild/common", staging.scripts + "prebuild", just_contents=True)
+        manifest.add_dir(current.common_scripts + "build/common", staging.scripts + "build", just_contents=True)
+        manifest.add_dir(current.common_scripts + "postbuild/common", staging.scripts + "postbuild", just_contents=True)
+        manifest.add_dir(current.common_hooks + "prepare_system/common", staging.hooks + "prepare_system", just_contents=True)
+        manifest.add_dir(current.common_hooks + "prepare_sdk/common", staging.hooks + "prepare_sdk", just_contents=True)
+        manifest.add_dir(current.common_hooks + "install_configs/common", staging.hooks + "install_configs", just_contents=True)
+        manifest.add_dir(current.common_hooks + "build_packages/common", staging.hooks + "build_packages", just_contents=True)
         
         # sdk-specific materials; can but shouldn't override (conflict with)
         # files already copied that are common to all SDKs
-        utils.cp_dir(current.common_files + f"system_config/{self.name}", staging.files + "system_config", just_contents=True)
-        utils.cp_dir(current.common_files + f"sdk_config/{self.name}", staging.files + "sdk_config", just_contents=True)
-        utils.cp_dir(current.common_scripts + f"prebuild/{self.name}", staging.scripts + "prebuild", just_contents=True)
-        utils.cp_dir(current.common_scripts + f"build/{self.name}", staging.scripts + "build", just_contents=True)
-        utils.cp_dir(current.common_scripts + f"postbuild/{self.name}", staging.scripts + "postbuild", just_contents=True)
-        utils.cp_dir(current.common_hooks + f"build_packages/{self.name}", staging.scripts + "hooks/build_packages", just_contents=True)
-        utils.cp_dir(current.common_hooks + f"install_configs/{self.name}", staging.scripts + "hooks/install_configs", just_contents=True)
-        utils.cp_dir(current.common_hooks + f"prepare_system/{self.name}", staging.scripts + "hooks/prepare_system", just_contents=True)
-        utils.cp_dir(current.common_hooks + f"prepare_sdk/{self.name}", staging.scripts + "hooks/prepare_sdk", just_contents=True)
-
-        # overrides or target-specific files
-        if os.path.exists(current.tgspec):
-            utils.cp_dir(current.target_files, staging.basedir)
-            utils.cp_dir(current.target_scripts, staging.basedir)
-        else:
-            assert(os.path.exists(tmp.tgspec))
-            # out-of-tree files, IFF the target is defined out-of-tree.
-            # -- the targets.enum schema
-            # -- the buildspecs.enum schema
-            # -- the target configuration
-            
-            # copy these files so the final merged file tree for the target
-            # is complete inside the container (files, scripts etc)
-            utils.cp_dir(tmp.target_files, staging.basedir)
-            utils.cp_dir(tmp.target_scripts, staging.basedir)
-
-        # copy these files (potentially-patched schema files) so the
-        # schema-validation logic works in the container
-        utils.cp_dir(tmp.specs, staging.specs, empty_first=False, just_contents=True)
-
-        # cp all source scripts
-        utils.cp_dir(f'{current.src}/', f'{staging.src}/', empty_first=False, just_contents=True)
+        manifest.add_dir(current.common_files + f"system_config/{self.name}", staging.files + "system_config", just_contents=True)
+        manifest.add_dir(current.common_files + f"sdk_config/{self.name}", staging.files + "sdk_config", just_contents=True)
+        manifest.add_dir(current.common_scripts + f"prebuild/{self.name}", staging.scripts + "prebuild", just_contents=True)
+        manifest.add_dir(current.common_scripts + f"build/{self.name}", staging.scripts + "build", just_contents=True)
+        manifest.add_dir(current.common_scripts + f"postbuild/{self.name}", staging.scripts + "postbuild", just_contents=True)
+        manifest.add_dir(current.common_hooks + f"build_packages/{self.name}", staging.scripts + "hooks/build_packages", just_contents=True)
+        manifest.add_dir(current.common_hooks + f"install_configs/{self.name}", staging.scripts + "hooks/install_configs", just_contents=True)
+        manifest.add_dir(current.common_hooks + f"prepare_system/{self.name}", staging.scripts + "hooks/prepare_system", just_contents=True)
+        manifest.add_dir(current.common_hooks + f"prepare_sdk/{self.name}", staging.scripts + "hooks/prepare_sdk", just_contents=True)
+
+        # overrides or target-specific files, in-tree or out-of-tree;
+        # so the final merged file tree for the target is complete
+        # inside the container (files, scripts etc)
+        target_dir = specs_overlay.target_dir(self.target)
+        manifest.add_dir(f'{target_dir}/files', staging.basedir)
+        manifest.add_dir(f'{target_dir}/scripts', staging.basedir)
+
+        # the overlay (out-of-tree targets and buildspecs, patched schema
+        # files) so the schema-validation logic works in the container
+        specs_overlay.add_to_manifest(manifest, staging.specs)
+
+        # cp all source scripts (but not the bytecode compiled from them)
+        manifest.add_dir(f'{current.src}/', f'{staging.src}/', just_contents=True)
+        manifest.remove(f'{staging.src}/__pycache__')
+
+        stats = manifest.sync()
+        utils.log(f" > Staging dir synced: {stats['copied']} copied, "
+                  f"{stats['unchanged']} unchanged, {stats['removed']} removed")
 
     def system_prepare(self):
         pass
@@ -455,7 +830,8 @@ class Concrete_sdk(Sdk):
         hooks_dir = self.paths.hooks
         cmd  = hooks_dir + script_name + f" {hook}"
         utils.log(f" => [Hook runner] {cmd}")
-        utils.run(cmd, env=self.get_env_vars())
+        with profiler.span(hook, 'hook'):
+            utils.run(cmd, env=self.get_env_vars())
 
     def install_configs(self):
         self.run_hook("install_configs")
@@ -474,6 +850,162 @@ class Concrete_sdk(Sdk):
         if not callable(method):
             raise TypeError(errmsg)
         method()
+
+    def run_step(self, step, upstream=None):
+        """
+        Execute step (see execute_task()) unless it is up to date i.e. it
+        last succeeded with exactly the same inputs (see get_step_inputs())
+        and upstream fingerprints. A stamp with the fingerprint is recorded
+        when the step succeeds. Stamps are ignored for steps listed in the
+        'force_steps' confvar and when starting clean.
+
+        :param upstream   a dict of the fingerprints of the steps this step
+                          depends on (as returned by this method).
+        :return           the fingerprint of the step, or None if it has none.
+        """
+        if step not in constants.STAMPED_STEPS:
+            self.execute_task(step)
+            return self.fingerprints.get(step)
+
+        fingerprint = self.get_step_fingerprint(step, upstream)
+        stamp = self.get_stamps_dir() + step
+        forced = set(self.conf.get("force_steps") or []) & {step, 'all'}
+        # fetching the latest sdk tag is the whole point of the step then
+        forced = forced or (step == "checkout" and self.checkout_spec.get("fetch"))
+        if self.conf["start_clean"] or forced:
+            utils.log(f" > Ignoring stamp for step '{step}'")
+        elif self.read_stamp(stamp) == fingerprint and self.has_step_outputs(step, fingerprint):
+            utils.log(f" > Step '{step}' is up to date (fingerprint {fingerprint[:12]}), skipping")
+            self.fingerprints[step] = fingerprint
+            self.skipped_steps.add(step)
+            return fingerprint
+
+        # no stamp while the step is in progress: if it fails midway,
+        # it must not be considered up to date next time around.
+        if os.path.exists(stamp):
+            os.remove(stamp)
+        self.execute_task(step)
+        if self.is_inside_container():
+            self.exclude_from_sdk_tree(constants.SDK_STAMPS_DIR)
+        os.makedirs(os.path.dirname(stamp), exist_ok=True)
+        with open(stamp + '.tmp', 'w') as f:
+            f.write(fingerprint + '\n')
+        os.replace(stamp + '.tmp', stamp)
+        self.fingerprints[step] = fingerprint
+        return fingerprint
+
+    def get_stamps_dir(self):
+        if self.is_inside_container():
+            return f"{self.path}/{constants.SDK_STAMPS_DIR}/"
+        return self.paths.get(context='host', label='stamps') + f"{self.target}/{self.build_type}/"
+
+    @staticmethod
+    def read_stamp(path):
+        try:
+            with open(path, 'r') as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
+
+    def has_step_outputs(self, step, fingerprint=None):
+        """
+        Whether what a previous run of step (with inputs fingerprint) produced
+        is still there.
+        """
+        if step == "build":
+            # the artifacts are retrieved after the build: inside the
+            # container they only exist as long as the container (and the
+            # builder empties the output directory first anyway), while on
+            # the host retrieve_build_artifacts() republishes those of the
+            # build skipped, which must therefore be in the artifact store.
+            if self.is_inside_container():
+                return False
+            if not self.get_artifact_store().find_build(self.target, fingerprint):
+                return False
+        if step in ("checkout", "build"):
+            return utils.is_git_repo(str(self.path.absolute()))
+        return True
+
+    def exclude_from_sdk_tree(self, name):
+        """
+        Have git ignore name (a directory of ours at the top of the sdk
+        checkout) so it does not show up as a modification of the sdk tree.
+        """
+        path = str(self.path.absolute())
+        if not utils.is_git_repo(path):
+            return
+        # in a worktree .git is a file: ask git where the exclude file is
+        _, exclude = utils.run(f"git -C {path} rev-parse --git-path info/exclude", capture=True)
+        exclude = os.path.join(path, exclude.strip())
+        line = f"/{name}/"
+        try:
+            with open(exclude, 'r') as f:
+                if line in f.read().splitlines():
+                    return
+        except FileNotFoundError:
+            pass
+        os.makedirs(os.path.dirname(exclude), exist_ok=True)
+        with open(exclude, 'a') as f:
+            f.write(line + '\n')
+
+    def get_sdk_tree_state(self):
+        """
+        Return a string describing the state of the sdk working tree: the
+        commit checked out and the digest of any local modifications git
+        can see. This catches changes made to the sdk sources themselves
+        (e.g. in dev builds) between runs.
+        """
+        path = str(self.path.absolute())
+        if not utils.is_git_repo(path):
+            return None
+        _, head = utils.run(f"git -C {path} rev-parse HEAD", capture=True)
+        # our own directories in the tree (stamps) are not sdk modifications
+        exclude = f"':(exclude){constants.SDK_STAMPS_DIR}'"
+        _, status = utils.run(f"git -C {path} status --porcelain -- . {exclude}", capture=True)
+        _, diff = utils.run(f"git -C {path} diff HEAD", capture=True)
+        return f"{head.strip()} {hashlib.sha256((status + diff).encode()).hexdigest()}"
+
+    def get_step_inputs(self, step):
+        """
+        Return a dict of everything the outcome of step depends on.
+        Staged files are taken from the container base directory when
+        running inside the container and from the staging directory
+        otherwise -- either way, what the step will actually use.
+        """
+        ctx = 'container' if self.is_inside_container() else 'staging'
+        scripts = self.paths.get(context=ctx, label='scripts')
+        hooks   = self.paths.get(context=ctx, label='hooks')
+        files   = self.paths.get(context=ctx, label='files')
+        env = {k: v for k, v in self.get_env_vars(inherit=False).items()
+               if k not in constants.STEP_FINGERPRINT_ENV_EXCLUDE}
+
+        inputs = {
+                "step": step,
+                "target": self.target,
+                "sdk": [self.name, self.tag, self.url],
+                "build_type": self.build_type,
+                }
+        if step == "checkout":
+            inputs["checkout"] = self.checkout_spec
+            return inputs
+        inputs["env"] = env
+        if step == "prepare_system":
+            inputs["hooks"] = filetree.content_fingerprint(hooks + step)
+            inputs["system_configs"] = filetree.content_fingerprint(files + "system_config")
+        elif step == "install_configs":
+            inputs["hooks"] = filetree.content_fingerprint(hooks + step)
+            inputs["files"] = filetree.content_fingerprint(files)
+        elif step == "build":
+            inputs["scripts"] = filetree.content_fingerprint(scripts)
+            inputs["files"] = filetree.content_fingerprint(files)
+            inputs["artifacts"] = self.artifact_spec
+            inputs["sdk_tree"] = self.get_sdk_tree_state()
+        return inputs
+
+    def get_step_fingerprint(self, step, upstream=None):
+        inputs = self.get_step_inputs(step)
+        inputs["upstream"] = upstream or {}
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode()).hexdigest()
     
     def get_time_string(self):
         time = datetime.now()
@@ -487,35 +1019,86 @@ class Concrete_sdk(Sdk):
             f.write(s + '\n')
 
     def retrieve_build_artifacts(self, source_path=None, archive_prefix=None):
-        outpath = self.paths.outdir + f"{self.conf['build_artifacts_archive_name']}.tar"
+        """
+        Add the artifacts of the build (along with the build log and
+        timestamp) to the artifact store, record the build in a manifest
+        and check its files out into out/<build_artifacts_archive_name>/.
+        Also export them as out/<build_artifacts_archive_name>.tar, or as
+        a compressed tarball (see --export-artifacts).
+        See artifact_store.py.
+        """
+        name = self.conf['build_artifacts_archive_name']
+        store = self.get_artifact_store()
+        # the checkout directory is emptied first: it must not be (nor
+        # hold, nor be in) the store
+        checkout_dir, store_root = (os.path.abspath(x) for x in (self.paths.outdir + name, store.root))
+        if os.path.commonpath([checkout_dir, store_root]) in (checkout_dir, store_root):
+            raise ValueError(f"build_artifacts_archive_name '{name}' clashes with the artifact store in {store.root}")
         srcpath = source_path or self.paths.get(context='container', label='outdir')
         arch_prefix = archive_prefix or utils.get_last_path_component(srcpath)
+        stream = None
 
+        # NOTE: nothing is actually copied until the stream is consumed below.
         if self.conf["sdk_build_type"] == "automated":
             if self.container:
                 utils.log(" ~ Copying artifacts from scope-restricted build..")
                 if not self.containers.container_exists(self.container.id()):
                     raise containers.ContainerNotFound("No suitable container found. Try full/clean build?")
-                self.containers.cp_from_container(self.container.id(), srcpath, outpath, remove_container=True)
+                stream = self.containers.archive_from_container(self.container.id(), srcpath, remove_container=True)
             else:
                 utils.log(" ~ Copying full build artifacts..")
                 if not self.containers.image_exists(self.container_img_tag):
                     raise containers.ImageNotFound("No suitable image found.")
-                self.containers.cp_from_img(self.container_img_tag, srcpath, outpath)
+                stream = self.containers.archive_from_img(self.container_img_tag, srcpath)
         else:
             if self.container:
                 utils.log(" ~ Copying artifacts from scope-restricted build [dev container] ..")
                 if not self.containers.container_exists(self.container.id()):
                     raise containers.ContainerNotFound("No suitable container found. Try full/clean build?")
-                self.containers.cp_from_container(self.container.id(), srcpath, outpath, remove_container=True)
+                stream = self.containers.archive_from_container(self.container.id(), srcpath, remove_container=True)
        
         self.set_end_timestamp()
-        utils.log(f"Artifacts bundled in {outpath}")
-        utils.append_to_tarball(outpath,
-                self.paths.buildlog,
-                self.paths.timestamp,
-                prefix=arch_prefix
-                )
+        previous = None
+        if stream is None and "build" in self.skipped_steps:
+            # nothing was built: republish the artifacts of the build that
+            # was up to date (see has_step_outputs())
+            previous = store.find_build(self.target, self.fingerprints.get("build"))
+            if not previous:
+                raise LookupError(f"The build of {self.target} was skipped as up to date but its artifacts "
+                                  f"are not in {store.root}: use --force-step build")
+            utils.log(f" ~ Build skipped: republishing the artifacts of build {previous['id']}")
+        utils.log(f"Storing artifacts in {store.root}")
+        # the build log goes into the bundle: it must be complete
+        utils.flush_log()
+        extra_files = [self.paths.buildlog, self.paths.timestamp]
+        with store.ingesting():
+            records = store.add_stream(stream) if stream is not None else {}
+            if previous:
+                records = {x['path']: {k: v for k, v in x.items() if k != 'path'} for x in previous['files']}
+            # these take precedence over any files of the same name in the stream
+            records.update(store.add_files({os.path.basename(x): x for x in extra_files if os.path.isfile(x)}))
+            manifest = store.write_manifest(self.target, {
+                    'sdk'       : self.name,
+                    'sdk_tag'   : self.tag,
+                    'build_type': self.conf['sdk_build_type'],
+                    'archive_name': name,
+                    # what the build was made from (see run_step())
+                    'build_fingerprint': self.fingerprints.get("build"),
+                    }, records)
+        utils.log(f" ~ Build {manifest['id']}: {len(records)} file(s), {store.added >> 20} MiB, "
+                  f"of which {store.stored >> 20} MiB not stored before")
+        outdir = store.checkout(manifest, checkout_dir)
+        utils.log(f" ~ Artifacts checked out in {outdir}")
+
+        export = self.conf.get('export_artifacts')
+        if export:
+            utils.log(f"Exporting artifacts as {export} ...")
+            utils.log(f" ~ Exported {store.export(manifest, self.paths.outdir + name, export, arch_prefix)}")
+
+        pruned = store.prune(constants.ARTIFACT_STORE_KEEP)
+        if pruned and any(pruned):
+            utils.log(f" ~ Artifact store pruned: {pruned[0]} manifest(s), {pruned[1]} object(s), "
+                      f"{pruned[2] >> 20} MiB freed")
 
 class OpenWrt_sdk(Concrete_sdk):
     def __init__(self, spec, paths, configs):
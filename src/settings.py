@@ -4,7 +4,6 @@ import os
 import sys
 
 import utils
-import containers
 
 class Pathmap():
     """
@@ -75,13 +74,18 @@ class Pathmap():
     def __getattr__(self, path):
         return self.get(context=self.context, label=path)
 
-def set_paths(target):
+def set_paths(target, workspace=None):
+    """
+    :param workspace   if specified, the staging, output and temporary
+                       (host) directories are nested under a subdirectory
+                       of this name, so that multiple builds (of different
+                       targets) can run concurrently without clashing.
+    """
     paths = Pathmap()
     paths.add_context("host", basedir=utils.get_project_root())
     paths.add_context("container", basedir="/home/dev/base")
-    paths.add_context("staging", basedir=paths.get("host", "basedir") + '/staging')
-    paths.add_context("tmp", basedir=paths.get("host", "basedir") + '.tmp')
-    paths.set_current_context('container' if containers.inside_container() else 'host')
+    paths.add_context("staging", basedir=paths.get("host", "basedir") + '/staging' + (f'/{workspace}' if workspace else ''))
+    paths.set_current_context('container' if utils.inside_container() else 'host')
 
     paths.set(context='container', label='home', path='/home/dev', relativeto=None)
     paths.set(context='all', label='src', path='src', relativeto='basedir')
@@ -95,24 +99,42 @@ def set_paths(target):
     paths.set(context='all', label='buildspecs', path='container_image_buildspec', relativeto='specs')
     paths.set(context='all', label='common', path='common', relativeto='tgroot')
     paths.set(context='host', label='outdir', path='out', relativeto='basedir')
+    # shared by all the targets, even when building several at a time
+    paths.set(context='host', label='artifact_store', path='out/store', relativeto='basedir')
     paths.set(context='container', label='outdir', path='out', relativeto='home')
     paths.set(context='container', label='sdk_path', path=paths.get("container", "home"), relativeto=None)
+    paths.set(context='container', label='dlcache', path='dl_cache', relativeto='home')
+    paths.set(context='container', label='ccache', path='ccache', relativeto='home')
+    paths.set(context='container', label='validation_cache', path='validation_cache', relativeto='home')
+    # where processes in the container dump their profiling spans (see profiler.py):
+    # not in the sdk tree, which would then count as changed
+    paths.set(context='container', label='profile_dumps', path='builder_profile', relativeto='home')
     paths.set(context='all', label='pkg_outdir', path='package', relativeto='outdir')
     paths.set(context='all', label='pkg_outdir', path='package', relativeto='outdir')
     paths.set(context='host', label='timestamp', path='timestamp', relativeto='tmpdir', isfile=True)
     paths.set(context='all', label='automated_build_steps', path='automated_build.json', relativeto='steps_dir', isfile=True)
     paths.set(context='all', label='dev_build_steps', path='dev_build.json', relativeto='steps_dir', isfile=True)
     paths.set(context='host', label='buildlog', path='build.log', relativeto='tmpdir', isfile=True)
+    paths.set(context='host', label='statslog', path='container_stats.jsonl', relativeto='tmpdir', isfile=True)
     paths.set(context='all', label='env_defaults', path='specs/environment.json', relativeto='common', isfile=True)
     paths.set(context='host', label='devconfig', path='developer.json', relativeto='basedir', isfile=True)
+    paths.set(context='host', label='cachedir', path='.cache', relativeto='basedir')
+    paths.set(context='host', label='build_context_cache', path='build_context', relativeto='cachedir')
+    paths.set(context='host', label='locks', path='locks', relativeto='cachedir')
+    paths.set(context='host', label='stamps', path='stamps', relativeto='cachedir')
+    paths.set(context='host', label='gitcache', path='git', relativeto='cachedir')
+    paths.set(context='host', label='dlcache', path='dl', relativeto='cachedir')
+    paths.set(context='host', label='ccache', path='ccache', relativeto='cachedir')
+    paths.set(context='host', label='validation_cache', path='validation', relativeto='cachedir')
+    paths.set(context='host', label='target_index', path='targets.json', relativeto='cachedir', isfile=True)
     paths.set(context='host', label='sdk_path', path='.', relativeto='basedir')
     paths.set(context='host', label='depends', path='depends', relativeto='specs')
     paths.set(context='host', label='common_scripts', path='scripts', relativeto='common')
     paths.set(context='host', label='common_hooks', path='hooks', relativeto='common_scripts')
     paths.set(context='host', label='common_files', path='files', relativeto='common')
-    paths.set(context='host;tmp', label='target_scripts', path='scripts', relativeto='target')
-    paths.set(context='host;tmp', label='target_hooks', path='hooks', relativeto='target_scripts')
-    paths.set(context='host;tmp', label='target_files', path='files', relativeto='target')
+    paths.set(context='host', label='target_scripts', path='scripts', relativeto='target')
+    paths.set(context='host', label='target_hooks', path='hooks', relativeto='target_scripts')
+    paths.set(context='host', label='target_files', path='files', relativeto='target')
     paths.set(context='container', label='filestore', path=paths.get("container", "basedir"), relativeto=None)
     paths.set(context='host', label='filestore', path=paths.get("staging", "basedir"), relativeto=None)
     paths.set(context='staging', label='filestore', path='.', relativeto='basedir')
@@ -124,6 +146,10 @@ def set_paths(target):
     paths.set(context='staging;container', label='scripts', path='scripts', relativeto='basedir')
     paths.set(context='staging;container', label='hooks', path='hooks', relativeto='scripts')
     paths.set(context='staging;container', label='depends', path='depends', relativeto='basedir')
+
+    if workspace:
+        paths.set(context='host', label='tmpdir', path=f'.tmp/work/{workspace}', relativeto='basedir')
+        paths.set(context='host', label='outdir', path=f'out/{workspace}', relativeto='basedir')
     return paths
 
 
@@ -6,27 +6,49 @@ Helper functions
 import os
 import sys
 import shutil
-import pathlib
 import json
-import jsonschema
 import subprocess
-import tarfile
-import tempfile
 import re
+import errno
+import fcntl
+import contextlib
+import threading
+import queue
+import atexit
 
 STREAM_LOGGING_ON = False
 FILE_LOGGING_ON   = False
 LOGFILE           = ".tmp/build.log"
+# max number of lines log() may be ahead of the log writer thread by
+LOG_QUEUE_SIZE    = 8192
 
-def set_logging(tostdout=False, tofile=False):
-    global STREAM_LOGGING_ON, FILE_LOGGING_ON
+# How files are materialized by cp_file() and cp_dir(); see copy_file().
+COPY_MODES        = ['auto', 'reflink', 'hardlink', 'copy']
+COPY_MODE         = 'auto'
+
+# ioctl request number for FICLONE (linux/fs.h)
+FICLONE           = 0x40049409
+
+# (source device, destination device) -> clone method known to work
+# between them, or None if data must be copied.
+_CLONE_METHODS    = {}
+
+def set_logging(tostdout=False, tofile=False, logfile=None):
+    global STREAM_LOGGING_ON, FILE_LOGGING_ON, LOGFILE
+    # lines already logged go where they were meant to
+    flush_log()
     STREAM_LOGGING_ON = tostdout
     FILE_LOGGING_ON   = tofile
+    LOGFILE           = logfile or LOGFILE
+
+_SGR_PATTERN = re.compile(r'(?:\x1B[@-Z\\-_]|[\x80-\x9A\x9C-\x9F]|(?:\x1B\[|\x9B)[0-?]*[ -/]*[@-~])')
 
 def strip_sgr(s):
     """ Strip ANSI SGR sequences from string and return it """
-    pattern = r'(?:\x1B[@-Z\\-_]|[\x80-\x9A\x9C-\x9F]|(?:\x1B\[|\x9B)[0-?]*[ -/]*[@-~])'
-    return re.sub(pattern, '', s)
+    # the vast majority of lines have nothing to strip
+    if s.isascii() and '\x1b' not in s:
+        return s
+    return _SGR_PATTERN.sub('', s)
 
 def strip_quoted_newlines(s):
     if not s:
@@ -35,19 +57,137 @@ def strip_quoted_newlines(s):
         s = s[:-1]
     return s.rstrip()
 
+class Log_writer(threading.Thread):
+    """
+    Background thread writing out the lines passed to log(), so that
+    logging costs the caller little more than queueing the line.
+    Lines are written in batches of whatever has accumulated in the
+    queue, to stdout and/or to a log file kept open between batches.
+    The queue is bounded: a caller logging faster than lines can be
+    written out blocks rather than using up memory.
+    """
+    def __init__(self):
+        super().__init__(name='log-writer', daemon=True)
+        self.queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+        self.pid   = os.getpid()
+        self.file  = None
+        self.path  = None
+
+    def get_file(self, path):
+        # reopen if the log file was deleted (e.g. .tmp cleaned up) or
+        # another log file is now in use
+        if self.file and (self.path != path or os.fstat(self.file.fileno()).st_nlink == 0):
+            self.close()
+        if not self.file:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.file = open(path, 'a', buffering=1 << 16)
+            self.path = path
+        return self.file
+
+    def close(self):
+        if self.file:
+            self.file.close()
+        self.file = None
+
+    def write(self, batch):
+        out = [msg for msg, tostdout, _ in batch if tostdout]
+        if out:
+            sys.stdout.write('\n'.join(out) + '\n')
+            sys.stdout.flush()
+        i = 0
+        while i < len(batch):
+            path = batch[i][2]
+            j = i
+            while j < len(batch) and batch[j][2] == path:
+                j += 1
+            if path:
+                f = self.get_file(path)
+                f.write('\n'.join(x[0] for x in batch[i:j]) + '\n')
+            i = j
+        if self.file:
+            self.file.flush()
+
+    def run(self):
+        while True:
+            batch, waiters = [], []
+            item = self.queue.get()
+            while True:
+                if isinstance(item, threading.Event):
+                    waiters.append(item)
+                else:
+                    batch.append(item)
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            # whatever goes wrong, the thread must live on to drain the
+            # queue: log() blocks once it is full
+            try:
+                self.write(batch)
+            except Exception as e:
+                print(f" !! Failed to write log: {e!r}", file=sys.stderr, flush=True)
+                try:
+                    self.close()
+                except Exception:
+                    self.file = None
+            for waiter in waiters:
+                waiter.set()
+
+_log_writer      = None
+_log_writer_lock = threading.Lock()
+
+def get_log_writer():
+    global _log_writer
+    with _log_writer_lock:
+        # threads do not survive fork(); nor should one ever die, but if
+        # it did, nothing would drain its queue any more
+        if _log_writer is None or _log_writer.pid != os.getpid() or not _log_writer.is_alive():
+            _log_writer = Log_writer()
+            _log_writer.start()
+        return _log_writer
+
+def flush_log():
+    """
+    Wait for everything logged so far to be written out.
+    """
+    writer = _log_writer
+    if writer is None or writer.pid != os.getpid() or not writer.is_alive():
+        return
+    done = threading.Event()
+    writer.queue.put(done)
+    done.wait()
+
+@atexit.register
+def _close_log():
+    flush_log()
+    if _log_writer is not None and _log_writer.pid == os.getpid():
+        _log_writer.close()
+
 def log(msg, cond=None):
     condition = cond
     if condition != None and not condition:
         return
+    if not (STREAM_LOGGING_ON or FILE_LOGGING_ON):
+        return
     # turn off any stray ANSI SGR effects
     msg = strip_sgr(msg)
     # strip sneaky newlines followed by single quotes, evading .rstrip()
     msg = strip_quoted_newlines(msg)
-    if STREAM_LOGGING_ON:
-        print(msg, flush=True)
-    if FILE_LOGGING_ON:
-        with open(LOGFILE, "a") as f:
-            f.write(msg + '\n')
+    get_log_writer().queue.put((msg, STREAM_LOGGING_ON, LOGFILE if FILE_LOGGING_ON else None))
+
+def log_lines(lines, cond=None):
+    """
+    Like log(), but for a batch of lines at once, which is handed to the
+    log writer as a whole. Meant for heavy streams of output (e.g. from
+    a build running in a container).
+    """
+    if cond != None and not cond:
+        return
+    if not (STREAM_LOGGING_ON or FILE_LOGGING_ON):
+        return
+    lines = [strip_quoted_newlines(strip_sgr(x)) for x in lines]
+    if lines:
+        get_log_writer().queue.put(('\n'.join(lines), STREAM_LOGGING_ON, LOGFILE if FILE_LOGGING_ON else None))
 
 def dedup(s, c, keep_last=True):
     append = s[-1] if (keep_last and s[-1] == c) else ''
@@ -75,8 +215,118 @@ def get_project_root():
     return root
 
 def is_git_repo(dirpath):
-    git_dir = f'{dirpath}/.git'
-    return os.path.exists(git_dir) and os.path.isdir(git_dir)
+    # .git is a file rather than a directory in a worktree
+    return os.path.exists(f'{dirpath}/.git')
+
+def parse_size(s):
+    """
+    Convert a size such as '512M' or '20G' (binary units; no suffix means
+    bytes) to a number of bytes.
+    """
+    units = {'': 0, 'K': 10, 'M': 20, 'G': 30, 'T': 40}
+    m = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B)?\s*', str(s), re.IGNORECASE)
+    if not m:
+        raise ValueError(f"Invalid size: '{s}'")
+    return int(float(m.group(1)) * (1 << units[m.group(2).upper()]))
+
+def set_copy_mode(mode):
+    global COPY_MODE
+    if mode not in COPY_MODES:
+        raise ValueError(f"Invalid copy mode '{mode}': must be one of {COPY_MODES}")
+    COPY_MODE = mode
+
+def is_read_only(st):
+    """
+    True if the file with the given stat has no write permission bits set.
+    """
+    return not (st.st_mode & 0o222)
+
+def _clone_file(src, dst, method):
+    """
+    Clone the contents of src into the new file dst without copying the
+    data through userspace: either as a reflink (FICLONE) or via
+    copy_file_range(), which lets the filesystem share extents or do the
+    copy server-side where it supports that.
+    """
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        if method == 'ficlone':
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return
+        remaining = os.fstat(fsrc.fileno()).st_size
+        while remaining > 0:
+            n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), remaining)
+            if n == 0:
+                break
+            remaining -= n
+
+def _try_clone_file(src, dst, st):
+    """
+    Clone src to dst using the first method that works between the two
+    filesystems involved. What works is probed once per pair of devices
+    and remembered.
+    :return   True if the file was cloned, else False.
+    """
+    key = (st.st_dev, os.stat(os.path.dirname(dst) or '.').st_dev)
+    methods = [_CLONE_METHODS[key]] if key in _CLONE_METHODS else ['ficlone', 'copy_file_range']
+    unsupported = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV, errno.EINVAL,
+                   errno.ENOSYS, errno.EBADF, errno.EPERM)
+    for method in methods:
+        if method is None:
+            break
+        if method == 'copy_file_range' and not hasattr(os, 'copy_file_range'):
+            continue
+        try:
+            _clone_file(src, dst, method)
+        except OSError as e:
+            if os.path.lexists(dst):
+                os.unlink(dst)
+            if e.errno not in unsupported:
+                raise
+        else:
+            _CLONE_METHODS[key] = method
+            return True
+    _CLONE_METHODS[key] = None
+    return False
+
+def copy_file(src, dst, mode=None):
+    """
+    Materialize the file src at dst according to the copy mode in effect
+    (or the one given).
+
+    - 'copy': plain byte copy (shutil.copy2).
+    - 'reflink': share the data with src where the filesystem supports it
+      (FICLONE, falling back to copy_file_range()); byte copy otherwise.
+    - 'hardlink': hard link dst to src; falls back to 'reflink' if that
+      is not possible (e.g. different filesystems).
+    - 'auto': hard link read-only inputs, reflink everything else.
+
+    Any existing dst is unlinked first: it must never be written to in
+    place as it could be a hard link to some other (source) file.
+    Metadata is preserved as with shutil.copy2.
+
+    :return   the path of the destination file.
+    """
+    mode = mode or COPY_MODE
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    if os.path.lexists(dst):
+        os.unlink(dst)
+
+    st = os.stat(src)
+    if mode == 'hardlink' or (mode == 'auto' and is_read_only(st)):
+        try:
+            os.link(src, dst)
+        except OSError:
+            pass
+        else:
+            return dst
+
+    if mode != 'copy' and _try_clone_file(src, dst, st):
+        shutil.copystat(src, dst)
+        return dst
+
+    shutil.copy2(src, dst)
+    return dst
 
 def cp_dir(src_dir, dst_dir, empty_first=False, just_contents=False):
     """
@@ -94,7 +344,7 @@ def cp_dir(src_dir, dst_dir, empty_first=False, just_contents=False):
         elif os.path.isfile(dst):
             raise NotADirectoryError("Source directory is a file!")
     os.makedirs(dst, exist_ok=True)
-    shutil.copytree(src_dir, dst, dirs_exist_ok=True)
+    shutil.copytree(src_dir, dst, dirs_exist_ok=True, copy_function=copy_file)
 
 def cp_file(src_file, dst_dir, dst_fname=None, make_dirs=True, must_exist=False):
     if not os.path.isfile(src_file):
@@ -103,33 +353,51 @@ def cp_file(src_file, dst_dir, dst_fname=None, make_dirs=True, must_exist=False)
         return
     if make_dirs:
         os.makedirs(dst_dir, exist_ok=True)
-    shutil.copy2(src_file, dst_dir + "/" + (dst_fname or ''))
+    copy_file(src_file, dst_dir + "/" + (dst_fname or ''))
+
+@contextlib.contextmanager
+def file_lock(path):
+    """
+    Hold an exclusive advisory lock on the file at path (created if
+    needed) for the duration of the with block. Blocks until the lock
+    is available.
+    """
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
 
 def load_json_from_file(path):
     with open(path, "r", encoding='utf8') as fh:
         return json.load(fh)
 
-def validate_json_against_schema(instancefile, schemas_dir):
-    instance     = load_json_from_file(instancefile)
-    schemafile   = schemas_dir + f"{instance['schema']}"
-    schema       = load_json_from_file(schemafile)
-
-    # add trailing slash, see
-    # https://python-jsonschema.readthedocs.io/en/stable/faq/#how-do-i-configure-a-base-uri-for-ref-resolution-using-local-files
-    schemas_path = pathlib.Path(schemas_dir).absolute().as_uri() + '/'
+def dump_json_to_file(path, obj, indent=5):
+    """
+    Replace the file at path with one containing obj as json.
+    The file is replaced rather than rewritten in place, as it
+    may share its data with another file (see copy_file()).
+    """
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w', encoding='utf8') as fh:
+        json.dump(obj, fh, indent=indent)
+    os.replace(tmp, path)
 
-    relref_resolver = jsonschema.validators.RefResolver(base_uri=schemas_path, referrer=True)
+def inside_container():
+    """
+    True if currently running inside a container, else False.
+    """
+    return bool(os.getenv("INSIDE_CONTAINER"))
 
+def validate_json_against_schema(instancefile, schemas_dir):
+    # see validation.py, which itself imports this module
+    import validation
     try:
-        jsonschema.validate(instance, schema, resolver=relref_resolver)
-    except jsonschema.exceptions.ValidationError as e :
-        print(f"Instance {instancefile} is invalid against schema {schemafile}")
-        raise
-    except jsonschema.exceptions.SchemaError as e:
-        print(f"Failed to validate {instancefile} -- invalid schema('{schemafile}')")
-        raise
-    else:
-        return instance
+        return validation.validate(instancefile, schemas_dir)
+    finally:
+        validation.save_verdicts()
 
 def run(cmd, env=None, capture=False, timeout=None):
     """
@@ -148,6 +416,8 @@ def run(cmd, env=None, capture=False, timeout=None):
                       a (<return code>, None) tuple.
     """
     proc_completed = None
+    # the output of cmd must not overtake what was logged before it
+    flush_log()
     try:
         proc_completed = subprocess.run(
                 cmd,
@@ -174,6 +444,7 @@ def interact(cmd, env=None, timeout=None):
     # note you DO NOT want to have the communication with the child proxied
     # via pipes. Docker will complain the driving program is not a tty. Instead,
     # simply interact with the program by connecting it directly to the standard streams.
+    flush_log()
     try:
         proc_completed = subprocess.run(
                 cmd,
@@ -219,22 +490,6 @@ def get_sorted_script_list(path):
             scripts.append( (prio, path + "/" + file) )
     return [x[1] for x in sorted(scripts)]
 
-def append_to_tarball(tarpath, *args, prefix=''):
-    temp_dir = tempfile.mkdtemp() + '/'
-    #print("temp_dir is ", temp_dir)
-    tar = tarfile.open(tarpath, 'r')
-    tar.extractall(path=temp_dir)
-    
-    for item in args:
-        shutil.copy2(item, temp_dir + prefix)
-
-    os.remove(tarpath)
-    tar = tarfile.open(tarpath, 'a')
-    os.chdir(temp_dir)
-    tar.add('.')
-    tar.close()
-    shutil.rmtree(temp_dir)
-
 def get_attr_if_exists(modname, attrname):
     module    = sys.modules.get(modname)
     if not module:
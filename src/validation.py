@@ -0,0 +1,285 @@
+"""
+Validation of json files (specs, build steps, developer configs) against
+their schemas.
+
+Each schema is compiled into a validator (with a resolver for its $refs
+backed by all the schemas in the schema directory, loaded once) the first
+time it is needed, and reused for the rest of the process.
+
+Schemas can also be overridden in memory (see override_schemas()), e.g. the
+enums patched in the spec overlay (see overlay.py).
+
+Verdicts are remembered across runs: a file found valid is not validated
+again as long as neither its contents nor any of the schemas (nor the
+jsonschema version) change. See Verdicts.
+
+jsonschema is only imported once something actually needs validating, as
+it takes a while to import.
+"""
+
+import os
+import json
+import time
+import pathlib
+import hashlib
+import threading
+
+import utils
+import filetree
+
+# most verdicts kept; the least recently used go first
+MAX_VERDICTS = 4096
+# fewer files than this are not worth starting worker processes for
+MIN_PARALLEL_FILES = 8
+
+_lock       = threading.Lock()
+_stores     = {}    # schemas dir -> (store for the resolver, digest of the schema set)
+_validators = {}    # (schemas dir, schema file name) -> compiled validator
+_overrides  = {}    # schemas dir -> {schema file name: schema} to use instead of the file
+_verdicts   = None
+
+def schemas_uri(schemas_dir):
+    # trailing slash, see
+    # https://python-jsonschema.readthedocs.io/en/stable/faq/#how-do-i-configure-a-base-uri-for-ref-resolution-using-local-files
+    return pathlib.Path(schemas_dir).absolute().as_uri() + '/'
+
+def _jsonschema_version():
+    import importlib.metadata
+    try:
+        return importlib.metadata.version('jsonschema')
+    except importlib.metadata.PackageNotFoundError:
+        return ''
+
+def override_schemas(schemas_dir, schemas):
+    """
+    Validate against schemas (a dict of schema file name, relative to
+    schemas_dir -> schema) instead of the files of those names under
+    schemas_dir, from now on.
+    """
+    schemas_dir = os.path.abspath(schemas_dir)
+    with _lock:
+        _overrides[schemas_dir] = dict(schemas)
+        _stores.pop(schemas_dir, None)
+        for key in [k for k in _validators if k[0] == schemas_dir]:
+            del _validators[key]
+
+def load_store(schemas_dir):
+    """
+    Return (store, digest) for the schemas under schemas_dir (with any
+    overrides applied): store maps the URI of each schema to the schema,
+    and digest identifies the schema set as a whole (and the version of
+    jsonschema checking against it).
+    """
+    schemas_dir = os.path.abspath(schemas_dir)
+    with _lock:
+        if schemas_dir in _stores:
+            return _stores[schemas_dir]
+        overrides = _overrides.get(schemas_dir, {})
+    schemas = {}
+    for relpath, st in filetree.walk_sorted(schemas_dir):
+        path = os.path.join(schemas_dir, relpath)
+        if relpath.endswith('.json') and os.path.isfile(path) and relpath not in overrides:
+            with open(path, 'rb') as f:
+                schemas[relpath] = f.read()
+    for relpath, schema in overrides.items():
+        schemas[relpath] = json.dumps(schema, sort_keys=True).encode()
+
+    store = {}
+    h = hashlib.sha256(_jsonschema_version().encode())
+    base = schemas_uri(schemas_dir)
+    for relpath, data in sorted(schemas.items()):
+        h.update(f"{relpath}\0{hashlib.sha256(data).hexdigest()}\n".encode())
+        store[base + relpath.replace(os.sep, '/')] = json.loads(data)
+    with _lock:
+        return _stores.setdefault(schemas_dir, (store, h.hexdigest()))
+
+def get_validator(schemas_dir, schema_name):
+    """
+    Return the compiled validator for the schema file schema_name (relative
+    to schemas_dir).
+    :raises jsonschema.exceptions.SchemaError  if the schema is invalid.
+    """
+    schemas_dir = os.path.abspath(schemas_dir)
+    key = (schemas_dir, schema_name)
+    with _lock:
+        if key in _validators:
+            return _validators[key]
+    store, _ = load_store(schemas_dir)
+    base = schemas_uri(schemas_dir)
+    schema = store.get(base + schema_name)
+    if schema is None:
+        schema = utils.load_json_from_file(os.path.join(schemas_dir, schema_name))
+    import jsonschema
+    cls = jsonschema.validators.validator_for(schema)
+    cls.check_schema(schema)
+    resolver = jsonschema.validators.RefResolver(base_uri=base, referrer=schema, store=store)
+    with _lock:
+        return _validators.setdefault(key, cls(schema, resolver=resolver))
+
+class Verdicts():
+    """
+    Persistent record of the files found valid, keyed by the digest of
+    their contents and the digest of the schema set they were validated
+    against. Only valid verdicts are recorded: invalid files are always
+    validated again, so that the error is reported.
+    :param path   the file the verdicts are kept in, or None to keep them
+                  in memory only.
+    """
+    def __init__(self, path):
+        self.path     = path
+        self.lockfile = path + '.lock' if path else None
+        self.entries  = self.load()
+        self.added    = {}
+
+    def load(self):
+        if not self.path:
+            return {}
+        try:
+            return utils.load_json_from_file(self.path)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def key(digest, schemas_digest):
+        return f"{digest}:{schemas_digest}"
+
+    def is_valid(self, digest, schemas_digest):
+        return self.key(digest, schemas_digest) in self.entries
+
+    def add(self, digest, schemas_digest):
+        key = self.key(digest, schemas_digest)
+        self.entries[key] = self.added[key] = time.time()
+
+    def save(self):
+        """
+        Merge the verdicts added since loading into the file, evicting the
+        least recently added ones beyond MAX_VERDICTS.
+        """
+        if not self.path or not self.added:
+            return
+        try:
+            with utils.file_lock(self.lockfile):
+                entries = {**self.load(), **self.added}
+                if len(entries) > MAX_VERDICTS:
+                    entries = dict(sorted(entries.items(), key=lambda x: x[1])[-MAX_VERDICTS:])
+                utils.dump_json_to_file(self.path, entries, indent=None)
+        except OSError as e:
+            utils.log(f"Failed to save validation verdicts to {self.path}: {e}")
+            return
+        self.entries.update(entries)
+        self.added = {}
+
+def use_verdicts(path):
+    """
+    Keep the verdicts of this process in (and take those already found
+    valid from) the file at path.
+    """
+    global _verdicts
+    _verdicts = Verdicts(path)
+
+def get_verdicts():
+    global _verdicts
+    if _verdicts is None:
+        _verdicts = Verdicts(None)
+    return _verdicts
+
+def save_verdicts():
+    """
+    Save the verdicts validate() has recorded in memory (see Verdicts.save()).
+    """
+    get_verdicts().save()
+
+def _load(instancefile):
+    with open(instancefile, 'rb') as f:
+        data = f.read()
+    return json.loads(data), hashlib.sha256(data).hexdigest()
+
+def _check(instance, instancefile, schemas_dir, verbose=True):
+    """
+    Validate instance (loaded from instancefile) against the schema it
+    names, without consulting or recording verdicts.
+    """
+    import jsonschema
+    schemafile = os.path.join(schemas_dir, instance['schema'])
+    try:
+        get_validator(schemas_dir, instance['schema']).validate(instance)
+    except jsonschema.exceptions.ValidationError:
+        if verbose:
+            print(f"Instance {instancefile} is invalid against schema {schemafile}")
+        raise
+    except jsonschema.exceptions.SchemaError:
+        if verbose:
+            print(f"Failed to validate {instancefile} -- invalid schema('{schemafile}')")
+        raise
+
+def validate(instancefile, schemas_dir):
+    """
+    Validate the json file instancefile against the schema (in schemas_dir)
+    its 'schema' key names, unless it is already known to be valid.
+    Return the instance.
+    The verdict is only recorded in memory: call save_verdicts() once done
+    validating, rather than locking and rewriting the file for each file.
+    :raises jsonschema.exceptions.ValidationError  if instancefile is invalid.
+    """
+    _, schemas_digest = load_store(schemas_dir)
+    verdicts = get_verdicts()
+    instance, digest = _load(instancefile)
+    if not verdicts.is_valid(digest, schemas_digest):
+        _check(instance, instancefile, schemas_dir)
+        verdicts.add(digest, schemas_digest)
+    return instance
+
+def _init_worker(overrides):
+    # worker processes are not necessarily forked from this one
+    _overrides.update(overrides)
+
+def _check_in_worker(instancefile, schemas_dir):
+    # exceptions do not necessarily survive pickling: only say whether
+    # it failed, the parent finds out why
+    try:
+        _check(_load(instancefile)[0], instancefile, schemas_dir, verbose=False)
+    except Exception as e:
+        return f"{type(e).__name__}: {e}".splitlines()[0]
+    return None
+
+def validate_files(files, schemas_dir, max_workers=None):
+    """
+    Validate files (see validate()), in worker processes if there are
+    enough of them not already known to be valid.
+    Return a dict mapping each file to None if it is valid, else to an
+    error message (invalid files are validated again in this process,
+    and their errors printed, for that message).
+    """
+    _, schemas_digest = load_store(schemas_dir)
+    verdicts = get_verdicts()
+    results = {}
+    pending = {}
+    for path in files:
+        _, digest = _load(path)
+        if verdicts.is_valid(digest, schemas_digest):
+            results[path] = None
+        else:
+            pending[path] = digest
+
+    errors = {}
+    if len(pending) >= MIN_PARALLEL_FILES:
+        import concurrent.futures
+        workers = min(len(pending), max_workers or os.cpu_count() or 1)
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                                    initargs=(dict(_overrides),)) as pool:
+            futures = {path: pool.submit(_check_in_worker, path, schemas_dir) for path in pending}
+            errors = {path: future.result() for path, future in futures.items()}
+    else:
+        errors = {path: _check_in_worker(path, schemas_dir) for path in pending}
+
+    for path, digest in pending.items():
+        if errors[path]:
+            try:
+                _check(_load(path)[0], path, schemas_dir)
+            except Exception as e:
+                errors[path] = str(e).splitlines()[0]
+        else:
+            verdicts.add(digest, schemas_digest)
+        results[path] = errors[path]
+    verdicts.save()
+    return {path: results[path] for path in files}